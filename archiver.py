@@ -0,0 +1,333 @@
+"""Retention and archival of the raw ``views`` collection.
+
+Raw views are kept in MongoDB for ``VIEW_RETENTION_DAYS`` (a TTL index on
+``timestamp``, see indexes.py); per-day and per-file numbers live on in
+the rollups. Before a day expires, ``python archiver.py archive`` streams
+it into ``VIEW_ARCHIVE_DIR/date=YYYY-MM-DD/views.jsonl.gz`` with a small
+``views.meta.json`` next to it. Run it daily from cron: it archives every
+finished day that is not archived yet, so a missed run is caught up by
+the next one as long as it happens within the retention window.
+
+The TTL index is not created at startup: on an existing deployment it
+would delete every view past retention before any of it was archived.
+Run ``archive`` first, then ``python archiver.py expire``, which creates
+the index and refuses while a day past retention is still unarchived.
+Once expiry is on, a day that has already started expiring is not
+archived unless forced, and is then marked partial.
+
+    python archiver.py archive [--day YYYY-MM-DD] [--force]
+    python archiver.py expire
+    python archiver.py status
+    python archiver.py query --from YYYY-MM-DD [--to YYYY-MM-DD] [--link ID] [--country CC] [--by day|country|link]
+    python archiver.py export --from YYYY-MM-DD [--to YYYY-MM-DD] [--link ID] [--country CC] [--format jsonl|csv] [-o FILE]
+"""
+import os
+import sys
+import csv
+import gzip
+import json
+import argparse
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+VIEW_RETENTION_DAYS = int(os.getenv('VIEW_RETENTION_DAYS', '30'))
+VIEW_ARCHIVE_DIR = os.getenv('VIEW_ARCHIVE_DIR', 'archive/views')
+# A day is archived once it ended this long ago, so late pipeline flushes land first
+VIEW_ARCHIVE_LAG_HOURS = float(os.getenv('VIEW_ARCHIVE_LAG_HOURS', '2'))
+# status warns about unarchived days this close to expiry
+VIEW_ARCHIVE_WARN_DAYS = int(os.getenv('VIEW_ARCHIVE_WARN_DAYS', '7'))
+
+FIELDS = ['_id', 'short_link_id', 'ip', 'country', 'user_agent', 'timestamp']
+
+
+class DayExpiringError(Exception):
+    """The day's raw views are already being removed by the TTL index"""
+
+
+def partition_dir(day: date, root: str = VIEW_ARCHIVE_DIR) -> str:
+    return os.path.join(root, f"date={day.isoformat()}")
+
+
+def archive_path(day: date, root: str = VIEW_ARCHIVE_DIR) -> str:
+    return os.path.join(partition_dir(day, root), 'views.jsonl.gz')
+
+
+def meta_path(day: date, root: str = VIEW_ARCHIVE_DIR) -> str:
+    return os.path.join(partition_dir(day, root), 'views.meta.json')
+
+
+def is_archived(day: date, root: str = VIEW_ARCHIVE_DIR) -> bool:
+    return os.path.exists(meta_path(day, root))
+
+
+def _day_range(day: date):
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+
+def expiry_cutoff(db, now: Optional[datetime] = None) -> Optional[datetime]:
+    """Views older than this may already be deleted; None while the TTL index does not exist"""
+    for index in db.views.index_information().values():
+        if 'expireAfterSeconds' in index and [k for k, _ in index['key']] == ['timestamp']:
+            return (now or datetime.utcnow()) - timedelta(seconds=index['expireAfterSeconds'])
+    return None
+
+
+def _expiring(day: date, cutoff: Optional[datetime]) -> bool:
+    return cutoff is not None and _day_range(day)[0] < cutoff
+
+
+def _to_record(view: Dict) -> Dict:
+    return {
+        '_id': str(view['_id']),
+        'short_link_id': view.get('short_link_id'),
+        'ip': view.get('ip'),
+        'country': view.get('country'),
+        'user_agent': view.get('user_agent'),
+        'timestamp': view['timestamp'].isoformat()
+    }
+
+
+def archive_day(db, day: date, root: str = VIEW_ARCHIVE_DIR, force: bool = False) -> Optional[int]:
+    """Write one day of raw views to its partition; returns the count, None if already archived.
+
+    The file is written under a temporary name and renamed into place,
+    and the meta file (which marks the day as done) is written last, so
+    an interrupted run leaves the day unarchived rather than truncated.
+    A day the TTL index has started deleting raises DayExpiringError;
+    with ``force`` what is left is archived and marked partial.
+    """
+    if is_archived(day, root) and not force:
+        return None
+    partial = _expiring(day, expiry_cutoff(db))
+    if partial and not force:
+        raise DayExpiringError(f"raw views of {day} are already expiring")
+
+    start, end = _day_range(day)
+    os.makedirs(partition_dir(day, root), exist_ok=True)
+    path = archive_path(day, root)
+    tmp_path = f"{path}.tmp"
+    count = 0
+    first = last = None
+    cursor = db.views.find({'timestamp': {'$gte': start, '$lt': end}}).sort('timestamp', 1).batch_size(5000)
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as out:
+        for view in cursor:
+            out.write(json.dumps(_to_record(view), separators=(',', ':')) + '\n')
+            count += 1
+            first = first or view['timestamp']
+            last = view['timestamp']
+    os.replace(tmp_path, path)
+
+    meta = {
+        'day': day.isoformat(),
+        'count': count,
+        'first': first.isoformat() if first else None,
+        'last': last.isoformat() if last else None,
+        'bytes': os.path.getsize(path),
+        'partial': partial,
+        'archived_at': datetime.utcnow().isoformat()
+    }
+    with open(meta_path(day, root), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return count
+
+
+def pending_days(db, root: str = VIEW_ARCHIVE_DIR, now: Optional[datetime] = None) -> List[date]:
+    """Finished days that still have raw views and no archive"""
+    now = now or datetime.utcnow()
+    oldest = db.views.find_one({}, {'timestamp': 1}, sort=[('timestamp', 1)])
+    if not oldest:
+        return []
+    last_day = (now - timedelta(hours=VIEW_ARCHIVE_LAG_HOURS)).date() - timedelta(days=1)
+    day = oldest['timestamp'].date()
+    days = []
+    while day <= last_day:
+        if not is_archived(day, root):
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def archive_pending(db, root: str = VIEW_ARCHIVE_DIR) -> Dict[date, int]:
+    """Archive every pending day, skipping (with a warning) days that already started expiring"""
+    archived = {}
+    for day in pending_days(db, root):
+        try:
+            archived[day] = archive_day(db, day, root)
+        except DayExpiringError as e:
+            print(f"⚠️ Skipped {day}: {e}; archive what is left with --day {day} --force")
+    return archived
+
+
+def enable_expiry(db, root: str = VIEW_ARCHIVE_DIR) -> List[date]:
+    """Create the views TTL index unless it would delete unarchived days.
+
+    Returns the days past retention that are not archived yet; the index
+    is only created when there are none.
+    """
+    from indexes import MANUAL_INDEXES
+
+    cutoff = datetime.utcnow() - timedelta(days=VIEW_RETENTION_DAYS)
+    blocking = [day for day in pending_days(db, root) if _expiring(day, cutoff)]
+    if not blocking:
+        db.views.create_indexes(MANUAL_INDEXES['views'])
+    return blocking
+
+
+def archived_days(root: str = VIEW_ARCHIVE_DIR) -> List[Dict]:
+    """Meta of every archived day, oldest first"""
+    if not os.path.isdir(root):
+        return []
+    metas = []
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name, 'views.meta.json')
+        if name.startswith('date=') and os.path.exists(path):
+            with open(path) as f:
+                metas.append(json.load(f))
+    return metas
+
+
+def read_archive(start: date, end: date, root: str = VIEW_ARCHIVE_DIR, link: Optional[str] = None,
+                 country: Optional[str] = None) -> Iterator[Dict]:
+    """Archived views from start to end (inclusive), optionally filtered"""
+    day = start
+    while day <= end:
+        path = archive_path(day, root)
+        if os.path.exists(path):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if link and record['short_link_id'] != link:
+                        continue
+                    if country and record['country'] != country:
+                        continue
+                    yield record
+        day += timedelta(days=1)
+
+
+def _parse_day(value: str) -> date:
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _print_status(db, root: str):
+    metas = archived_days(root)
+    for meta in metas:
+        partial = '  partial' if meta.get('partial') else ''
+        print(f"  {meta['day']}  {meta['count']:>9} views  {meta['bytes']:>11} B{partial}")
+    print(f"{len(metas)} archived days in {root}")
+
+    if db is None:
+        return
+    if expiry_cutoff(db) is None:
+        print("TTL expiry is off; run 'python archiver.py expire' once every day past retention is archived")
+    expiry_warning = datetime.utcnow().date() - timedelta(days=VIEW_RETENTION_DAYS - VIEW_ARCHIVE_WARN_DAYS)
+    pending = pending_days(db, root)
+    at_risk = [day for day in pending if day <= expiry_warning]
+    print(f"{len(pending)} finished days not archived yet")
+    if at_risk:
+        print(f"⚠️ {len(at_risk)} of them expire within {VIEW_ARCHIVE_WARN_DAYS} days: "
+              f"{', '.join(d.isoformat() for d in at_risk)}")
+
+
+def _query(records: Iterator[Dict], by: str):
+    counts: Dict[str, int] = {}
+    for record in records:
+        if by == 'day':
+            key = record['timestamp'][:10]
+        elif by == 'country':
+            key = record['country']
+        else:
+            key = record['short_link_id']
+        counts[key] = counts.get(key, 0) + 1
+    ordered = sorted(counts.items()) if by == 'day' else sorted(counts.items(), key=lambda x: x[1], reverse=True)
+    for key, count in ordered:
+        print(f"  {key:<24} {count:>9}")
+    print(f"{sum(counts.values())} views")
+
+
+def _export(records: Iterator[Dict], fmt: str, output: Optional[str]):
+    out = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        if fmt == 'csv':
+            writer = csv.DictWriter(out, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            for record in records:
+                out.write(json.dumps(record, separators=(',', ':')) + '\n')
+    finally:
+        if output:
+            out.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog='archiver.py', description='Archive and query raw views')
+    parser.add_argument('--dir', default=VIEW_ARCHIVE_DIR, help='archive root')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    archive = commands.add_parser('archive', help='archive finished days')
+    archive.add_argument('--day', type=_parse_day, help='archive only this day')
+    archive.add_argument('--force', action='store_true', help='rewrite an archived day, or archive what is left of an expiring one')
+
+    commands.add_parser('expire', help='create the TTL index once every day past retention is archived')
+    commands.add_parser('status', help='list archived days and days at risk of expiring')
+
+    for name in ('query', 'export'):
+        sub = commands.add_parser(name, help=f'{name} archived views')
+        sub.add_argument('--from', dest='start', type=_parse_day, required=True)
+        sub.add_argument('--to', dest='end', type=_parse_day)
+        sub.add_argument('--link', help='short link ID')
+        sub.add_argument('--country', help='country code')
+        if name == 'query':
+            sub.add_argument('--by', choices=['day', 'country', 'link'], default='day')
+        else:
+            sub.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+            sub.add_argument('-o', '--output', help='file to write (default stdout)')
+
+    args = parser.parse_args(argv)
+
+    if args.command in ('query', 'export'):
+        records = read_archive(args.start, args.end or args.start, args.dir, args.link, args.country)
+        if args.command == 'query':
+            _query(records, args.by)
+        else:
+            _export(records, args.format, args.output)
+        return
+
+    import database
+
+    if args.command == 'status':
+        _print_status(database.db, args.dir)
+        return
+
+    if database.db is None:
+        print("❌ MONGO_URI is not set")
+        sys.exit(1)
+    if args.command == 'expire':
+        blocking = enable_expiry(database.db, args.dir)
+        if blocking:
+            print(f"❌ {len(blocking)} days past retention are not archived yet: "
+                  f"{', '.join(d.isoformat() for d in blocking)}; run 'python archiver.py archive' first")
+            sys.exit(1)
+        print(f"✅ Raw views now expire after {VIEW_RETENTION_DAYS} days")
+        return
+    if args.day:
+        try:
+            count = archive_day(database.db, args.day, args.dir, args.force)
+        except DayExpiringError as e:
+            print(f"❌ {e}; --force archives what is left and marks it partial")
+            sys.exit(1)
+        print(f"✅ {args.day}: {count} views" if count is not None else f"{args.day} is already archived")
+    else:
+        archived = archive_pending(database.db, args.dir)
+        for day, count in archived.items():
+            print(f"✅ {day}: {count} views")
+        print(f"Archived {len(archived)} days")
+
+
+if __name__ == '__main__':
+    main()
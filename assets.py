@@ -0,0 +1,83 @@
+"""Fingerprinted static assets and response compression.
+
+Files in ``static/`` are read once, fingerprinted with a hash of their
+contents and precompressed, then served from ``/assets/<name>.<hash>.<ext>``
+with a year-long immutable ``Cache-Control``: a changed file gets a new
+URL, so browsers never need to revalidate. Brotli is used when the
+optional ``brotli`` package is installed, gzip otherwise.
+"""
+import os
+import gzip
+import hashlib
+import mimetypes
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+COMPRESS_RESPONSES = os.getenv('COMPRESS_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '500'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain', 'application/javascript', 'application/json')
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+
+def supported_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(body: bytes, encoding: str, level: int = COMPRESS_LEVEL) -> bytes:
+    if encoding == 'br':
+        # Brotli quality 0-11; dynamic responses use a mid setting, like gzip
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+class Asset:
+    def __init__(self, name: str, body: bytes):
+        self.name = name
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        self.filename = f"{stem}.{self.digest}{ext}"
+        self.url = f"/assets/{self.filename}"
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        # Static files are compressed once, at the highest level
+        self.encoded: Dict[str, bytes] = {'gzip': compress(body, 'gzip', 9)}
+        if brotli is not None:
+            self.encoded['br'] = compress(body, 'br', 11)
+
+    def variant(self, encoding: Optional[str]) -> bytes:
+        return self.encoded.get(encoding, self.body)
+
+
+def load_assets(directory: str = STATIC_DIR) -> Dict[str, Asset]:
+    assets = {}
+    if not os.path.isdir(directory):
+        return assets
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as fh:
+                assets[name] = Asset(name, fh.read())
+    return assets
+
+
+ASSETS = load_assets()
+_by_filename = {asset.filename: asset for asset in ASSETS.values()}
+
+
+def asset_url(name: str) -> str:
+    return ASSETS[name].url
+
+
+def find_asset(filename: str) -> Optional[Asset]:
+    return _by_filename.get(filename)
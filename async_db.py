@@ -0,0 +1,84 @@
+"""Awaitable versions of the database.py functions for the bot.
+
+pymongo is blocking, and a blocking call inside a pyrogram handler stops
+the event loop, and with it every other user's updates, for the whole
+round trip. Each function here has the same name and arguments as its
+database.py counterpart but runs it on a bounded thread pool
+(``DB_EXECUTOR_WORKERS`` threads), so handlers ``await`` it and the loop
+keeps serving other updates meanwhile.
+"""
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+
+import database
+
+load_dotenv()
+
+# Stays well under pymongo's default connection pool of 100
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '16'))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+    return _executor
+
+
+async def run(fn: Callable, *args, **kwargs):
+    """Run a blocking call on the database pool and wait for it without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def _async_version(name: str):
+    sync_fn = getattr(database, name)
+
+    @functools.wraps(sync_fn)
+    async def wrapper(*args, **kwargs):
+        # Looked up per call so a reconnect or replaced function is picked up
+        return await run(getattr(database, name), *args, **kwargs)
+
+    return wrapper
+
+
+get_or_create_user = _async_version('get_or_create_user')
+create_file_record = _async_version('create_file_record')
+get_file_by_short_link_id = _async_version('get_file_by_short_link_id')
+get_user_stats = _async_version('get_user_stats')
+get_user_balance = _async_version('get_user_balance')
+get_user_counters = _async_version('get_user_counters')
+get_user_daily_stats = _async_version('get_user_daily_stats')
+get_file_daily_stats = _async_version('get_file_daily_stats')
+get_all_users_stats = _async_version('get_all_users_stats')
+get_admin_summary = _async_version('get_admin_summary')
+get_cpm_rates = _async_version('get_cpm_rates')
+update_cpm_rates = _async_version('update_cpm_rates')
+create_withdrawal_request = _async_version('create_withdrawal_request')
+get_user_withdrawals = _async_version('get_user_withdrawals')
+get_pending_withdrawals = _async_version('get_pending_withdrawals')
+approve_withdrawal = _async_version('approve_withdrawal')
+reject_withdrawal = _async_version('reject_withdrawal')
+get_withdrawal_by_id = _async_version('get_withdrawal_by_id')
+get_ad_codes = _async_version('get_ad_codes')
+update_ad_code = _async_version('update_ad_code')
+remove_ad_code = _async_version('remove_ad_code')
+get_referral_stats = _async_version('get_referral_stats')
+get_referrals = _async_version('get_referrals')
+award_referral_commission = _async_version('award_referral_commission')
+get_user_files = _async_version('get_user_files')
+get_file_stats = _async_version('get_file_stats')
+delete_file = _async_version('delete_file')
+delete_file_by_short_link = _async_version('delete_file_by_short_link')
+get_file_count = _async_version('get_file_count')
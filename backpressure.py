@@ -0,0 +1,235 @@
+"""Update admission and load shedding for the bot.
+
+Pyrogram hands updates to ``BOT_WORKERS`` worker tasks through an
+unbounded queue. ``install`` swaps that queue for one that stops
+accepting low-priority updates past ``BOT_QUEUE_MAX``, and handlers
+decorated with ``gate.guard`` apply the rest of the policy:
+
+* File deliveries (``/start <link>``) and uploads are high priority: they
+  are never shed, and wait (up to ``BOT_USER_WAIT_TIMEOUT``) behind the
+  same user's earlier updates instead of being dropped.
+* Everything else is shed when the queue is over its limit, when the
+  update is older than ``BOT_MAX_UPDATE_AGE`` (the user has given up on
+  it), or, for button presses, when the user already has
+  ``BOT_USER_MAX_INFLIGHT`` updates in progress (double taps). With
+  ``BOT_SHED_POLICY=notify`` a shed button press is answered with a short
+  "busy" alert, which is not a chat message; shed messages are dropped.
+
+``gate.stats()`` reports queue depth, in-flight counts, shed counts and
+handler latency percentiles.
+"""
+import os
+import time
+import asyncio
+import functools
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Union
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '16'))
+BOT_QUEUE_MAX = int(os.getenv('BOT_QUEUE_MAX', '1000'))
+BOT_MAX_UPDATE_AGE = float(os.getenv('BOT_MAX_UPDATE_AGE', '60'))
+BOT_USER_MAX_INFLIGHT = int(os.getenv('BOT_USER_MAX_INFLIGHT', '2'))
+BOT_USER_WAIT_TIMEOUT = float(os.getenv('BOT_USER_WAIT_TIMEOUT', '10'))
+BOT_SHED_POLICY = os.getenv('BOT_SHED_POLICY', 'notify').lower()
+BOT_METRICS_INTERVAL = float(os.getenv('BOT_METRICS_INTERVAL', '0'))
+
+LATENCY_SAMPLES = 500
+BUSY_ALERT = "⏳ The bot is busy right now, please try again in a moment."
+
+HIGH = 'high'
+NORMAL = 'normal'
+
+
+def is_priority_message(text: str, has_media: bool) -> bool:
+    if has_media:
+        return True
+    parts = (text or '').split()
+    return len(parts) > 1 and parts[0].split('@')[0] == '/start' and not parts[1].startswith('ref_')
+
+
+def is_priority_raw_update(update) -> bool:
+    """Priority check on an unparsed update, before it enters the queue"""
+    message = getattr(update, 'message', None)
+    if message is None or not hasattr(message, 'message'):
+        return False
+    return is_priority_message(message.message, getattr(message, 'media', None) is not None)
+
+
+def start_priority(message) -> str:
+    """Priority for /start: file deliveries are high, plain /start and referrals normal"""
+    return HIGH if is_priority_message(message.text, False) else NORMAL
+
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """Dispatcher queue that turns away low-priority updates once it holds ``limit``"""
+
+    def __init__(self, limit: int, gate: 'UpdateGate'):
+        super().__init__()
+        self.limit = limit
+        self.gate = gate
+
+    def put_nowait(self, item):
+        # None is the dispatcher's stop signal and must always get through
+        if item is not None and self.qsize() >= self.limit and not is_priority_raw_update(item[0]):
+            self.gate.count_shed('queue_full')
+            return
+        super().put_nowait(item)
+
+
+def _percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class UpdateGate:
+    def __init__(self, queue_max: int = BOT_QUEUE_MAX, max_age: float = BOT_MAX_UPDATE_AGE,
+                 user_max_inflight: int = BOT_USER_MAX_INFLIGHT,
+                 user_wait_timeout: float = BOT_USER_WAIT_TIMEOUT, policy: str = BOT_SHED_POLICY):
+        self.queue_max = queue_max
+        self.max_age = max_age
+        self.user_max_inflight = user_max_inflight
+        self.user_wait_timeout = user_wait_timeout
+        self.policy = policy
+        self.client = None
+        self.user_slots: Dict[int, asyncio.Semaphore] = {}
+        self.user_inflight: Dict[int, int] = {}
+        self.in_flight = 0
+        self.handled = 0
+        self.errors = 0
+        self.shed: Dict[str, int] = {}
+        self.latency: Dict[str, Deque[float]] = {}
+
+    def install(self, client):
+        """Bound the client's update queue; call before the client starts"""
+        self.client = client
+        client.dispatcher.updates_queue = BoundedUpdateQueue(self.queue_max, self)
+
+    def queue_depth(self) -> int:
+        if self.client is None:
+            return 0
+        return self.client.dispatcher.updates_queue.qsize()
+
+    def count_shed(self, reason: str):
+        self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    async def _reject(self, update, reason: str):
+        self.count_shed(reason)
+        if self.policy == 'notify' and hasattr(update, 'answer') and hasattr(update, 'data'):
+            try:
+                await update.answer(BUSY_ALERT, show_alert=False)
+            except Exception:
+                pass
+
+    def _slot(self, user_id: int) -> asyncio.Semaphore:
+        slot = self.user_slots.get(user_id)
+        if slot is None:
+            slot = self.user_slots[user_id] = asyncio.Semaphore(self.user_max_inflight)
+        return slot
+
+    def _leave(self, user_id: int):
+        remaining = self.user_inflight[user_id] - 1
+        if remaining:
+            self.user_inflight[user_id] = remaining
+        else:
+            # Idle users hold no memory
+            del self.user_inflight[user_id]
+            self.user_slots.pop(user_id, None)
+
+    def _overloaded(self, update) -> Optional[str]:
+        if self.queue_depth() >= self.queue_max:
+            return 'queue_full'
+        date = getattr(update, 'date', None)
+        if date is not None and self.max_age and time.time() - date.timestamp() > self.max_age:
+            return 'stale'
+        return None
+
+    def guard(self, priority: Union[str, Callable] = NORMAL):
+        """Decorator applying the admission policy to a pyrogram handler"""
+        def decorator(handler):
+            name = handler.__name__
+            samples = self.latency.setdefault(name, deque(maxlen=LATENCY_SAMPLES))
+
+            @functools.wraps(handler)
+            async def wrapper(client, update):
+                level = priority(update) if callable(priority) else priority
+                user = getattr(update, 'from_user', None)
+                user_id = user.id if user else 0
+                is_button = hasattr(update, 'data')
+
+                if level != HIGH:
+                    reason = self._overloaded(update)
+                    if reason:
+                        return await self._reject(update, reason)
+
+                slot = self._slot(user_id)
+                if slot.locked() and is_button and level != HIGH:
+                    return await self._reject(update, 'user_inflight')
+
+                # Counts waiting updates too, so the slot outlives everyone queued on it
+                self.user_inflight[user_id] = self.user_inflight.get(user_id, 0) + 1
+                try:
+                    try:
+                        if slot.locked():
+                            await asyncio.wait_for(slot.acquire(), self.user_wait_timeout)
+                        else:
+                            # Taken without yielding, so a second tap sees the slot busy
+                            await slot.acquire()
+                        acquired = True
+                    except asyncio.TimeoutError:
+                        if level != HIGH:
+                            return await self._reject(update, 'user_timeout')
+                        # A delivery still goes out, just without the per-user limit
+                        acquired = False
+
+                    self.in_flight += 1
+                    started = time.perf_counter()
+                    try:
+                        return await handler(client, update)
+                    except Exception:
+                        self.errors += 1
+                        raise
+                    finally:
+                        samples.append(time.perf_counter() - started)
+                        self.in_flight -= 1
+                        self.handled += 1
+                        if acquired:
+                            slot.release()
+                finally:
+                    self._leave(user_id)
+
+            return wrapper
+        return decorator
+
+    def stats(self) -> Dict:
+        latency = {}
+        for name, samples in self.latency.items():
+            if samples:
+                latency[name] = {
+                    'count': len(samples),
+                    'p50_ms': round(_percentile(samples, 0.5) * 1000, 1),
+                    'p95_ms': round(_percentile(samples, 0.95) * 1000, 1),
+                    'max_ms': round(max(samples) * 1000, 1)
+                }
+        return {
+            'queue_depth': self.queue_depth(),
+            'queue_max': self.queue_max,
+            'workers': self.client.workers if self.client is not None else BOT_WORKERS,
+            'in_flight': self.in_flight,
+            'users_active': len(self.user_inflight),
+            'handled': self.handled,
+            'errors': self.errors,
+            'shed': dict(self.shed),
+            'latency': latency
+        }
+
+    async def log_periodically(self, interval: float = BOT_METRICS_INTERVAL):
+        while interval > 0:
+            await asyncio.sleep(interval)
+            print(f"📈 Bot metrics: {self.stats()}")
+
+
+gate = UpdateGate()
@@ -0,0 +1,101 @@
+"""Per-view write latency of crediting an uploader and their referrer.
+
+Compares the old per-view update_user_balance path ($inc, find_one for
+the referrer, then the referrer $inc) with a single ordered bulk_write
+of the ops record_view_batch builds for one uploader. Needs a disposable
+MongoDB server; a throwaway database is created and dropped.
+
+    BENCH_MONGO_URI=mongodb://localhost:27017 python benchmarks/bench_balance_writes.py [views]
+"""
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['MONGO_URI'] = ''
+
+from pymongo import MongoClient, monitoring
+
+import database
+
+BENCH_DB = 'file_monetization_bench'
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def legacy_update_user_balance(users, user_id, amount):
+    users.update_one(
+        {'user_id': user_id},
+        {'$inc': {'balance': amount, 'total_views': 1}, '$set': {'updated_at': database.datetime.utcnow()}}
+    )
+    user = users.find_one({'user_id': user_id})
+    if user and user.get('referrer_id'):
+        commission = amount * database.REFERRAL_COMMISSION_RATE
+        users.update_one(
+            {'user_id': user['referrer_id']},
+            {'$inc': {'balance': commission, 'referral_earnings': commission}}
+        )
+
+
+def bulk_update_user_balance(user_id, amount):
+    """One view credited the way record_view_batch does it, as one bulk_write"""
+    referrer_id = database.get_referrer_id(user_id)
+    user_ops, _ = database._balance_credit_ops(user_id, amount, referrer_id, database._hot_decider({}))
+    database.users_collection.bulk_write(user_ops, ordered=True)
+
+
+def measure(name, fn, views, counter):
+    latencies = []
+    start_trips = counter.count
+    for _ in range(views):
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    trips = (counter.count - start_trips) / views
+    latencies.sort()
+    print(f"{name:<28} p50 {statistics.median(latencies):7.3f} ms   "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1]:7.3f} ms   {trips:.1f} round trips/view")
+
+
+def main():
+    uri = os.getenv('BENCH_MONGO_URI')
+    if not uri:
+        print(__doc__)
+        sys.exit(1)
+    views = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    counter = RoundTripCounter()
+    client = MongoClient(uri, event_listeners=[counter])
+    client.drop_database(BENCH_DB)
+    db = client[BENCH_DB]
+    users = db.users
+    users.create_index('user_id', unique=True)
+
+    database.users_collection = users
+    database.get_or_create_user(1, 'referrer')
+    database.get_or_create_user(2, 'uploader', referrer_id=1)
+
+    try:
+        measure('$inc + find_one + $inc', lambda: legacy_update_user_balance(users, 2, 0.005), views, counter)
+        database._referrer_cache.clear()
+        measure('single ordered bulk_write', lambda: bulk_update_user_balance(2, 0.005), views, counter)
+    finally:
+        client.drop_database(BENCH_DB)
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
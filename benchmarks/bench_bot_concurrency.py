@@ -0,0 +1,99 @@
+"""N simultaneous /start deep links through bot.start_handler.
+
+Each database call is simulated with a fixed blocking delay (a Mongo
+round trip). Called directly from the handler, as before, the calls block
+the event loop and the requests are served one after another; through
+async_db they run on the executor and the requests overlap.
+
+    python benchmarks/bench_bot_concurrency.py [requests] [latency_ms]
+"""
+import os
+import sys
+import time
+import asyncio
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URI', '')
+# Measure the database path, not Telegram's send limits
+os.environ.setdefault('SEND_GLOBAL_RATE', '1000000')
+os.environ.setdefault('SEND_GLOBAL_BURST', '1000000')
+
+import database
+import async_db
+import bot
+
+LATENCY = 0.05
+
+FILE_RECORD = {
+    'short_link_id': 'AbCdEfGhIjK',
+    'file_name': 'report.pdf',
+    'file_type': 'document',
+    'telegram_file_id': 'BQACAgIAAxkBAAIB',
+}
+
+
+def slow(result=None):
+    def call(*args, **kwargs):
+        time.sleep(LATENCY)
+        return result
+    return call
+
+
+database.get_or_create_user = slow({'user_id': 1})
+database.get_file_by_short_link_id = slow(FILE_RECORD)
+
+
+class FakeMessage:
+    def __init__(self, user_id: int):
+        self.from_user = SimpleNamespace(id=user_id, username=f'user{user_id}')
+        self.chat = SimpleNamespace(id=user_id)
+        self.command = ['start', FILE_RECORD['short_link_id']]
+        self.text = f"/start {FILE_RECORD['short_link_id']}"
+
+    async def reply_document(self, **kwargs):
+        pass
+
+    async def reply_text(self, *args, **kwargs):
+        pass
+
+
+def blocking_version(name):
+    async def call(*args, **kwargs):
+        return getattr(database, name)(*args, **kwargs)
+    return call
+
+
+async def serve(count: int) -> float:
+    started = time.perf_counter()
+    await asyncio.gather(*(bot.start_handler(None, FakeMessage(i)) for i in range(count)))
+    return time.perf_counter() - started
+
+
+def main():
+    global LATENCY
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    LATENCY = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+
+    print(f"{count} concurrent /start deep links, 2 database calls of {LATENCY * 1000:.0f} ms each")
+    print(f"executor threads: {async_db.DB_EXECUTOR_WORKERS}")
+
+    bot.get_or_create_user = blocking_version('get_or_create_user')
+    bot.get_file_by_short_link_id = blocking_version('get_file_by_short_link_id')
+    blocking = asyncio.run(serve(count))
+    print(f"{'sync calls on the event loop':<32} {blocking * 1000:8.0f} ms")
+
+    bot.get_or_create_user = async_db.get_or_create_user
+    bot.get_file_by_short_link_id = async_db.get_file_by_short_link_id
+    pooled = asyncio.run(serve(count))
+    print(f"{'async_db (thread pool)':<32} {pooled * 1000:8.0f} ms")
+    print(f"{'speedup':<32} {blocking / pooled:8.1f}x")
+
+    # Served in parallel: all requests finish in about one request's time
+    # as long as they fit in the pool
+    if count <= async_db.DB_EXECUTOR_WORKERS:
+        assert pooled < 2 * 2 * LATENCY + 0.1, pooled
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Response bytes for one completed funnel (/download, /page1-/page4).
+
+"before" inlines the shared CSS/JS back into every page and sends it
+uncompressed, as the templates used to. "after" fetches the fingerprinted
+assets once (the browser caches them for a year) and receives compressed
+HTML. Counts response bodies only; headers are about the same either way.
+
+    python benchmarks/bench_funnel_bytes.py
+"""
+import os
+import re
+import sys
+import gzip
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URI', '')
+
+import web
+from assets import ASSETS, supported_encodings
+
+LINK = 'AbCdEfGhIjK'
+IP = '8.8.8.8'
+
+web.get_file_by_short_link_id = lambda short_link_id: {'short_link_id': short_link_id, 'uploader_id': 1}
+web.check_recent_view = lambda short_link_id, ip: False
+web.credit_view = lambda short_link_id, ip, country: None
+web.get_ad_codes = lambda: {}
+web.funnel_tokens.min_dwell = [0] * 5
+web.rate_limiter.limits = {}
+
+INLINE = {asset.url: asset.body.decode() for asset in ASSETS.values()}
+
+
+def inline_assets(html: str) -> str:
+    def stylesheet(match):
+        return f"<style>\n{INLINE[match.group(1)]}</style>"
+
+    def script(match):
+        return f"<script>\n{INLINE[match.group(1)]}</script>"
+
+    html = re.sub(r'<link rel="stylesheet" href="([^"]+)">', stylesheet, html)
+    return re.sub(r'<script src="([^"]+)"></script>', script, html)
+
+
+def decode(response) -> bytes:
+    body = response.get_data()
+    encoding = response.headers.get('Content-Encoding')
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'br':
+        import brotli
+        return brotli.decompress(body)
+    return body
+
+
+def run_funnel(client, headers):
+    """Yield (path, response) for every request a visitor makes"""
+    response = client.get(f'/download/{LINK}', headers=headers)
+    yield f'/download/{LINK}', response
+    path = response.location
+    while path:
+        response = client.get(path, headers=headers)
+        yield path.split('?')[0], response
+        match = re.search(rb"next: '(/page\d/[^']+)'", decode(response))
+        path = match.group(1).decode().replace('&amp;', '&') if match else None
+
+
+def main():
+    client = web.app.test_client()
+
+    web.COMPRESS_RESPONSES = False
+    before = 0
+    print('before (inline CSS/JS, uncompressed)')
+    for path, response in run_funnel(client, {'X-Forwarded-For': IP, 'Accept-Encoding': 'identity'}):
+        size = len(inline_assets(response.get_data(as_text=True)).encode())
+        before += size
+        print(f"  {path:<22} {size:8d} B")
+
+    web.COMPRESS_RESPONSES = True
+    encoding = ', '.join(supported_encodings())
+    headers = {'X-Forwarded-For': IP, 'Accept-Encoding': encoding}
+    after = 0
+    print(f"after (fingerprinted assets fetched once, Accept-Encoding: {encoding})")
+    for path, response in run_funnel(client, headers):
+        size = len(response.get_data())
+        after += size
+        print(f"  {path:<22} {size:8d} B")
+    for asset in ASSETS.values():
+        response = client.get(asset.url, headers=headers)
+        size = len(response.get_data())
+        after += size
+        print(f"  {asset.url:<22} {size:8d} B  (once per visitor)")
+
+    print(f"{'total before':<24} {before:8d} B")
+    print(f"{'total after':<24} {after:8d} B")
+    print(f"{'saved':<24} {1 - after / before:8.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Per-request render cost of the funnel pages.
+
+Compares the old path (four str.replace calls plus render_template_string,
+which parses and compiles the template on every hit) with the cached
+compiled templates used by web.render_page.
+
+    python benchmarks/bench_page_render.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URI', '')
+
+from flask import render_template_string
+
+import web
+
+AD_CODES = {
+    'popunder': "<script type='text/javascript' src='//pl.example.com/aa/bb/cc/popunder.js'></script>",
+    'banner': "<script>atOptions = {'key': 'abc123', 'format': 'iframe', 'height': 90, 'width': 728};</script>",
+    'native': "<div id='container-abc123'></div><script async src='//pl.example.com/native.js'></script>",
+    'smartlink': 'https://www.example.com/smartlink?key=abc123',
+    'social_bar': "<script type='text/javascript' src='//pl.example.com/social.js'></script>",
+}
+web.get_ad_codes = lambda: dict(AD_CODES)
+
+NEXT_URL = '/page2/AbCdEfGhIjK?token=0123456789abcdef'
+
+
+def legacy_render():
+    ad_codes = web.get_ad_codes()
+    template = web.PAGE_1_TEMPLATE
+    template = template.replace('<!-- Add your Adsterra Popunder code here -->', ad_codes.get('popunder', ''))
+    template = template.replace('<!-- Add your Adsterra Banner code here -->', ad_codes.get('banner', ''))
+    template = template.replace('<!-- Add your Adsterra Native Banner code here -->', ad_codes.get('native', ''))
+    template = template.replace('<!-- Add your Adsterra Social Bar code here -->', ad_codes.get('social_bar', ''))
+    return render_template_string(template, next_url=NEXT_URL)
+
+
+def cached_render():
+    return web.render_page(1, next_url=NEXT_URL)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    with web.app.test_request_context():
+        assert legacy_render() == cached_render()
+
+        results = {}
+        for name, fn in (('replace + render_template_string', legacy_render),
+                         ('cached compiled template', cached_render)):
+            best = min(timeit.repeat(fn, number=iterations, repeat=3))
+            results[name] = best / iterations * 1e6
+            print(f"{name:<34} {results[name]:9.1f} us/request")
+
+    before, after = results.values()
+    print(f"{'speedup':<34} {before / after:9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
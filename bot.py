@@ -2,14 +2,16 @@ import os
 from datetime import datetime
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from database import (
+from async_db import (
     get_or_create_user, create_file_record, get_file_by_short_link_id,
-    get_user_stats, get_all_users_stats, get_cpm_rates, update_cpm_rates,
+    get_user_stats, get_user_balance, get_user_daily_stats, get_admin_summary, get_cpm_rates, update_cpm_rates,
     create_withdrawal_request, get_user_withdrawals, get_pending_withdrawals,
     approve_withdrawal, reject_withdrawal, get_withdrawal_by_id, get_ad_codes, update_ad_code, remove_ad_code,
-    get_referral_stats, award_referral_commission, get_user_files, get_file_stats,
+    get_referral_stats, get_referrals, award_referral_commission, get_user_files, get_file_stats,
     delete_file, delete_file_by_short_link, get_file_count
 )
+from send_queue import outbox
+from backpressure import gate, start_priority, HIGH, BOT_WORKERS, BOT_METRICS_INTERVAL
 from dotenv import load_dotenv
 import secrets
 
@@ -34,8 +36,10 @@ app = Client(
     "file_monetization_bot",
     api_id=API_ID,
     api_hash=API_HASH,
-    bot_token=BOT_TOKEN
+    bot_token=BOT_TOKEN,
+    workers=BOT_WORKERS
 )
+gate.install(app)
 
 user_sessions = {}
 
@@ -65,6 +69,24 @@ def get_cancel_button(callback_data="cancel"):
     return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data=callback_data)]])
 
 
+def get_page_buttons(prefix, page):
+    """Prev/Next row for a keyset page; callback data is <prefix>_<p or n>_<cursor>"""
+    row = []
+    if page.get('prev'):
+        row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{prefix}_p_{page['prev']}"))
+    if page.get('next'):
+        row.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}_n_{page['next']}"))
+    return [row] if row else []
+
+
+def parse_page_data(data, prefix):
+    """(cursor, direction) from page navigation callback data; (None, 'next') for the first page"""
+    if not data.startswith(f"{prefix}_"):
+        return None, 'next'
+    _, step, cursor = data.split('_', 2)
+    return cursor, 'prev' if step == 'p' else 'next'
+
+
 def get_admin_keyboard():
     """Generate admin panel keyboard"""
     keyboard = [
@@ -78,6 +100,7 @@ def get_admin_keyboard():
 
 
 @app.on_message(filters.command("start"))
+@gate.guard(start_priority)
 async def start_handler(client: Client, message: Message):
     user_id = message.from_user.id
     username = message.from_user.username
@@ -92,11 +115,11 @@ async def start_handler(client: Client, message: Message):
         except:
             pass
     
-    get_or_create_user(user_id, username, referrer_id)
+    await get_or_create_user(user_id, username, referrer_id)
     
     if len(message.command) > 1:
         short_link_id = message.command[1]
-        file_record = get_file_by_short_link_id(short_link_id)
+        file_record = await get_file_by_short_link_id(short_link_id)
         
         if file_record:
             try:
@@ -106,41 +129,47 @@ async def start_handler(client: Client, message: Message):
                 keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("📊 View My Stats", callback_data="menu_stats")]])
                 
                 if file_type == 'photo':
-                    await message.reply_photo(
+                    await outbox.deliver(
+                        message, 'reply_photo',
                         photo=file_record['telegram_file_id'],
                         caption=caption,
                         reply_markup=keyboard
                     )
                 elif file_type == 'video':
-                    await message.reply_video(
+                    await outbox.deliver(
+                        message, 'reply_video',
                         video=file_record['telegram_file_id'],
                         caption=caption,
                         reply_markup=keyboard
                     )
                 elif file_type == 'audio':
-                    await message.reply_audio(
+                    await outbox.deliver(
+                        message, 'reply_audio',
                         audio=file_record['telegram_file_id'],
                         caption=caption,
                         reply_markup=keyboard
                     )
                 else:
-                    await message.reply_document(
+                    await outbox.deliver(
+                        message, 'reply_document',
                         document=file_record['telegram_file_id'],
                         caption=caption,
                         reply_markup=keyboard
                     )
             except Exception as e:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     f"❌ Sorry, there was an error retrieving the file.\n\nError: {str(e)}",
                     reply_markup=get_back_button()
                 )
         else:
-            await message.reply_text(
+            await outbox.reply(
+                message,
                 "❌ File not found or has expired.",
                 reply_markup=get_back_button()
             )
     else:
-        cpm_rates = get_cpm_rates()
+        cpm_rates = await get_cpm_rates()
         welcome_text = f"""
 👋 **Welcome to File Monetization Bot!**
 
@@ -159,25 +188,28 @@ async def start_handler(client: Client, message: Message):
 Start earning now by uploading a file or use the menu below! 🚀
 """
         is_admin = user_id == ADMIN_ID
-        await message.reply_text(welcome_text, reply_markup=get_main_menu_keyboard(is_admin))
+        await outbox.reply(message, welcome_text, reply_markup=get_main_menu_keyboard(is_admin))
 
 
 @app.on_message(filters.command("menu"))
+@gate.guard()
 async def menu_handler(client: Client, message: Message):
     user_id = message.from_user.id
     is_admin = user_id == ADMIN_ID
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "📋 **Main Menu**\n\nChoose an option below:",
         reply_markup=get_main_menu_keyboard(is_admin)
     )
 
 
 @app.on_message(filters.document | filters.video | filters.photo | filters.audio)
+@gate.guard(HIGH)
 async def file_handler(client: Client, message: Message):
     user_id = message.from_user.id
     username = message.from_user.username
     
-    get_or_create_user(user_id, username)
+    await get_or_create_user(user_id, username)
     
     if message.document:
         file_id = message.document.file_id
@@ -196,7 +228,8 @@ async def file_handler(client: Client, message: Message):
         file_name = message.audio.file_name or "audio.mp3"
         file_type = "audio"
     else:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "❌ Unsupported file type.",
             reply_markup=get_back_button()
         )
@@ -205,7 +238,7 @@ async def file_handler(client: Client, message: Message):
     short_link_id = secrets.token_urlsafe(8)
     short_link = f"{BASE_URL}/download/{short_link_id}"
     
-    create_file_record(file_id, file_name, user_id, short_link_id, short_link, file_type)
+    await create_file_record(file_id, file_name, user_id, short_link_id, short_link, file_type)
     
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("📊 View My Stats", callback_data="menu_stats")],
@@ -231,10 +264,11 @@ async def file_handler(client: Client, message: Message):
 Start sharing now! 🚀
 """
     
-    await message.reply_text(response_text, reply_markup=keyboard, disable_web_page_preview=True)
+    await outbox.reply(message, response_text, reply_markup=keyboard, disable_web_page_preview=True)
 
 
 @app.on_callback_query()
+@gate.guard()
 async def callback_handler(client: Client, callback_query: CallbackQuery):
     data = callback_query.data
     user_id = callback_query.from_user.id
@@ -243,7 +277,8 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
     try:
         # Main Menu Navigation
         if data == "menu_main":
-            await callback_query.message.edit_text(
+            await outbox.edit(
+                callback_query.message,
                 "📋 **Main Menu**\n\nChoose an option below:",
                 reply_markup=get_main_menu_keyboard(is_admin)
             )
@@ -251,10 +286,11 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
         
         # Statistics
         elif data == "menu_stats":
-            stats = get_user_stats(user_id)
+            stats = await get_user_stats(user_id)
             
             if not stats:
-                await callback_query.message.edit_text(
+                await outbox.edit(
+                    callback_query.message,
                     "📊 **Your Statistics**\n\nNo statistics available yet. Upload a file to get started!",
                     reply_markup=get_back_button()
                 )
@@ -276,17 +312,43 @@ async def callback_handler(client: Client, callback_query: CallbackQuery):
 Keep sharing your links to earn more! 🚀
 """
                 keyboard = InlineKeyboardMarkup([
+                    [
+                        InlineKeyboardButton("📅 Last 7 Days", callback_data="stats_days_7"),
+                        InlineKeyboardButton("📅 Last 30 Days", callback_data="stats_days_30")
+                    ],
                     [InlineKeyboardButton("💰 Withdraw", callback_data="menu_withdraw")],
                     [InlineKeyboardButton("🔄 Refresh Stats", callback_data="menu_stats")],
                     [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu_main")]
                 ])
-                await callback_query.message.edit_text(stats_text, reply_markup=keyboard)
+                await outbox.edit(callback_query.message, stats_text, reply_markup=keyboard)
+            await callback_query.answer()
+        
+        # Daily Statistics (last 7 / 30 days)
+        elif data.startswith("stats_days_"):
+            days = 30 if data == "stats_days_30" else 7
+            daily = await get_user_daily_stats(user_id, days)
+            
+            daily_text = f"📅 **Last {days} Days**\n\n"
+            daily_text += f"👁 **Views:** {daily['views']}\n"
+            daily_text += f"💰 **Earnings:** ${daily['earnings']:.4f}\n\n"
+            for bucket in reversed(daily['buckets']):
+                daily_text += f"`{bucket['start'].strftime('%m-%d')}` {bucket['views']} views · ${bucket['earnings']:.4f}\n"
+            if daily['countries']:
+                daily_text += "\n**📍 Top Countries:**\n"
+                for country, count in sorted(daily['countries'].items(), key=lambda x: x[1], reverse=True)[:5]:
+                    daily_text += f"• {country}: {count} views\n"
+            
+            other = 7 if days == 30 else 30
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"📅 Last {other} Days", callback_data=f"stats_days_{other}")],
+                [InlineKeyboardButton("🔙 Back to Stats", callback_data="menu_stats")]
+            ])
+            await outbox.edit(callback_query.message, daily_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # Withdraw Menu
         elif data == "menu_withdraw":
-            stats = get_user_stats(user_id)
-            balance = stats.get('balance', 0) if stats else 0
+            balance = await get_user_balance(user_id)
             
             withdraw_text = f"""
 💰 **Withdrawal Request**
@@ -326,12 +388,14 @@ Your withdrawal will be processed within 24-48 hours.
 Keep sharing your links to earn more! 💪
 """
             
-            await callback_query.message.edit_text(withdraw_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, withdraw_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # Withdrawal History
-        elif data == "menu_history":
-            withdrawals = get_user_withdrawals(user_id)
+        elif data == "menu_history" or data.startswith("history_"):
+            cursor, direction = parse_page_data(data, "history")
+            page = await get_user_withdrawals(user_id, cursor=cursor, direction=direction)
+            withdrawals = page['items']
             
             if not withdrawals:
                 history_text = """
@@ -344,7 +408,7 @@ Use the menu below to request your first withdrawal!
             else:
                 history_text = "📜 **Withdrawal History**\n\n"
                 
-                for w in withdrawals[:10]:
+                for w in withdrawals:
                     status_emoji = {
                         'pending': '⏳',
                         'approved': '✅',
@@ -360,11 +424,11 @@ Date: {w['created_at'].strftime('%Y-%m-%d %H:%M')}
                         history_text += f"Note: {w['admin_note']}\n"
                     history_text += "─────────────────\n"
             
-            keyboard = InlineKeyboardMarkup([
+            keyboard = InlineKeyboardMarkup(get_page_buttons("history", page) + [
                 [InlineKeyboardButton("💰 New Withdrawal", callback_data="menu_withdraw")],
                 [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu_main")]
             ])
-            await callback_query.message.edit_text(history_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, history_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # Help Menu
@@ -400,12 +464,12 @@ For support, contact the admin.
                 [InlineKeyboardButton("💵 View CPM Rates", callback_data="help_cpm")],
                 [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu_main")]
             ])
-            await callback_query.message.edit_text(help_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, help_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # CPM Rates Info
         elif data == "help_cpm":
-            cpm_rates = get_cpm_rates()
+            cpm_rates = await get_cpm_rates()
             cpm_text = "💵 **Current CPM Rates**\n\n"
             
             country_names = {
@@ -421,12 +485,12 @@ For support, contact the admin.
             
             cpm_text += "\n**What is CPM?**\nCPM (Cost Per Mille) is the amount you earn per 1000 views from a specific country."
             
-            await callback_query.message.edit_text(cpm_text, reply_markup=get_back_button("menu_help"))
+            await outbox.edit(callback_query.message, cpm_text, reply_markup=get_back_button("menu_help"))
             await callback_query.answer()
         
         # Referral Program
         elif data == "menu_referral":
-            ref_stats = get_referral_stats(user_id)
+            ref_stats = await get_referral_stats(user_id)
             referral_link = f"https://t.me/{BOT_USERNAME}?start=ref_{user_id}"
             
             ref_text = f"""
@@ -456,35 +520,39 @@ For support, contact the admin.
                 [InlineKeyboardButton("👥 View Referrals", callback_data="view_referrals")],
                 [InlineKeyboardButton("🔙 Back to Menu", callback_data="menu_main")]
             ])
-            await callback_query.message.edit_text(ref_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, ref_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # View Referrals List
-        elif data == "view_referrals":
-            ref_stats = get_referral_stats(user_id)
-            referred_users = ref_stats.get('referred_users', [])
+        elif data == "view_referrals" or data.startswith("referrals_"):
+            cursor, direction = parse_page_data(data, "referrals")
+            page = await get_referrals(user_id, cursor=cursor, direction=direction)
+            referred_users = page['items']
             
             if not referred_users:
                 ref_list_text = "👥 **Your Referrals**\n\nYou haven't referred anyone yet.\n\nShare your referral link to start earning!"
             else:
-                ref_list_text = f"👥 **Your Referrals ({len(referred_users)})**\n\n"
-                for idx, ref_user in enumerate(referred_users[:20], 1):
+                ref_stats = await get_referral_stats(user_id)
+                ref_list_text = f"👥 **Your Referrals ({ref_stats.get('referral_count', 0)})**\n\n"
+                for ref_user in referred_users:
                     username = ref_user.get('username', 'Unknown')
                     joined = ref_user.get('joined_at')
                     date_str = joined.strftime('%Y-%m-%d') if joined else 'N/A'
-                    ref_list_text += f"{idx}. @{username} - {date_str}\n"
+                    ref_list_text += f"• @{username} - {date_str}\n"
             
-            keyboard = InlineKeyboardMarkup([
+            keyboard = InlineKeyboardMarkup(get_page_buttons("referrals", page) + [
                 [InlineKeyboardButton("🔙 Back to Referral", callback_data="menu_referral")],
                 [InlineKeyboardButton("📋 Main Menu", callback_data="menu_main")]
             ])
-            await callback_query.message.edit_text(ref_list_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, ref_list_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # File Manager
-        elif data == "menu_files":
-            files = get_user_files(user_id, limit=10)
-            total_files = get_file_count(user_id)
+        elif data == "menu_files" or data.startswith("files_"):
+            cursor, direction = parse_page_data(data, "files")
+            page = await get_user_files(user_id, cursor=cursor, direction=direction)
+            files = page['items']
+            total_files = await get_file_count(user_id)
             
             if not files:
                 files_text = """
@@ -502,12 +570,12 @@ Send me a file to get started!
                 files_text = f"📁 **My Files & Links** ({total_files} total)\n\n"
                 
                 keyboard_buttons = []
-                for idx, file in enumerate(files, 1):
+                for file in files:
                     file_name = file.get('file_name', 'Unknown')[:30]
                     views = file.get('views', 0)
                     file_id = str(file.get('_id'))
                     
-                    files_text += f"{idx}. **{file_name}**\n"
+                    files_text += f"• **{file_name}**\n"
                     files_text += f"   👁 {views} views\n\n"
                     
                     keyboard_buttons.append([
@@ -515,16 +583,17 @@ Send me a file to get started!
                         InlineKeyboardButton("🗑️", callback_data=f"file_delete_{file_id}")
                     ])
                 
+                keyboard_buttons.extend(get_page_buttons("files", page))
                 keyboard_buttons.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="menu_main")])
                 keyboard = InlineKeyboardMarkup(keyboard_buttons)
             
-            await callback_query.message.edit_text(files_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, files_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # View File Details
         elif data.startswith("file_view_"):
             file_id = data.replace("file_view_", "")
-            file_stats = get_file_stats(file_id)
+            file_stats = await get_file_stats(file_id)
             
             if not file_stats:
                 await callback_query.answer("File not found!", show_alert=True)
@@ -552,7 +621,7 @@ Send me a file to get started!
                 [InlineKeyboardButton("🗑️ Delete File", callback_data=f"file_delete_{file_id}")],
                 [InlineKeyboardButton("🔙 Back to Files", callback_data="menu_files")]
             ])
-            await callback_query.message.edit_text(file_detail_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, file_detail_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # Delete File Confirmation
@@ -564,7 +633,8 @@ Send me a file to get started!
                 [InlineKeyboardButton("❌ Cancel", callback_data="menu_files")]
             ])
             
-            await callback_query.message.edit_text(
+            await outbox.edit(
+                callback_query.message,
                 "🗑️ **Delete File**\n\nAre you sure you want to delete this file?\nThis action cannot be undone!",
                 reply_markup=keyboard
             )
@@ -574,14 +644,16 @@ Send me a file to get started!
         elif data.startswith("file_confirm_"):
             file_id = data.replace("file_confirm_", "")
             
-            if delete_file(file_id, user_id):
-                await callback_query.message.edit_text(
+            if await delete_file(file_id, user_id):
+                await outbox.edit(
+                    callback_query.message,
                     "✅ **File Deleted Successfully!**\n\nThe file and its link have been removed.",
                     reply_markup=get_back_button("menu_files")
                 )
                 await callback_query.answer("File deleted!")
             else:
-                await callback_query.message.edit_text(
+                await outbox.edit(
+                    callback_query.message,
                     "❌ **Failed to Delete File**\n\nFile not found or you don't have permission.",
                     reply_markup=get_back_button("menu_files")
                 )
@@ -589,7 +661,8 @@ Send me a file to get started!
         
         # Upload More
         elif data == "upload_more":
-            await callback_query.message.edit_text(
+            await outbox.edit(
+                callback_query.message,
                 "📤 **Upload a File**\n\nSend me any file (document, video, photo, audio) to generate a monetized link!",
                 reply_markup=get_back_button()
             )
@@ -601,7 +674,8 @@ Send me a file to get started!
                 await callback_query.answer("❌ Admin only!", show_alert=True)
                 return
             
-            await callback_query.message.edit_text(
+            await outbox.edit(
+                callback_query.message,
                 "👨‍💼 **Admin Panel**\n\nChoose an option below:",
                 reply_markup=get_admin_keyboard()
             )
@@ -613,16 +687,13 @@ Send me a file to get started!
                 await callback_query.answer("❌ Admin only!", show_alert=True)
                 return
             
-            all_stats = get_all_users_stats()
-            total_users = len(all_stats)
-            total_balance = sum(user.get('balance', 0) for user in all_stats)
-            total_views = sum(user.get('total_views', 0) for user in all_stats)
-            
-            pending_withdrawals = get_pending_withdrawals()
-            pending_count = len(pending_withdrawals)
-            pending_amount = sum(w.get('amount', 0) for w in pending_withdrawals)
-            
-            top_users = sorted(all_stats, key=lambda x: x.get('balance', 0), reverse=True)[:5]
+            summary = await get_admin_summary(5)
+            total_users = summary.get('total_users', 0)
+            total_balance = summary.get('total_balance', 0)
+            total_views = summary.get('total_views', 0)
+            pending_count = summary.get('pending_withdrawals', 0)
+            pending_amount = summary.get('pending_amount', 0)
+            top_users = summary.get('top_users', [])
             
             top_text = "\n**Top 5 Earners:**\n"
             for idx, user in enumerate(top_users, 1):
@@ -643,7 +714,7 @@ Send me a file to get started!
                 [InlineKeyboardButton("🔄 Refresh", callback_data="admin_stats")],
                 [InlineKeyboardButton("🔙 Back to Admin", callback_data="menu_admin")]
             ])
-            await callback_query.message.edit_text(admin_text, reply_markup=keyboard)
+            await outbox.edit(callback_query.message, admin_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # Admin CPM Management
@@ -652,7 +723,7 @@ Send me a file to get started!
                 await callback_query.answer("❌ Admin only!", show_alert=True)
                 return
             
-            cpm_rates = get_cpm_rates()
+            cpm_rates = await get_cpm_rates()
             cpm_text = "💵 **CPM Rate Management**\n\n**Current Rates:**\n\n"
             
             for country, rate in cpm_rates.items():
@@ -660,7 +731,7 @@ Send me a file to get started!
             
             cpm_text += "\n**To update rates, use:**\n`/setcpm <COUNTRY> <RATE>`\n\n**Example:**\n`/setcpm US 6.0`"
             
-            await callback_query.message.edit_text(cpm_text, reply_markup=get_back_button("menu_admin"))
+            await outbox.edit(callback_query.message, cpm_text, reply_markup=get_back_button("menu_admin"))
             await callback_query.answer()
         
         # Admin Withdrawals
@@ -669,10 +740,11 @@ Send me a file to get started!
                 await callback_query.answer("❌ Admin only!", show_alert=True)
                 return
             
-            pending = get_pending_withdrawals()
+            pending = await get_pending_withdrawals()
             
             if not pending:
-                await callback_query.message.edit_text(
+                await outbox.edit(
+                    callback_query.message,
                     "📋 **Pending Withdrawals**\n\nNo pending withdrawal requests.",
                     reply_markup=get_back_button("menu_admin")
                 )
@@ -699,7 +771,7 @@ Send me a file to get started!
                 keyboard_buttons.append([InlineKeyboardButton("🔄 Refresh", callback_data="admin_withdrawals")])
                 keyboard_buttons.append([InlineKeyboardButton("🔙 Back to Admin", callback_data="menu_admin")])
                 keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                await callback_query.message.edit_text(withdrawals_text, reply_markup=keyboard)
+                await outbox.edit(callback_query.message, withdrawals_text, reply_markup=keyboard)
             await callback_query.answer()
         
         # Approve Withdrawal
@@ -711,9 +783,9 @@ Send me a file to get started!
             withdrawal_id = data.replace("withdrawal_approve_", "")
             
             # Get withdrawal details before approving
-            withdrawal = get_withdrawal_by_id(withdrawal_id)
+            withdrawal = await get_withdrawal_by_id(withdrawal_id)
             
-            if withdrawal and approve_withdrawal(withdrawal_id):
+            if withdrawal and await approve_withdrawal(withdrawal_id):
                 # Send notification to user
                 try:
                     user_notification_keyboard = InlineKeyboardMarkup([
@@ -721,7 +793,8 @@ Send me a file to get started!
                         [InlineKeyboardButton("📜 View History", callback_data="menu_history")]
                     ])
                     
-                    await client.send_message(
+                    await outbox.send(
+                        withdrawal['user_id'], client.send_message,
                         withdrawal['user_id'],
                         f"""
 ✅ **Withdrawal Approved!**
@@ -745,10 +818,11 @@ Thank you for using our service! 🎉
                 await callback_query.answer("✅ Withdrawal approved!", show_alert=True)
                 
                 # Refresh the withdrawals list
-                pending = get_pending_withdrawals()
+                pending = await get_pending_withdrawals()
                 
                 if not pending:
-                    await callback_query.message.edit_text(
+                    await outbox.edit(
+                        callback_query.message,
                         "📋 **Pending Withdrawals**\n\n✅ Withdrawal approved successfully!\n\nNo more pending withdrawal requests.",
                         reply_markup=get_back_button("menu_admin")
                     )
@@ -775,7 +849,7 @@ Thank you for using our service! 🎉
                     keyboard_buttons.append([InlineKeyboardButton("🔄 Refresh", callback_data="admin_withdrawals")])
                     keyboard_buttons.append([InlineKeyboardButton("🔙 Back to Admin", callback_data="menu_admin")])
                     keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                    await callback_query.message.edit_text(withdrawals_text, reply_markup=keyboard)
+                    await outbox.edit(callback_query.message, withdrawals_text, reply_markup=keyboard)
             else:
                 await callback_query.answer("❌ Failed to approve withdrawal!", show_alert=True)
         
@@ -788,9 +862,9 @@ Thank you for using our service! 🎉
             withdrawal_id = data.replace("withdrawal_reject_", "")
             
             # Get withdrawal details before rejecting
-            withdrawal = get_withdrawal_by_id(withdrawal_id)
+            withdrawal = await get_withdrawal_by_id(withdrawal_id)
             
-            if withdrawal and reject_withdrawal(withdrawal_id):
+            if withdrawal and await reject_withdrawal(withdrawal_id):
                 # Send notification to user
                 try:
                     user_notification_keyboard = InlineKeyboardMarkup([
@@ -798,7 +872,8 @@ Thank you for using our service! 🎉
                         [InlineKeyboardButton("💰 Try Again", callback_data="menu_withdraw")]
                     ])
                     
-                    await client.send_message(
+                    await outbox.send(
+                        withdrawal['user_id'], client.send_message,
                         withdrawal['user_id'],
                         f"""
 ❌ **Withdrawal Rejected**
@@ -822,10 +897,11 @@ Please check your account details and try again. If you have questions, contact
                 await callback_query.answer("❌ Withdrawal rejected!", show_alert=True)
                 
                 # Refresh the withdrawals list
-                pending = get_pending_withdrawals()
+                pending = await get_pending_withdrawals()
                 
                 if not pending:
-                    await callback_query.message.edit_text(
+                    await outbox.edit(
+                        callback_query.message,
                         "📋 **Pending Withdrawals**\n\n❌ Withdrawal rejected successfully!\n\nNo more pending withdrawal requests.",
                         reply_markup=get_back_button("menu_admin")
                     )
@@ -852,7 +928,7 @@ Please check your account details and try again. If you have questions, contact
                     keyboard_buttons.append([InlineKeyboardButton("🔄 Refresh", callback_data="admin_withdrawals")])
                     keyboard_buttons.append([InlineKeyboardButton("🔙 Back to Admin", callback_data="menu_admin")])
                     keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                    await callback_query.message.edit_text(withdrawals_text, reply_markup=keyboard)
+                    await outbox.edit(callback_query.message, withdrawals_text, reply_markup=keyboard)
             else:
                 await callback_query.answer("❌ Failed to reject withdrawal!", show_alert=True)
         
@@ -862,7 +938,7 @@ Please check your account details and try again. If you have questions, contact
                 await callback_query.answer("❌ Admin only!", show_alert=True)
                 return
             
-            ad_codes = get_ad_codes()
+            ad_codes = await get_ad_codes()
             
             status_text = "📺 **Ad Codes Management**\n\n"
             ad_types = {
@@ -880,14 +956,15 @@ Please check your account details and try again. If you have questions, contact
             
             status_text += "\n**Commands:**\n`/ads set <type>` - Set ad\n`/ads remove <type>` - Remove ad\n\n**Types:** popunder, banner, native, smartlink, social_bar"
             
-            await callback_query.message.edit_text(status_text, reply_markup=get_back_button("menu_admin"))
+            await outbox.edit(callback_query.message, status_text, reply_markup=get_back_button("menu_admin"))
             await callback_query.answer()
         
         # Cancel Operation
         elif data == "cancel":
             if user_id in user_sessions:
                 del user_sessions[user_id]
-            await callback_query.message.edit_text(
+            await outbox.edit(
+                callback_query.message,
                 "❌ **Operation Cancelled**",
                 reply_markup=get_back_button()
             )
@@ -903,48 +980,90 @@ Please check your account details and try again. If you have questions, contact
 
 # Legacy command handlers for backward compatibility
 @app.on_message(filters.command("help"))
+@gate.guard()
 async def help_command(client: Client, message: Message):
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "📖 **Help & Information**\n\nUse the menu below to navigate:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("ℹ️ Open Help", callback_data="menu_help")]])
     )
 
 
 @app.on_message(filters.command("stats"))
+@gate.guard()
 async def stats_command(client: Client, message: Message):
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "📊 **Your Statistics**\n\nClick below to view your stats:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📊 View Stats", callback_data="menu_stats")]])
     )
 
 
 @app.on_message(filters.command("admin"))
+@gate.guard()
 async def admin_command(client: Client, message: Message):
     user_id = message.from_user.id
     
     if user_id != ADMIN_ID:
-        await message.reply_text("❌ This command is only available to administrators.")
+        await outbox.reply(message, "❌ This command is only available to administrators.")
         return
     
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "👨‍💼 **Admin Panel**\n\nAccess admin features below:",
         reply_markup=get_admin_keyboard()
     )
 
 
+@app.on_message(filters.command("botstats"))
+@gate.guard()
+async def botstats_command(client: Client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await outbox.reply(message, "❌ This command is only available to administrators.")
+        return
+    
+    stats = gate.stats()
+    shed = ', '.join(f"{reason}: {count}" for reason, count in stats['shed'].items()) or 'none'
+    sends = outbox.stats()
+    sent = ', '.join(f"{kind}: {count}" for kind, count in sends['sent'].items()) or 'none'
+    latency = '\n'.join(
+        f"• {name}: p50 {l['p50_ms']} ms, p95 {l['p95_ms']} ms, max {l['max_ms']} ms ({l['count']})"
+        for name, l in stats['latency'].items()
+    ) or '• no samples yet'
+    await outbox.reply(message, f"""
+📈 **Bot Load**
+
+**Queue:** {stats['queue_depth']} / {stats['queue_max']}
+**Workers:** {stats['workers']}
+**In flight:** {stats['in_flight']} ({stats['users_active']} users)
+**Handled:** {stats['handled']} (errors: {stats['errors']})
+**Shed:** {shed}
+
+**Outbox:** {sends['queued']} queued, {sends['parked']} waiting on rate limits
+**Sent:** {sent}
+**FloodWaits:** {sends['flood_waits']} (retried: {sends['retried']}, failed: {sends['failed']})
+
+**Handler latency:**
+{latency}
+""")
+
+
 @app.on_message(filters.command("setcpm"))
+@gate.guard()
 async def setcpm_handler(client: Client, message: Message):
     user_id = message.from_user.id
     
     if user_id != ADMIN_ID:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "❌ This command is only available to administrators.",
             reply_markup=get_back_button()
         )
         return
     
     if len(message.command) < 3:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "❌ **Invalid Format**\n\nUsage: `/setcpm <COUNTRY> <RATE>`\n\nExample: `/setcpm US 6.0`",
             reply_markup=get_back_button("menu_admin")
         )
@@ -954,36 +1073,38 @@ async def setcpm_handler(client: Client, message: Message):
         country = message.command[1].upper()
         rate = float(message.command[2])
         
-        current_rates = get_cpm_rates()
+        current_rates = await get_cpm_rates()
         current_rates[country] = rate
-        update_cpm_rates(current_rates)
+        await update_cpm_rates(current_rates)
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("💵 View All Rates", callback_data="admin_cpm")],
             [InlineKeyboardButton("🔙 Back to Admin", callback_data="menu_admin")]
         ])
-        await message.reply_text(
+        await outbox.reply(
+            message,
             f"✅ **CPM Updated!**\n\nCPM rate for {country} updated to ${rate}",
             reply_markup=keyboard
         )
     except ValueError:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "❌ Invalid rate. Please provide a number.",
             reply_markup=get_back_button("menu_admin")
         )
     except Exception as e:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             f"❌ Error updating CPM: {str(e)}",
             reply_markup=get_back_button("menu_admin")
         )
 
 
 @app.on_message(filters.command("withdraw"))
+@gate.guard()
 async def withdraw_handler(client: Client, message: Message):
     user_id = message.from_user.id
-    stats = get_user_stats(user_id)
-    
-    balance = stats.get('balance', 0) if stats else 0
+    balance = await get_user_balance(user_id)
     
     if len(message.command) >= 4:
         try:
@@ -992,20 +1113,22 @@ async def withdraw_handler(client: Client, message: Message):
             details = ' '.join(message.command[3:])
             
             if amount < 5.0:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     "❌ Minimum withdrawal amount is $5.00",
                     reply_markup=get_back_button()
                 )
                 return
             
             if amount > balance:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     f"❌ Insufficient balance. You have ${balance:.4f}",
                     reply_markup=get_back_button()
                 )
                 return
             
-            withdrawal = create_withdrawal_request(user_id, amount, method, details)
+            withdrawal = await create_withdrawal_request(user_id, amount, method, details)
             
             if withdrawal:
                 keyboard = InlineKeyboardMarkup([
@@ -1013,7 +1136,8 @@ async def withdraw_handler(client: Client, message: Message):
                     [InlineKeyboardButton("🔙 Main Menu", callback_data="menu_main")]
                 ])
                 
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     f"""
 ✅ **Withdrawal Request Submitted!**
 
@@ -1028,7 +1152,8 @@ You will be notified once it's approved.
                 )
                 
                 try:
-                    await client.send_message(
+                    await outbox.send(
+                        ADMIN_ID, client.send_message,
                         ADMIN_ID,
                         f"""
 🔔 **New Withdrawal Request**
@@ -1044,42 +1169,50 @@ Use /withdrawals to manage requests.
                 except:
                     pass
             else:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     "❌ Failed to create withdrawal request. Please try again.",
                     reply_markup=get_back_button()
                 )
         except ValueError:
-            await message.reply_text(
+            await outbox.reply(
+                message,
                 "❌ Invalid amount. Please enter a valid number.",
                 reply_markup=get_back_button()
             )
         except Exception as e:
-            await message.reply_text(
+            await outbox.reply(
+                message,
                 f"❌ Error: {str(e)}",
                 reply_markup=get_back_button()
             )
     else:
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("💰 Withdrawal Info", callback_data="menu_withdraw")]])
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "💰 **Withdrawal**\n\nClick below for withdrawal information and instructions:",
             reply_markup=keyboard
         )
 
 
 @app.on_message(filters.command("history"))
+@gate.guard()
 async def history_command(client: Client, message: Message):
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "📜 **Withdrawal History**\n\nClick below to view your history:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📜 View History", callback_data="menu_history")]])
     )
 
 
 @app.on_message(filters.command("withdrawals"))
+@gate.guard()
 async def withdrawals_admin_handler(client: Client, message: Message):
     user_id = message.from_user.id
     
     if user_id != ADMIN_ID:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "❌ This command is only available to administrators.",
             reply_markup=get_back_button()
         )
@@ -1096,46 +1229,54 @@ async def withdrawals_admin_handler(client: Client, message: Message):
         ])
         
         if action == 'approve':
-            if approve_withdrawal(withdrawal_id, note):
-                await message.reply_text(
+            if await approve_withdrawal(withdrawal_id, note):
+                await outbox.reply(
+                    message,
                     f"✅ Withdrawal {withdrawal_id} approved!",
                     reply_markup=keyboard
                 )
             else:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     "❌ Failed to approve withdrawal.",
                     reply_markup=keyboard
                 )
         elif action == 'reject':
-            if reject_withdrawal(withdrawal_id, note):
-                await message.reply_text(
+            if await reject_withdrawal(withdrawal_id, note):
+                await outbox.reply(
+                    message,
                     f"❌ Withdrawal {withdrawal_id} rejected!",
                     reply_markup=keyboard
                 )
             else:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     "❌ Failed to reject withdrawal.",
                     reply_markup=keyboard
                 )
         else:
-            await message.reply_text(
+            await outbox.reply(
+                message,
                 "❌ Invalid action. Use: approve or reject",
                 reply_markup=keyboard
             )
         return
     
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "💸 **Withdrawal Management**\n\nClick below to view pending withdrawals:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💸 View Withdrawals", callback_data="admin_withdrawals")]])
     )
 
 
 @app.on_message(filters.command("ads"))
+@gate.guard()
 async def ads_handler(client: Client, message: Message):
     user_id = message.from_user.id
     
     if user_id != ADMIN_ID:
-        await message.reply_text(
+        await outbox.reply(
+            message,
             "❌ This command is only available to administrators.",
             reply_markup=get_back_button()
         )
@@ -1150,7 +1291,7 @@ async def ads_handler(client: Client, message: Message):
         ])
         
         if action == "view":
-            ad_codes = get_ad_codes()
+            ad_codes = await get_ad_codes()
             
             status_text = "📺 **Current Ad Codes Status**\n\n"
             ad_types = {
@@ -1170,7 +1311,7 @@ async def ads_handler(client: Client, message: Message):
                     status_text += f"  Preview: `{preview}`\n"
                 status_text += "\n"
             
-            await message.reply_text(status_text, reply_markup=keyboard)
+            await outbox.reply(message, status_text, reply_markup=keyboard)
             return
         
         elif action == "set" and len(message.command) >= 3:
@@ -1178,7 +1319,8 @@ async def ads_handler(client: Client, message: Message):
             
             valid_types = ['popunder', 'banner', 'native', 'smartlink', 'social_bar']
             if ad_type not in valid_types:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     f"❌ Invalid ad type. Valid types: {', '.join(valid_types)}",
                     reply_markup=keyboard
                 )
@@ -1188,7 +1330,8 @@ async def ads_handler(client: Client, message: Message):
             
             cancel_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel")]])
             
-            await message.reply_text(
+            await outbox.reply(
+                message,
                 f"""
 ✏️ **Setting {ad_type.upper()} Ad Code**
 
@@ -1213,25 +1356,29 @@ Just paste your complete ad code.
         elif action == "remove" and len(message.command) >= 3:
             ad_type = message.command[2].lower()
             
-            if remove_ad_code(ad_type):
-                await message.reply_text(
+            if await remove_ad_code(ad_type):
+                await outbox.reply(
+                    message,
                     f"✅ {ad_type.upper()} ad code removed successfully!",
                     reply_markup=keyboard
                 )
             else:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     "❌ Failed to remove ad code.",
                     reply_markup=keyboard
                 )
             return
     
-    await message.reply_text(
+    await outbox.reply(
+        message,
         "📺 **Ad Management**\n\nClick below to manage ads:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📺 Manage Ads", callback_data="admin_ads")]])
     )
 
 
 @app.on_message(filters.text & filters.private & ~filters.command(""))
+@gate.guard()
 async def text_handler(client: Client, message: Message):
     user_id = message.from_user.id
     
@@ -1242,13 +1389,14 @@ async def text_handler(client: Client, message: Message):
             ad_type = session.get('ad_type')
             ad_code = message.text
             
-            if update_ad_code(ad_type, ad_code):
+            if await update_ad_code(ad_type, ad_code):
                 keyboard = InlineKeyboardMarkup([
                     [InlineKeyboardButton("📺 View Ads", callback_data="admin_ads")],
                     [InlineKeyboardButton("🔙 Admin Panel", callback_data="menu_admin")]
                 ])
                 
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     f"""
 ✅ **{ad_type.upper()} Ad Code Updated!**
 
@@ -1258,7 +1406,8 @@ Your ad code has been saved and will now appear on all redirect pages.
                 )
                 del user_sessions[user_id]
             else:
-                await message.reply_text(
+                await outbox.reply(
+                    message,
                     "❌ Failed to update ad code. Please try again.",
                     reply_markup=get_cancel_button()
                 )
@@ -1266,6 +1415,8 @@ Your ad code has been saved and will now appear on all redirect pages.
 
 def run_bot():
     print("🤖 Starting Telegram Bot...")
+    if BOT_METRICS_INTERVAL > 0:
+        app.loop.create_task(gate.log_periodically())
     app.run()
 
 
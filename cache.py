@@ -0,0 +1,97 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe, size-bounded cache with per-entry expiry.
+
+    Entries are evicted in LRU order (or FIFO with ``policy='fifo'``) once
+    ``maxsize`` is reached. Negative results get their own, usually much
+    shorter, ``negative_ttl`` so failures are retried soon without
+    hammering the backing service on every call.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600, negative_ttl: float = 60,
+                 policy: str = 'lru', is_negative: Callable[[Any], bool] = lambda value: value is None):
+        if policy not in ('lru', 'fifo'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.policy = policy
+        self.is_negative = is_negative
+        self._data: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            if self.policy == 'lru':
+                self._data.move_to_end(key)
+            self.hits += 1
+            if self.is_negative(value):
+                self.negative_hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = (expires_at, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+        }
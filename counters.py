@@ -0,0 +1,199 @@
+"""Sharded counters for hot file and user documents.
+
+When one link goes viral every credited view increments the same
+``files`` and ``users`` documents, and those writes serialize on the
+document lock. With ``SHARDED_COUNTERS`` enabled, a document whose
+increment rate crosses ``HOT_WRITE_THRESHOLD`` per second is switched to
+sharded mode: the document is flagged with ``sharded_counters: True`` and
+further increments are spread over ``COUNTER_SHARDS`` documents in the
+``counter_shards`` collection. Readers add the shards back on top of the
+main document, and ``python counters.py fold`` periodically moves shard
+totals back into the main documents.
+
+Hot keys are detected per process. ``HOT_WRITE_THRESHOLD`` is the rate
+for the whole deployment, so each process compares its own share of the
+writes against the threshold divided by ``WEB_WORKERS`` (set by
+gunicorn.conf.py), since gunicorn spreads requests about evenly.
+"""
+import os
+import sys
+import time
+import random
+import threading
+from typing import Dict, Hashable, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+from dotenv import load_dotenv
+
+from cache import TTLCache
+
+load_dotenv()
+
+SHARDED_COUNTERS = os.getenv('SHARDED_COUNTERS', 'false').lower() in ('1', 'true', 'yes')
+COUNTER_SHARDS = int(os.getenv('COUNTER_SHARDS', '8'))
+HOT_WRITE_THRESHOLD = float(os.getenv('HOT_WRITE_THRESHOLD', '20'))
+HOT_WINDOW_SECONDS = float(os.getenv('HOT_WINDOW_SECONDS', '10'))
+HOT_KEY_TTL = float(os.getenv('HOT_KEY_TTL', '600'))
+# Processes sharing the write load, each of which tracks hot keys on its own
+WRITE_PROCESSES = max(1, int(os.getenv('WEB_WORKERS', '1')))
+
+# kind -> field identifying the main document
+KEY_FIELDS = {'file': 'short_link_id', 'user': 'user_id'}
+
+
+class HotKeyTracker:
+    """Counts increments per document over a fixed window and reports hot ones"""
+
+    def __init__(self, threshold: float = HOT_WRITE_THRESHOLD / WRITE_PROCESSES,
+                 window: float = HOT_WINDOW_SECONDS, hot_ttl: float = HOT_KEY_TTL):
+        self.threshold = threshold
+        self.window = window
+        self.window_started = time.monotonic()
+        self.counts: Dict[Tuple[str, Hashable], int] = {}
+        self.hot = TTLCache(maxsize=10000, ttl=hot_ttl, is_negative=lambda value: False)
+        self.lock = threading.Lock()
+
+    def record(self, kind: str, key: Hashable, increments: int = 1) -> bool:
+        """Register increments and return True if this document should be sharded"""
+        ident = (kind, key)
+        if self.hot.get(ident):
+            return True
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_started >= self.window:
+                # Starting a new window also keeps the map bounded
+                self.counts = {}
+                self.window_started = now
+            count = self.counts.get(ident, 0) + increments
+            self.counts[ident] = count
+        if count / self.window >= self.threshold:
+            self.hot.set(ident, True)
+            return True
+        return False
+
+
+tracker = HotKeyTracker()
+
+
+def shard_id(kind: str, key: Hashable, shard: int) -> str:
+    return f"{kind}:{key}:{shard}"
+
+
+def shard_update(kind: str, key: Hashable, inc: Dict) -> UpdateOne:
+    """$inc against one randomly chosen shard of a document"""
+    shard = random.randrange(COUNTER_SHARDS)
+    return UpdateOne(
+        {'_id': shard_id(kind, key, shard)},
+        {
+            '$inc': inc,
+            '$setOnInsert': {'kind': kind, 'key': key, 'shard': shard}
+        },
+        upsert=True
+    )
+
+
+def should_shard(kind: str, key: Hashable, increments: int = 1) -> bool:
+    if not SHARDED_COUNTERS:
+        return False
+    return tracker.record(kind, key, increments)
+
+
+def _add_into(target: Dict, source: Dict):
+    for field, value in source.items():
+        if field in ('_id', 'kind', 'key', 'shard'):
+            continue
+        if isinstance(value, dict):
+            _add_into(target.setdefault(field, {}), value)
+        elif isinstance(value, (int, float)):
+            target[field] = target.get(field, 0) + value
+
+
+def merge_shards(doc: Dict, shards) -> Dict:
+    """Return a copy of a main document with its shard counters added in"""
+    merged = dict(doc)
+    for field in ('geo_stats', 'geo_breakdown'):
+        if isinstance(merged.get(field), dict):
+            merged[field] = dict(merged[field])
+    for shard in shards:
+        _add_into(merged, shard)
+    return merged
+
+
+def _flatten_counters(values: Dict, prefix: str = '') -> Dict:
+    flat = {}
+    for field, value in values.items():
+        if field in ('_id', 'kind', 'key', 'shard'):
+            continue
+        path = f"{prefix}{field}"
+        if isinstance(value, dict):
+            flat.update(_flatten_counters(value, f"{path}."))
+        elif isinstance(value, (int, float)) and value:
+            flat[path] = value
+    return flat
+
+
+def _claim_shard(db, shard: Dict) -> Dict:
+    """Atomically zero a shard's counters and return the amounts taken.
+
+    Only the fields seen in ``shard`` are reset, and only those are
+    returned, so a field first incremented after the read stays in the
+    shard for the next fold.
+    """
+    reset = {}
+    for field, value in shard.items():
+        if field in ('_id', 'kind', 'key', 'shard'):
+            continue
+        if isinstance(value, dict):
+            reset[field] = {}
+        elif isinstance(value, (int, float)):
+            reset[field] = 0
+    if not reset:
+        return {}
+    before = db.counter_shards.find_one_and_update(
+        {'_id': shard['_id']}, {'$set': reset}, return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return {}
+    return _flatten_counters({field: before[field] for field in reset if field in before})
+
+
+def fold_shards(db) -> int:
+    """Move shard totals into their main documents; returns shards folded.
+
+    Each shard is claimed first (zeroed in the same atomic operation that
+    reads it) and the claimed amounts are then added to the main
+    document, so a retry or a concurrent fold can never add them twice.
+    If adding to the main document fails, the amounts go back into the
+    shard.
+    """
+    collections = {'file': db.files, 'user': db.users}
+    folded = 0
+    for shard in db.counter_shards.find({}):
+        if not _flatten_counters(shard):
+            continue
+        inc = _claim_shard(db, shard)
+        if not inc:
+            continue
+        kind = shard['kind']
+        try:
+            collections[kind].update_one({KEY_FIELDS[kind]: shard['key']}, {'$inc': inc})
+        except Exception:
+            db.counter_shards.update_one({'_id': shard['_id']}, {'$inc': inc})
+            raise
+        folded += 1
+    return folded
+
+
+if __name__ == '__main__':
+    import database
+
+    if database.db is None:
+        print("❌ MONGO_URI is not set")
+        sys.exit(1)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'fold':
+        print(f"✅ Folded {fold_shards(database.db)} counter shards")
+    else:
+        print("Usage: python counters.py fold")
+        sys.exit(1)
@@ -1,20 +1,65 @@
 import os
-from pymongo import MongoClient
-from datetime import datetime
+import time
+import threading
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta
 from typing import Optional, Dict, List
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
 
+from cache import TTLCache
+from counters import KEY_FIELDS, should_shard, shard_update, merge_shards
+import rollups
+
 load_dotenv()
 
 MONGO_URI = os.getenv('MONGO_URI')
-client = MongoClient(MONGO_URI) if MONGO_URI else None
-db = client.file_monetization if client is not None else None
+AUTO_CREATE_INDEXES = os.getenv('AUTO_CREATE_INDEXES', 'true').lower() in ('1', 'true', 'yes')
+SETTINGS_CACHE_TTL = float(os.getenv('SETTINGS_CACHE_TTL', '5'))
+REFERRAL_COMMISSION_RATE = 0.10
+VIEW_DEDUPE_MINUTES = int(os.getenv('VIEW_DEDUPE_MINUTES', '5'))
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '10'))
+client = None
+db = None
+
+users_collection = None
+files_collection = None
+views_collection = None
+settings_collection = None
+withdrawals_collection = None
+counter_shards_collection = None
+view_dedupe_collection = None
+rate_limits_collection = None
+rollups_collection = None
+
+
+def connect():
+    """(Re)create the MongoDB client.
+
+    MongoClient is not fork-safe, so pre-fork servers call this again in
+    every worker process after forking.
+    """
+    global client, db, users_collection, files_collection, views_collection, settings_collection
+    global withdrawals_collection, counter_shards_collection, view_dedupe_collection, rate_limits_collection
+    global rollups_collection
+    
+    client = MongoClient(MONGO_URI) if MONGO_URI else None
+    db = client.file_monetization if client is not None else None
+    
+    users_collection = db.users if db is not None else None
+    files_collection = db.files if db is not None else None
+    views_collection = db.views if db is not None else None
+    settings_collection = db.settings if db is not None else None
+    withdrawals_collection = db.withdrawals if db is not None else None
+    counter_shards_collection = db.counter_shards if db is not None else None
+    view_dedupe_collection = db.view_dedupe if db is not None else None
+    rate_limits_collection = db.rate_limits if db is not None else None
+    rollups_collection = db.rollups if db is not None else None
 
-users_collection = db.users if db is not None else None
-files_collection = db.files if db is not None else None
-views_collection = db.views if db is not None else None
-settings_collection = db.settings if db is not None else None
-withdrawals_collection = db.withdrawals if db is not None else None
+
+connect()
 
 
 def init_default_settings():
@@ -64,9 +109,27 @@ def get_or_create_user(user_id: int, username: str = None, referrer_id: int = No
             'referrer_id': referrer_id,
             'referral_count': 0,
             'referral_earnings': 0.0,
+            # Views per country across the user's files, kept by crediting
+            'geo_stats': {},
+            'geo_ready': True,
             'created_at': datetime.utcnow()
         }
-        users_collection.insert_one(user)
+        # Two /start updates for a new user can race; only the one whose
+        # upsert creates the document awards the referral bonus
+        try:
+            result = users_collection.update_one(
+                {'user_id': user_id},
+                {'$setOnInsert': user},
+                upsert=True
+            )
+            created = result.upserted_id is not None
+        except DuplicateKeyError:
+            # Lost a concurrent upsert race for the same user
+            created = False
+        if not created:
+            return users_collection.find_one({'user_id': user_id})
+        user['_id'] = result.upserted_id
+        _referrer_cache.set(user_id, referrer_id)
         
         # Award bonus to referrer if exists
         if referrer_id:
@@ -83,22 +146,146 @@ def get_or_create_user(user_id: int, username: str = None, referrer_id: int = No
     return user
 
 
-def update_user_balance(user_id: int, amount: float):
+# user_id -> referrer_id. A user's referrer is fixed when the account is
+# created, so entries only expire to bound memory.
+_referrer_cache = TTLCache(
+    maxsize=int(os.getenv('REFERRER_CACHE_SIZE', '100000')),
+    ttl=float(os.getenv('REFERRER_CACHE_TTL', '3600')),
+    is_negative=lambda value: False
+)
+_NOT_CACHED = object()
+
+
+def get_referrer_id(user_id: int) -> Optional[int]:
     if users_collection is None:
+        return None
+    
+    referrer_id = _referrer_cache.get(user_id, _NOT_CACHED)
+    if referrer_id is _NOT_CACHED:
+        user = users_collection.find_one({'user_id': user_id}, {'referrer_id': 1})
+        referrer_id = user.get('referrer_id') if user else None
+        _referrer_cache.set(user_id, referrer_id)
+    return referrer_id
+
+
+def get_file_referrer_id(file_record: Dict) -> Optional[int]:
+    """Referrer of a file's uploader, denormalized on newer file records"""
+    if 'uploader_referrer_id' in file_record:
+        return file_record['uploader_referrer_id']
+    return get_referrer_id(file_record['uploader_id'])
+
+
+_sharded_keys = TTLCache(maxsize=10000, ttl=3600, is_negative=lambda value: False)
+
+
+def _mark_sharded(kind: str, key):
+    """Flag a main document so readers add its counter shards back in"""
+    if _sharded_keys.get((kind, key)):
         return
+    collection = files_collection if kind == 'file' else users_collection
+    collection.update_one({KEY_FIELDS[kind]: key}, {'$set': {'sharded_counters': True}})
+    _sharded_keys.set((kind, key), True)
+
+
+def _hot_decider(state: Dict):
+    """Decide once per write (or per batch, across retries) which documents go to shards"""
+    hot = state.setdefault('hot', {})
     
-    users_collection.update_one(
-        {'user_id': user_id},
-        {
-            '$inc': {'balance': amount, 'total_views': 1},
-            '$set': {'updated_at': datetime.utcnow()}
-        }
-    )
+    def is_hot(kind: str, key, increments: int = 1) -> bool:
+        if (kind, key) not in hot:
+            hot[(kind, key)] = should_shard(kind, key, increments)
+            if hot[(kind, key)]:
+                _mark_sharded(kind, key)
+        return hot[(kind, key)]
+    return is_hot
+
+
+def _route_inc(kind: str, key, inc: Dict, main_ops: List, shard_ops: List, is_hot,
+               increments: int = 1, set_fields: Optional[Dict] = None):
+    if is_hot(kind, key, increments):
+        shard_ops.append(shard_update(kind, key, inc))
+        return
+    update = {'$inc': inc}
+    if set_fields:
+        update['$set'] = set_fields
+    main_ops.append(UpdateOne({KEY_FIELDS[kind]: key}, update))
+
+
+def _with_counter_shards(kind: str, key, doc: Dict) -> Dict:
+    """Main document plus its counter shards, for documents in sharded mode"""
+    if not doc.get('sharded_counters') or counter_shards_collection is None:
+        return doc
+    return merge_shards(doc, counter_shards_collection.find({'kind': kind, 'key': key}))
+
+
+def _balance_credit_ops(user_id: int, amount: float, referrer_id: Optional[int], is_hot,
+                        views: int = 1, geo: Optional[Dict[str, int]] = None):
+    """Users-collection and counter-shard ops crediting an uploader and their referrer.
+
+    ``geo`` maps country to views and is added to the uploader's geo_stats
+    aggregate in the same write, so it tracks the files' geo_stats.
+    """
+    user_ops, shard_ops = [], []
+    inc = {'balance': amount, 'total_views': views}
+    for country, count in (geo or {}).items():
+        inc[f'geo_stats.{country}'] = count
+    _route_inc('user', user_id, inc, user_ops, shard_ops, is_hot, views,
+               {'updated_at': datetime.utcnow()})
+    if referrer_id:
+        commission = amount * REFERRAL_COMMISSION_RATE
+        _route_inc('user', referrer_id, {'balance': commission, 'referral_earnings': commission},
+                   user_ops, shard_ops, is_hot, views)
+    return user_ops, shard_ops
+
+
+# short_link_id -> file record without its counters. Records do not change
+# after upload, so only deletes invalidate; unknown IDs are cached briefly
+# so enumeration with random IDs does not reach MongoDB. Deletes also bump
+# a shared version counter, which every process (web workers, the bot)
+# polls at most once per SETTINGS_CACHE_TTL and clears its cache on.
+_file_cache = TTLCache(
+    maxsize=int(os.getenv('FILE_CACHE_SIZE', '50000')),
+    ttl=float(os.getenv('FILE_CACHE_TTL', '300')),
+    negative_ttl=float(os.getenv('FILE_CACHE_NEGATIVE_TTL', '30'))
+)
+_file_cache_version = None
+_file_cache_checked_at = 0.0
+_file_cache_lock = threading.Lock()
+# Counters change on every view; get_file_stats reads them fresh
+_FILE_COUNTER_FIELDS = {'views': 0, 'geo_stats': 0, 'sharded_counters': 0}
+
+
+def _check_file_cache_version():
+    global _file_cache_version, _file_cache_checked_at
     
-    # Award commission to referrer if exists
-    user = users_collection.find_one({'user_id': user_id})
-    if user and user.get('referrer_id'):
-        award_referral_commission(user['referrer_id'], amount)
+    if settings_collection is None or time.monotonic() - _file_cache_checked_at < SETTINGS_CACHE_TTL:
+        return
+    # Only one thread polls; the rest keep serving the cached records
+    if not _file_cache_lock.acquire(blocking=False):
+        return
+    try:
+        doc = settings_collection.find_one({'type': 'file_cache_version'})
+        version = doc.get('version', 0) if doc else 0
+        if _file_cache_version is not None and version != _file_cache_version:
+            _file_cache.clear()
+        _file_cache_version = version
+        _file_cache_checked_at = time.monotonic()
+    finally:
+        _file_cache_lock.release()
+
+
+def _invalidate_file(short_link_id: str):
+    """Drop a deleted file here and, within SETTINGS_CACHE_TTL, in every other process"""
+    _file_cache.invalidate(short_link_id)
+    if settings_collection is not None:
+        settings_collection.update_one(
+            {'type': 'file_cache_version'},
+            {
+                '$inc': {'version': 1},
+                '$set': {'updated_at': datetime.utcnow()}
+            },
+            upsert=True
+        )
 
 
 def create_file_record(telegram_file_id: str, file_name: str, uploader_id: int, short_link_id: str, short_link: str, file_type: str = 'document') -> Dict:
@@ -112,11 +299,13 @@ def create_file_record(telegram_file_id: str, file_name: str, uploader_id: int,
         'file_type': file_type,
         'uploader_id': uploader_id,
         'short_link': short_link,
+        'uploader_referrer_id': get_referrer_id(uploader_id),
         'views': 0,
         'geo_stats': {},
         'created_at': datetime.utcnow()
     }
     files_collection.insert_one(file_record)
+    _file_cache.invalidate(short_link_id)
     
     users_collection.update_one(
         {'user_id': uploader_id},
@@ -127,24 +316,20 @@ def create_file_record(telegram_file_id: str, file_name: str, uploader_id: int,
 
 
 def get_file_by_short_link_id(short_link_id: str) -> Optional[Dict]:
+    """File record (without view counters), served from the in-process cache"""
     if files_collection is None:
         return None
-    return files_collection.find_one({'short_link_id': short_link_id})
-
-
-def increment_file_views(short_link_id: str, country: str):
-    if files_collection is None:
-        return
     
-    files_collection.update_one(
-        {'short_link_id': short_link_id},
-        {
-            '$inc': {
-                'views': 1,
-                f'geo_stats.{country}': 1
-            }
-        }
+    _check_file_cache_version()
+    file_record = _file_cache.get_or_load(
+        short_link_id,
+        lambda: files_collection.find_one({'short_link_id': short_link_id}, _FILE_COUNTER_FIELDS)
     )
+    return dict(file_record) if file_record else None
+
+
+def get_file_cache_stats() -> Dict:
+    return _file_cache.stats()
 
 
 def create_view_record(short_link_id: str, ip: str, country: str, user_agent: str = None):
@@ -161,29 +346,282 @@ def create_view_record(short_link_id: str, ip: str, country: str, user_agent: st
     views_collection.insert_one(view_record)
 
 
-def check_recent_view(short_link_id: str, ip: str, minutes: int = 5) -> bool:
-    if views_collection is None:
+def _view_dedupe_key(short_link_id: str, ip: str, minutes: int) -> str:
+    # Views are deduplicated per fixed time bucket of `minutes`
+    bucket = int(time.time() // (minutes * 60))
+    return f"{short_link_id}:{ip}:{bucket}"
+
+
+def check_recent_view(short_link_id: str, ip: str, minutes: int = VIEW_DEDUPE_MINUTES) -> bool:
+    if view_dedupe_collection is None:
         return False
     
-    from datetime import timedelta
-    cutoff_time = datetime.utcnow() - timedelta(minutes=minutes)
+    key = _view_dedupe_key(short_link_id, ip, minutes)
+    return view_dedupe_collection.find_one({'_id': key}, {'_id': 1}) is not None
+
+
+def claim_view(short_link_id: str, ip: str, minutes: int = VIEW_DEDUPE_MINUTES) -> bool:
+    """Atomically reserve the credit for (link, ip, time bucket).
+
+    Returns True for exactly one caller per bucket, so parallel tabs or
+    replayed requests cannot credit the same view twice. Keys expire
+    through the TTL index on expires_at.
+    """
+    if view_dedupe_collection is None:
+        return True
     
-    recent_view = views_collection.find_one({
-        'short_link_id': short_link_id,
-        'ip': ip,
-        'timestamp': {'$gte': cutoff_time}
-    })
+    key = _view_dedupe_key(short_link_id, ip, minutes)
+    try:
+        result = view_dedupe_collection.update_one(
+            {'_id': key},
+            {
+                '$setOnInsert': {
+                    'short_link_id': short_link_id,
+                    'ip': ip,
+                    'expires_at': datetime.utcnow() + timedelta(minutes=minutes * 2)
+                }
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Lost a concurrent upsert race for the same key
+        return False
+    return result.upserted_id is not None
+
+
+def claim_token(token_id: str, ttl: int) -> bool:
+    """Atomically mark a funnel token as used; True only for its first use.
+
+    Tokens are bound to a network prefix rather than one address, so
+    without this a finished token could be replayed from every address
+    on the prefix. The key expires with the token, ``ttl`` seconds on.
+    """
+    if view_dedupe_collection is None:
+        return True
+    
+    try:
+        result = view_dedupe_collection.update_one(
+            {'_id': f"token:{token_id}"},
+            {'$setOnInsert': {'expires_at': datetime.utcnow() + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return result.upserted_id is not None
+
+
+class PartialWriteError(Exception):
+    """Some operations of a bulk write kept failing.
+
+    ``remaining`` holds them as update specs ({'q', 'u', 'upsert'}) so a
+    later retry can apply exactly those and not the ones that succeeded.
+    """
+
+    def __init__(self, collection_name: str, remaining: List[Dict], errors: List[Dict]):
+        super().__init__(f"{len(remaining)} writes on {collection_name} failed: {errors[:3]}")
+        self.remaining = remaining
+
+
+def _bulk_write_retrying_failed_ops(collection, ops: List, attempts: int = 3):
+    """Unordered bulk_write that resubmits only the operations that failed"""
+    for attempt in range(attempts):
+        try:
+            collection.bulk_write(ops, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if attempt == attempts - 1:
+                raise PartialWriteError(collection.name, [err['op'] for err in errors], errors)
+            ops = [ops[err['index']] for err in errors]
+
+
+def _ops_from_specs(specs: List[Dict]) -> List[UpdateOne]:
+    return [UpdateOne(spec['q'], spec['u'], upsert=spec.get('upsert', False)) for spec in specs]
+
+
+def record_view_batch(views: List[Dict], state: Dict = None):
+    """Persist a batch of completed views with one write per collection.
+
+    Each view carries _id, short_link_id, ip, country, user_agent,
+    timestamp, uploader_id, earnings and optionally referrer_id. View
+    documents are inserted with insert_many; file and user counters are
+    summed per document and applied as one $inc each, with referrer
+    commissions in the same users bulk_write, and the batch is added to
+    the hourly and daily rollup buckets. ``state`` records finished
+    stages, the operations of a stage that only partly succeeded, the
+    links that still exist and the hot-document routing, so a retried
+    batch neither applies a write twice nor routes it differently.
+    Views of deleted files are not credited. Writes that keep failing
+    raise.
+    """
+    if views_collection is None or not views:
+        return
+    if state is None:
+        state = {}
+    completed = state.setdefault('completed', set())
+    is_hot = _hot_decider(state)
     
-    return recent_view is not None
+    now = datetime.utcnow()
+    
+    if 'views' not in completed:
+        view_docs = [
+            {
+                '_id': v['_id'],
+                'short_link_id': v['short_link_id'],
+                'ip': v['ip'],
+                'country': v['country'],
+                'user_agent': v.get('user_agent'),
+                'timestamp': v.get('timestamp', now)
+            }
+            for v in views
+        ]
+        try:
+            views_collection.insert_many(view_docs, ordered=False)
+        except BulkWriteError as e:
+            # Documents already written by an earlier attempt are fine
+            if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                raise
+        completed.add('views')
+    
+    # The web worker may have served a file from its cache after it was
+    # deleted; such views are kept as raw records but earn nothing
+    if 'live_links' not in state:
+        links = list({v['short_link_id'] for v in views})
+        state['live_links'] = {
+            f['short_link_id']
+            for f in files_collection.find({'short_link_id': {'$in': links}}, {'short_link_id': 1})
+        }
+    views = [v for v in views if v['short_link_id'] in state['live_links']]
+    
+    file_incs: Dict[str, Dict[str, int]] = {}
+    user_incs: Dict[int, Dict[str, float]] = {}
+    referrers: Dict[int, Optional[int]] = {}
+    for v in views:
+        inc = file_incs.setdefault(v['short_link_id'], {})
+        inc['views'] = inc.get('views', 0) + 1
+        geo_key = f"geo_stats.{v['country']}"
+        inc[geo_key] = inc.get(geo_key, 0) + 1
+        
+        if v.get('uploader_id') is not None:
+            inc = user_incs.setdefault(v['uploader_id'], {'balance': 0.0, 'total_views': 0, 'geo': {}})
+            inc['balance'] += v.get('earnings', 0.0)
+            inc['total_views'] += 1
+            inc['geo'][v['country']] = inc['geo'].get(v['country'], 0) + 1
+            if v['uploader_id'] not in referrers:
+                referrers[v['uploader_id']] = (
+                    v['referrer_id'] if 'referrer_id' in v else get_referrer_id(v['uploader_id'])
+                )
+    
+    file_ops, file_shard_ops = [], []
+    for short_link_id, inc in file_incs.items():
+        _route_inc('file', short_link_id, inc, file_ops, file_shard_ops, is_hot, inc['views'])
+    
+    user_ops, user_shard_ops = [], []
+    for user_id, inc in user_incs.items():
+        ops, shard_ops = _balance_credit_ops(user_id, inc['balance'], referrers[user_id], is_hot,
+                                             inc['total_views'], inc['geo'])
+        user_ops.extend(ops)
+        user_shard_ops.extend(shard_ops)
+    
+    bucket_ops = rollups.rollup_ops(views, now) if rollups_collection is not None else []
+    
+    stages = (
+        ('files', files_collection, file_ops),
+        ('users', users_collection, user_ops),
+        ('counter_shards', counter_shards_collection, file_shard_ops + user_shard_ops),
+        ('rollups', rollups_collection, bucket_ops),
+    )
+    remaining = state.setdefault('remaining', {})
+    for stage, collection, ops in stages:
+        if stage in completed:
+            continue
+        if stage in remaining:
+            ops = _ops_from_specs(remaining[stage])
+        if ops:
+            try:
+                _bulk_write_retrying_failed_ops(collection, ops)
+            except PartialWriteError as e:
+                remaining[stage] = e.remaining
+                raise
+        remaining.pop(stage, None)
+        completed.add(stage)
+
+
+# Settings cache: settings documents are read on every view but change
+# rarely, so each process keeps them in memory and only polls the version
+# counter (bumped by every update) once per SETTINGS_CACHE_TTL.
+_settings_cache: Dict[str, Dict] = {}
+_settings_version = None
+_settings_checked_at = 0.0
+_settings_lock = threading.Lock()
+
+
+def _refresh_settings_cache():
+    global _settings_cache, _settings_version, _settings_checked_at
+    
+    if time.monotonic() - _settings_checked_at < SETTINGS_CACHE_TTL:
+        return
+    # Only one thread polls; the rest keep serving the cached documents
+    if not _settings_lock.acquire(blocking=False):
+        return
+    try:
+        doc = settings_collection.find_one({'type': 'settings_version'})
+        version = doc.get('version', 0) if doc else 0
+        if version != _settings_version:
+            cached_types = list(_settings_cache)
+            fresh = {t: {} for t in cached_types}
+            if cached_types:
+                for setting in settings_collection.find({'type': {'$in': cached_types}}):
+                    fresh[setting['type']] = setting
+            _settings_cache = fresh
+            _settings_version = version
+        _settings_checked_at = time.monotonic()
+    finally:
+        _settings_lock.release()
+
+
+def _get_setting(setting_type: str) -> Dict:
+    _refresh_settings_cache()
+    
+    setting = _settings_cache.get(setting_type)
+    if setting is None:
+        with _settings_lock:
+            setting = _settings_cache.get(setting_type)
+            if setting is None:
+                setting = settings_collection.find_one({'type': setting_type}) or {}
+                _settings_cache[setting_type] = setting
+    return setting
+
+
+def _bump_settings_version():
+    global _settings_checked_at
+    
+    settings_collection.update_one(
+        {'type': 'settings_version'},
+        {
+            '$inc': {'version': 1},
+            '$set': {'updated_at': datetime.utcnow()}
+        },
+        upsert=True
+    )
+    _settings_checked_at = 0.0
+
+
+def get_settings_version() -> int:
+    """Counter that changes whenever CPM rates or ad codes are updated"""
+    if settings_collection is None:
+        return 0
+    _refresh_settings_cache()
+    return _settings_version or 0
 
 
 def get_cpm_rates() -> Dict[str, float]:
     if settings_collection is None:
         return {'US': 5.0, 'GB': 4.0, 'IN': 2.0, 'OTHER': 1.0}
     
-    settings = settings_collection.find_one({'type': 'cpm_rates'})
+    settings = _get_setting('cpm_rates')
     if settings:
-        return settings.get('rates', {})
+        return dict(settings.get('rates', {}))
     return {'US': 5.0, 'GB': 4.0, 'IN': 2.0, 'OTHER': 1.0}
 
 
@@ -201,22 +639,79 @@ def update_cpm_rates(rates: Dict[str, float]):
         },
         upsert=True
     )
+    _bump_settings_version()
 
 
-def get_user_stats(user_id: int) -> Dict:
+# Scalar counters on a user document; reads that only need these skip
+# geo_stats, which grows with every country the user gets views from.
+_USER_COUNTER_FIELDS = {
+    'balance': 1, 'total_views': 1, 'files_uploaded': 1,
+    'referral_count': 1, 'referral_earnings': 1, 'sharded_counters': 1
+}
+
+
+def _read_user(user_id: int, projection: Dict) -> Optional[Dict]:
+    user = users_collection.find_one({'user_id': user_id}, dict(projection, _id=0))
+    if not user:
+        return None
+    return _with_counter_shards('user', user_id, user)
+
+
+def get_user_balance(user_id: int) -> float:
+    """Current balance only, for withdraw checks"""
+    if users_collection is None:
+        return 0.0
+    
+    user = _read_user(user_id, {'balance': 1, 'sharded_counters': 1})
+    return user.get('balance', 0.0) if user else 0.0
+
+
+def get_user_counters(user_id: int) -> Dict:
+    """Balance, view, file and referral counters without the geo breakdown"""
     if users_collection is None:
         return {}
     
-    user = users_collection.find_one({'user_id': user_id})
+    user = _read_user(user_id, _USER_COUNTER_FIELDS)
     if not user:
         return {}
-    
-    files = list(files_collection.find({'uploader_id': user_id})) if files_collection is not None else []
-    
+    return {
+        'balance': user.get('balance', 0.0),
+        'total_views': user.get('total_views', 0),
+        'files_uploaded': user.get('files_uploaded', 0),
+        'referral_count': user.get('referral_count', 0),
+        'referral_earnings': user.get('referral_earnings', 0.0)
+    }
+
+
+def _geo_breakdown_from_files(user_id: int) -> Dict[str, int]:
+    """Per-country views summed over the user's files (one read per file)"""
     geo_breakdown = {}
+    if files_collection is None:
+        return geo_breakdown
+    
+    files = files_collection.find({'uploader_id': user_id},
+                                  {'short_link_id': 1, 'geo_stats': 1, 'sharded_counters': 1})
     for file in files:
+        file = _with_counter_shards('file', file['short_link_id'], file)
         for country, count in file.get('geo_stats', {}).items():
             geo_breakdown[country] = geo_breakdown.get(country, 0) + count
+    return geo_breakdown
+
+
+def get_user_stats(user_id: int) -> Dict:
+    if users_collection is None:
+        return {}
+    
+    user = _read_user(user_id, dict(_USER_COUNTER_FIELDS, geo_stats=1, geo_ready=1))
+    if not user:
+        return {}
+    
+    if user.get('geo_ready'):
+        geo_breakdown = {country: count for country, count in user.get('geo_stats', {}).items() if count}
+    else:
+        # Accounts created before the aggregate existed, until
+        # ``python geo_aggregate.py backfill`` has run
+        geo_breakdown = _geo_breakdown_from_files(user_id)
     
     return {
         'balance': user.get('balance', 0.0),
@@ -226,6 +721,19 @@ def get_user_stats(user_id: int) -> Dict:
     }
 
 
+def get_user_daily_stats(user_id: int, days: int = 7) -> Dict:
+    """Views, earnings and countries per day over the last ``days`` days, from rollups"""
+    return rollups.series(rollups_collection, 'user', user_id, rollups.DAY, days)
+
+
+def get_file_daily_stats(short_link_id: str, days: int = 7) -> Dict:
+    return rollups.series(rollups_collection, 'file', short_link_id, rollups.DAY, days)
+
+
+def get_country_daily_stats(country: str, days: int = 7) -> Dict:
+    return rollups.series(rollups_collection, 'country', country, rollups.DAY, days)
+
+
 def get_all_users_stats() -> List[Dict]:
     if users_collection is None:
         return []
@@ -234,6 +742,62 @@ def get_all_users_stats() -> List[Dict]:
     return users
 
 
+# Admin panel totals; a refresh within ADMIN_SUMMARY_TTL is served from
+# memory. Withdrawal changes clear it so the admin sees their own action.
+_admin_summary_cache = TTLCache(
+    maxsize=16,
+    ttl=float(os.getenv('ADMIN_SUMMARY_TTL', '30')),
+    is_negative=lambda value: False
+)
+
+
+def _sum_fields(collection, match: Dict, fields: List[str]) -> Dict:
+    """count and $sum of each field over the matching documents, in one aggregation"""
+    group = {'_id': None, 'count': {'$sum': 1}}
+    for field in fields:
+        group[field] = {'$sum': f'${field}'}
+    rows = list(collection.aggregate([{'$match': match}, {'$group': group}]))
+    totals = rows[0] if rows else {}
+    return {name: totals.get(name, 0) for name in ['count'] + fields}
+
+
+def _load_admin_summary(top_n: int) -> Dict:
+    users = _sum_fields(users_collection, {}, ['balance', 'total_views'])
+    if counter_shards_collection is not None:
+        # Increments on hot users that have not been folded back yet
+        shards = _sum_fields(counter_shards_collection, {'kind': 'user'}, ['balance', 'total_views'])
+        users['balance'] += shards['balance']
+        users['total_views'] += shards['total_views']
+    
+    # Ranked on the main documents; unfolded shards are added afterwards
+    top_users = [
+        _with_counter_shards('user', user['user_id'], user)
+        for user in users_collection.find(
+            {}, {'_id': 0, 'user_id': 1, 'username': 1, 'balance': 1, 'sharded_counters': 1}
+        ).sort('balance', -1).limit(top_n)
+    ]
+    
+    pending = {'count': 0, 'amount': 0}
+    if withdrawals_collection is not None:
+        pending = _sum_fields(withdrawals_collection, {'status': 'pending'}, ['amount'])
+    
+    return {
+        'total_users': users['count'],
+        'total_balance': users['balance'],
+        'total_views': users['total_views'],
+        'pending_withdrawals': pending['count'],
+        'pending_amount': pending['amount'],
+        'top_users': top_users
+    }
+
+
+def get_admin_summary(top_n: int = 5) -> Dict:
+    """Totals, top earners and pending withdrawals for the admin panel"""
+    if users_collection is None:
+        return {}
+    return _admin_summary_cache.get_or_load(top_n, lambda: _load_admin_summary(top_n))
+
+
 def calculate_earnings(country: str) -> float:
     rates = get_cpm_rates()
     cpm = rates.get(country, rates.get('OTHER', 1.0))
@@ -255,13 +819,14 @@ def create_withdrawal_request(user_id: int, amount: float, payment_method: str,
     }
     result = withdrawals_collection.insert_one(withdrawal)
     withdrawal['_id'] = result.inserted_id
+    _admin_summary_cache.clear()
     return withdrawal
 
 
-def get_user_withdrawals(user_id: int) -> List[Dict]:
-    if withdrawals_collection is None:
-        return []
-    return list(withdrawals_collection.find({'user_id': user_id}).sort('created_at', -1))
+def get_user_withdrawals(user_id: int, limit: int = PAGE_SIZE, cursor: Optional[str] = None,
+                         direction: str = 'next') -> Dict:
+    """Page of a user's withdrawal requests, newest first (see _keyset_page)"""
+    return _keyset_page(withdrawals_collection, {'user_id': user_id}, None, limit, cursor, direction)
 
 
 def get_pending_withdrawals() -> List[Dict]:
@@ -305,6 +870,7 @@ def approve_withdrawal(withdrawal_id, admin_note: str = None):
             }
         }
     )
+    _admin_summary_cache.clear()
     return True
 
 
@@ -323,6 +889,7 @@ def reject_withdrawal(withdrawal_id, admin_note: str = None):
             }
         }
     )
+    _admin_summary_cache.clear()
     return True
 
 
@@ -330,9 +897,9 @@ def get_ad_codes() -> Dict[str, str]:
     if settings_collection is None:
         return {'popunder': '', 'banner': '', 'native': '', 'smartlink': '', 'social_bar': ''}
     
-    settings = settings_collection.find_one({'type': 'ad_codes'})
+    settings = _get_setting('ad_codes')
     if settings:
-        return settings.get('codes', {})
+        return dict(settings.get('codes', {}))
     return {'popunder': '', 'banner': '', 'native': '', 'smartlink': '', 'social_bar': ''}
 
 
@@ -353,6 +920,7 @@ def update_ad_code(ad_type: str, code: str):
         },
         upsert=True
     )
+    _bump_settings_version()
     return True
 
 
@@ -373,6 +941,7 @@ def remove_ad_code(ad_type: str):
         },
         upsert=True
     )
+    _bump_settings_version()
     return True
 
 
@@ -382,28 +951,33 @@ def get_referral_stats(user_id: int) -> Dict:
     if users_collection is None:
         return {}
     
-    user = users_collection.find_one({'user_id': user_id})
+    user = _read_user(user_id, {'referral_count': 1, 'referral_earnings': 1, 'sharded_counters': 1})
     if not user:
         return {}
     
-    # Get all referred users
-    referred_users = list(users_collection.find({'referrer_id': user_id}))
-    
     return {
         'referral_count': user.get('referral_count', 0),
-        'referral_earnings': user.get('referral_earnings', 0.0),
-        'referred_users': [
-            {
-                'user_id': u['user_id'],
-                'username': u.get('username', 'Unknown'),
-                'joined_at': u.get('created_at')
-            }
-            for u in referred_users
-        ]
+        'referral_earnings': user.get('referral_earnings', 0.0)
     }
 
 
-def award_referral_commission(referrer_id: int, amount: float, commission_rate: float = 0.10):
+def get_referrals(user_id: int, limit: int = PAGE_SIZE, cursor: Optional[str] = None,
+                  direction: str = 'next') -> Dict:
+    """Page of users referred by user_id, newest first (see _keyset_page)"""
+    page = _keyset_page(users_collection, {'referrer_id': user_id},
+                        {'user_id': 1, 'username': 1, 'created_at': 1}, limit, cursor, direction)
+    page['items'] = [
+        {
+            'user_id': u['user_id'],
+            'username': u.get('username', 'Unknown'),
+            'joined_at': u.get('created_at')
+        }
+        for u in page['items']
+    ]
+    return page
+
+
+def award_referral_commission(referrer_id: int, amount: float, commission_rate: float = REFERRAL_COMMISSION_RATE):
     """Award commission to referrer (10% of referred user's earnings)"""
     if users_collection is None:
         return False
@@ -421,17 +995,91 @@ def award_referral_commission(referrer_id: int, amount: float, commission_rate:
     return True
 
 
+# Keyset pagination: lists are ordered newest first on (created_at, _id)
+# and a page starts after the boundary item of the previous one, so every
+# page is one index range scan no matter how deep it is. Cursors are short
+# enough for Telegram callback data.
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(doc: Dict) -> str:
+    ms = (doc['created_at'] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{ms:x}.{doc['_id']}"
+
+
+def decode_cursor(cursor: str):
+    """(created_at, _id) from a cursor, or None if it is malformed"""
+    try:
+        ms, oid = cursor.split('.')
+        return _EPOCH + timedelta(milliseconds=int(ms, 16)), ObjectId(oid)
+    except (ValueError, InvalidId):
+        return None
+
+
+def _keyset_page(collection, query: Dict, projection: Optional[Dict] = None, limit: int = PAGE_SIZE,
+                 cursor: Optional[str] = None, direction: str = 'next') -> Dict:
+    """One page of newest-first results.
+
+    ``direction`` 'next' returns the items older than ``cursor``, 'prev'
+    the items newer than it. The result carries the cursors for the
+    neighbouring pages ('next' / 'prev'), None where there is none.
+    """
+    page = {'items': [], 'next': None, 'prev': None}
+    if collection is None:
+        return page
+    
+    boundary = decode_cursor(cursor) if cursor else None
+    backwards = boundary is not None and direction == 'prev'
+    order = 1 if backwards else -1
+    ranged = dict(query)
+    if boundary is not None:
+        created_at, oid = boundary
+        op = '$gt' if backwards else '$lt'
+        ranged['$or'] = [
+            {'created_at': {op: created_at}},
+            {'created_at': created_at, '_id': {op: oid}}
+        ]
+    
+    items = list(collection.find(ranged, projection)
+                 .sort([('created_at', order), ('_id', order)])
+                 .limit(limit + 1))
+    more = len(items) > limit
+    items = items[:limit]
+    if not items and boundary is not None:
+        # Everything past the cursor was deleted meanwhile; start over
+        return _keyset_page(collection, query, projection, limit)
+    if backwards:
+        items.reverse()
+    
+    page['items'] = items
+    if items:
+        # Moving backwards, the page we came from is older; moving forwards, newer
+        has_older = more if not backwards else True
+        has_newer = more if backwards else boundary is not None
+        page['next'] = encode_cursor(items[-1]) if has_older else None
+        page['prev'] = encode_cursor(items[0]) if has_newer else None
+    return page
+
+
 # File Management Functions
-def get_user_files(user_id: int, limit: int = 50, skip: int = 0) -> List[Dict]:
-    """Get all files uploaded by a user"""
-    if files_collection is None:
-        return []
+def get_user_files(user_id: int, limit: int = PAGE_SIZE, cursor: Optional[str] = None,
+                   direction: str = 'next') -> Dict:
+    """Page of files uploaded by a user, newest first (see _keyset_page)"""
+    page = _keyset_page(files_collection, {'uploader_id': user_id}, {'geo_stats': 0},
+                        limit, cursor, direction)
     
-    files = list(files_collection.find({'uploader_id': user_id})
-                 .sort('created_at', -1)
-                 .skip(skip)
-                 .limit(limit))
-    return files
+    # View counts of hot files include their shards not folded back yet
+    sharded = [f['short_link_id'] for f in page['items'] if f.get('sharded_counters')]
+    if sharded and counter_shards_collection is not None:
+        shards: Dict[str, List[Dict]] = {}
+        for shard in counter_shards_collection.find({'kind': 'file', 'key': {'$in': sharded}},
+                                                    {'geo_stats': 0}):
+            shards.setdefault(shard['key'], []).append(shard)
+        page['items'] = [
+            merge_shards(f, shards[f['short_link_id']]) if f['short_link_id'] in shards else f
+            for f in page['items']
+        ]
+    return page
 
 
 def get_file_stats(file_id: str) -> Dict:
@@ -443,6 +1091,7 @@ def get_file_stats(file_id: str) -> Dict:
     file_record = files_collection.find_one({'_id': ObjectId(file_id)})
     if not file_record:
         return {}
+    file_record = _with_counter_shards('file', file_record['short_link_id'], file_record)
     
     return {
         'file_name': file_record.get('file_name'),
@@ -453,6 +1102,15 @@ def get_file_stats(file_id: str) -> Dict:
     }
 
 
+def _deleted_file_incs(file_record: Dict) -> Dict:
+    inc = {'files_uploaded': -1}
+    file_record = _with_counter_shards('file', file_record['short_link_id'], file_record)
+    for country, count in file_record.get('geo_stats', {}).items():
+        if count:
+            inc[f'geo_stats.{country}'] = -count
+    return inc
+
+
 def delete_file(file_id: str, user_id: int) -> bool:
     """Delete a file (only by owner)"""
     if files_collection is None:
@@ -475,11 +1133,13 @@ def delete_file(file_id: str, user_id: int) -> bool:
         'uploader_id': user_id
     })
     
+    _invalidate_file(file_record['short_link_id'])
+    
     if result.deleted_count > 0:
-        # Update user's file count
+        # Update user's file count and take the file out of their geo breakdown
         users_collection.update_one(
             {'user_id': user_id},
-            {'$inc': {'files_uploaded': -1}}
+            {'$inc': _deleted_file_incs(file_record)}
         )
         return True
     
@@ -506,11 +1166,13 @@ def delete_file_by_short_link(short_link_id: str, user_id: int) -> bool:
         'uploader_id': user_id
     })
     
+    _invalidate_file(file_record['short_link_id'])
+    
     if result.deleted_count > 0:
-        # Update user's file count
+        # Update user's file count and take the file out of their geo breakdown
         users_collection.update_one(
             {'user_id': user_id},
-            {'$inc': {'files_uploaded': -1}}
+            {'$inc': _deleted_file_incs(file_record)}
         )
         return True
     
@@ -527,3 +1189,6 @@ def get_file_count(user_id: int) -> int:
 
 if client is not None:
     init_default_settings()
+    if AUTO_CREATE_INDEXES:
+        from indexes import ensure_indexes
+        ensure_indexes(db)
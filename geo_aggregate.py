@@ -0,0 +1,181 @@
+"""Per-user geo breakdown maintenance.
+
+Every credited view is counted per country on the file
+(``files.geo_stats``) and, in the same write batch, on the uploader
+(``users.geo_stats``), so ``get_user_stats`` reads one document no
+matter how many files the user has. Deleting a file subtracts its counts
+again. Accounts created before the aggregate existed have no
+``geo_ready`` flag and fall back to summing their files until
+``python geo_aggregate.py backfill`` builds it from ``files.geo_stats``.
+``python geo_aggregate.py check [--fix]`` compares each aggregate with
+its files and reports (or rebuilds) the ones that drifted.
+
+The rebuild is a compare-and-set on the user's ``geo_stats``: if a view
+is credited between reading the files and writing the user, the write
+misses and that user is recomputed.
+"""
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+BATCH_SIZE = 500
+REBUILD_ATTEMPTS = 3
+
+Geo = Dict[str, int]
+
+
+def _add_geo(target: Geo, geo: Optional[Dict]):
+    for country, count in (geo or {}).items():
+        if isinstance(count, (int, float)):
+            target[country] = target.get(country, 0) + count
+
+
+def _nonzero(geo: Geo) -> Geo:
+    return {country: count for country, count in geo.items() if count}
+
+
+def _batches(cursor, size: int) -> Iterator[List[Dict]]:
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def file_geo_totals(db, user_ids: Iterable[int]) -> Dict[int, Geo]:
+    """Per-country views summed over each user's files, counter shards included"""
+    user_ids = list(user_ids)
+    totals: Dict[int, Geo] = {user_id: {} for user_id in user_ids}
+    pipeline = [
+        {'$match': {'uploader_id': {'$in': user_ids}}},
+        {'$project': {'uploader_id': 1, 'geo': {'$objectToArray': {'$ifNull': ['$geo_stats', {}]}}}},
+        {'$unwind': '$geo'},
+        {'$group': {'_id': {'user': '$uploader_id', 'country': '$geo.k'}, 'count': {'$sum': '$geo.v'}}},
+    ]
+    for row in db.files.aggregate(pipeline):
+        _add_geo(totals[row['_id']['user']], {row['_id']['country']: row['count']})
+
+    # Views on hot files that have not been folded back yet
+    sharded = {
+        f['short_link_id']: f['uploader_id']
+        for f in db.files.find({'uploader_id': {'$in': user_ids}, 'sharded_counters': True},
+                               {'short_link_id': 1, 'uploader_id': 1})
+    }
+    if sharded:
+        for shard in db.counter_shards.find({'kind': 'file', 'key': {'$in': list(sharded)}}):
+            _add_geo(totals[sharded[shard['key']]], shard.get('geo_stats'))
+    return totals
+
+
+def _user_shard_geo(db, user_ids: Iterable[int]) -> Dict[int, Geo]:
+    shard_geo: Dict[int, Geo] = {}
+    for shard in db.counter_shards.find({'kind': 'user', 'key': {'$in': list(user_ids)}}):
+        _add_geo(shard_geo.setdefault(shard['key'], {}), shard.get('geo_stats'))
+    return shard_geo
+
+
+def _store(db, user: Dict, totals: Geo, shard_geo: Geo) -> bool:
+    """Compare-and-set the user's geo_stats so that it plus its shards equals totals"""
+    target = dict(totals)
+    for country, count in shard_geo.items():
+        target[country] = target.get(country, 0) - count
+    query = {'user_id': user['user_id']}
+    if 'geo_stats' in user:
+        query['geo_stats'] = user['geo_stats']
+    else:
+        query['geo_stats'] = {'$exists': False}
+    result = db.users.update_one(query, {'$set': {'geo_stats': _nonzero(target), 'geo_ready': True}})
+    return result.matched_count == 1
+
+
+def rebuild_user(db, user_id: int, attempts: int = REBUILD_ATTEMPTS) -> bool:
+    """Recompute one user's aggregate from their files"""
+    for _ in range(attempts):
+        user = db.users.find_one({'user_id': user_id}, {'user_id': 1, 'geo_stats': 1})
+        if not user:
+            return False
+        totals = file_geo_totals(db, [user_id])[user_id]
+        if _store(db, user, totals, _user_shard_geo(db, [user_id]).get(user_id, {})):
+            return True
+    print(f"❌ Could not rebuild geo_stats for user {user_id}: views kept arriving")
+    return False
+
+
+def _rebuild_batch(db, users: List[Dict]) -> Tuple[int, int]:
+    user_ids = [u['user_id'] for u in users]
+    totals = file_geo_totals(db, user_ids)
+    shard_geo = _user_shard_geo(db, user_ids)
+    rebuilt = failed = 0
+    for user in users:
+        user_id = user['user_id']
+        if _store(db, user, totals[user_id], shard_geo.get(user_id, {})) or rebuild_user(db, user_id):
+            rebuilt += 1
+        else:
+            failed += 1
+    return rebuilt, failed
+
+
+def backfill(db, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """Build the aggregate for every user that does not have one yet"""
+    counts = {'rebuilt': 0, 'failed': 0}
+    cursor = db.users.find({'geo_ready': {'$ne': True}}, {'user_id': 1, 'geo_stats': 1})
+    for users in _batches(cursor, batch_size):
+        rebuilt, failed = _rebuild_batch(db, users)
+        counts['rebuilt'] += rebuilt
+        counts['failed'] += failed
+    return counts
+
+
+def check(db, fix: bool = False, batch_size: int = BATCH_SIZE) -> List[Tuple[int, Geo, Geo]]:
+    """(user_id, aggregate, files total) for every user whose aggregate drifted"""
+    drifted = []
+    cursor = db.users.find({'geo_ready': True}, {'user_id': 1, 'geo_stats': 1})
+    for users in _batches(cursor, batch_size):
+        user_ids = [u['user_id'] for u in users]
+        totals = file_geo_totals(db, user_ids)
+        shard_geo = _user_shard_geo(db, user_ids)
+        for user in users:
+            user_id = user['user_id']
+            aggregate = dict(user.get('geo_stats') or {})
+            _add_geo(aggregate, shard_geo.get(user_id))
+            aggregate, expected = _nonzero(aggregate), _nonzero(totals[user_id])
+            if aggregate != expected:
+                drifted.append((user_id, aggregate, expected))
+                if fix:
+                    rebuild_user(db, user_id)
+    return drifted
+
+
+def _diff(aggregate: Geo, expected: Geo) -> str:
+    countries = sorted(set(aggregate) | set(expected))
+    return ', '.join(
+        f"{c}: {aggregate.get(c, 0)} != {expected.get(c, 0)}"
+        for c in countries if aggregate.get(c, 0) != expected.get(c, 0)
+    )
+
+
+if __name__ == '__main__':
+    import database
+
+    if database.db is None:
+        print("❌ MONGO_URI is not set")
+        sys.exit(1)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'backfill':
+        counts = backfill(database.db)
+        print(f"✅ Built geo_stats for {counts['rebuilt']} users ({counts['failed']} failed)")
+    elif command == 'check':
+        fix = '--fix' in sys.argv[2:]
+        drifted = check(database.db, fix=fix)
+        for user_id, aggregate, expected in drifted:
+            print(f"  user {user_id}: {_diff(aggregate, expected)}")
+        action = 'rebuilt' if fix else 'found'
+        print(f"{'⚠️' if drifted else '✅'} {len(drifted)} drifted aggregates {action}")
+        if drifted and not fix:
+            sys.exit(1)
+    else:
+        print("Usage: python geo_aggregate.py backfill | check [--fix]")
+        sys.exit(1)
@@ -0,0 +1,369 @@
+import os
+import csv
+import time
+import bisect
+import ipaddress
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, List, Tuple, Callable
+
+import requests
+from dotenv import load_dotenv
+
+from cache import TTLCache
+
+load_dotenv()
+
+GEOIP_DB_PATH = os.getenv('GEOIP_DB_PATH', '')
+GEOIP_RELOAD_INTERVAL = float(os.getenv('GEOIP_RELOAD_INTERVAL', '60'))
+GEOIP_REMOTE_FALLBACK = os.getenv('GEOIP_REMOTE_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
+GEOIP_REMOTE_TIMEOUT = float(os.getenv('GEOIP_REMOTE_TIMEOUT', '3'))
+GEOIP_CACHE_SIZE = int(os.getenv('GEOIP_CACHE_SIZE', '100000'))
+GEOIP_CACHE_TTL = float(os.getenv('GEOIP_CACHE_TTL', '86400'))
+GEOIP_NEGATIVE_TTL = float(os.getenv('GEOIP_NEGATIVE_TTL', '60'))
+GEOIP_CACHE_POLICY = os.getenv('GEOIP_CACHE_POLICY', 'lru')
+GEOIP_PREFETCH_WORKERS = int(os.getenv('GEOIP_PREFETCH_WORKERS', '4'))
+GEOIP_PREFETCH_MAX_PENDING = int(os.getenv('GEOIP_PREFETCH_MAX_PENDING', '1000'))
+
+DEFAULT_COUNTRY = 'OTHER'
+
+
+def _normalize_country(code) -> Optional[str]:
+    if not code or not isinstance(code, str):
+        return None
+    code = code.strip().upper()
+    if len(code) != 2 or not code.isalpha():
+        return None
+    return code
+
+
+class RangeIndex:
+    """Sorted, non-overlapping IP ranges answered with a binary search"""
+
+    def __init__(self, ranges: List[Tuple[int, int, str]], wide: bool = False):
+        ranges.sort(key=lambda r: (r[0], r[1]))
+
+        # IPv4 bounds fit in a machine word; IPv6 bounds need Python ints
+        self.starts = [] if wide else array('L')
+        self.ends = [] if wide else array('L')
+        self.codes = array('H')
+        self.countries: List[str] = []
+        country_ids: Dict[str, int] = {}
+
+        last_end = -1
+        for start, end, country in ranges:
+            if end < start or end <= last_end:
+                continue
+            start = max(start, last_end + 1)
+            if country not in country_ids:
+                country_ids[country] = len(self.countries)
+                self.countries.append(country)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.codes.append(country_ids[country])
+            last_end = end
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, value: int) -> Optional[str]:
+        idx = bisect.bisect_right(self.starts, value) - 1
+        if idx >= 0 and value <= self.ends[idx]:
+            return self.countries[self.codes[idx]]
+        return None
+
+
+class CsvGeoDatabase:
+    """IP-range database loaded from a CSV file.
+
+    Each row is either ``start_ip,end_ip,country`` (DB-IP / IP2Location
+    style) or ``network/prefix,country``. Blank lines, comments and
+    header rows are skipped.
+    """
+
+    def __init__(self, path: str):
+        v4: List[Tuple[int, int, str]] = []
+        v6: List[Tuple[int, int, str]] = []
+
+        with open(path, newline='', encoding='utf-8') as fh:
+            for row in csv.reader(fh):
+                parsed = self._parse_row(row)
+                if not parsed:
+                    continue
+                version, start, end, country = parsed
+                (v4 if version == 4 else v6).append((start, end, country))
+
+        self.v4 = RangeIndex(v4)
+        self.v6 = RangeIndex(v6, wide=True)
+
+    @staticmethod
+    def _parse_row(row: List[str]):
+        if not row or row[0].startswith('#'):
+            return None
+        try:
+            if len(row) >= 3 and '/' not in row[0]:
+                start = ipaddress.ip_address(row[0].strip())
+                end = ipaddress.ip_address(row[1].strip())
+                country = _normalize_country(row[2])
+                if start.version != end.version:
+                    return None
+                version, start, end = start.version, int(start), int(end)
+            elif len(row) >= 2:
+                network = ipaddress.ip_network(row[0].strip(), strict=False)
+                country = _normalize_country(row[1])
+                version = network.version
+                start, end = int(network.network_address), int(network.broadcast_address)
+            else:
+                return None
+        except ValueError:
+            return None
+        if not country:
+            return None
+        return version, start, end, country
+
+    def __len__(self):
+        return len(self.v4) + len(self.v6)
+
+    def lookup(self, ip: ipaddress._BaseAddress) -> Optional[str]:
+        index = self.v4 if ip.version == 4 else self.v6
+        return index.lookup(int(ip))
+
+    def close(self):
+        pass
+
+
+class MmdbGeoDatabase:
+    """MaxMind DB (GeoLite2/GeoIP2/DB-IP .mmdb) file, requires ``maxminddb``"""
+
+    def __init__(self, path: str):
+        import maxminddb
+        self.reader = maxminddb.open_database(path)
+
+    def __len__(self):
+        return self.reader.metadata().node_count
+
+    def lookup(self, ip: ipaddress._BaseAddress) -> Optional[str]:
+        record = self.reader.get(str(ip))
+        if not record:
+            return None
+        country = record.get('country') or record.get('registered_country') or {}
+        return _normalize_country(country.get('iso_code') or record.get('country_code'))
+
+    def close(self):
+        self.reader.close()
+
+
+def open_geo_database(path: str):
+    """Pick a database loader from the file extension"""
+    if path.lower().endswith('.mmdb'):
+        return MmdbGeoDatabase(path)
+    return CsvGeoDatabase(path)
+
+
+class LocalGeoProvider:
+    """Looks IPs up in a local database file and reloads it when it changes"""
+
+    def __init__(self, path: str, reload_interval: float = GEOIP_RELOAD_INTERVAL,
+                 on_reload: Optional[Callable[[], None]] = None):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.on_reload = on_reload
+        self.database = None
+        self.mtime = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            print(f"GeoIP database unavailable ({self.path}): {e}")
+            return False
+        if mtime == self.mtime:
+            return False
+
+        started = time.perf_counter()
+        try:
+            database = open_geo_database(self.path)
+        except Exception as e:
+            print(f"Failed to load GeoIP database {self.path}: {e}")
+            return False
+
+        # Swap the reference so in-flight lookups keep using the old index.
+        # The old database is not closed here: a lookup may still be inside
+        # its reader, and it is released once the last reference goes away.
+        previous, self.database, self.mtime = self.database, database, mtime
+        if previous is not None and self.on_reload:
+            self.on_reload()
+        print(f"🌍 Loaded GeoIP database {self.path} ({len(database)} entries) "
+              f"in {time.perf_counter() - started:.2f}s")
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        # Only one thread rebuilds; the others keep answering from the old index
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.checked_at = now
+            self.reload()
+        finally:
+            self.lock.release()
+
+    def __call__(self, ip: ipaddress._BaseAddress) -> Optional[str]:
+        self._maybe_reload()
+        database = self.database
+        if database is None:
+            return None
+        return database.lookup(ip)
+
+
+class RemoteGeoProvider:
+    """ipapi.co lookup, kept as a fallback for addresses the local file misses"""
+
+    def __init__(self, timeout: float = GEOIP_REMOTE_TIMEOUT):
+        self.timeout = timeout
+
+    def __call__(self, ip: ipaddress._BaseAddress) -> Optional[str]:
+        try:
+            response = requests.get(f'https://ipapi.co/{ip}/json/', timeout=self.timeout)
+            if response.status_code == 200:
+                return _normalize_country(response.json().get('country_code'))
+        except Exception:
+            pass
+        return None
+
+
+GeoProvider = Callable[[ipaddress._BaseAddress], Optional[str]]
+
+
+def build_default_providers() -> List[GeoProvider]:
+    providers: List[GeoProvider] = []
+    if GEOIP_DB_PATH:
+        # Answers cached from the old file must not outlive a reload
+        providers.append(LocalGeoProvider(GEOIP_DB_PATH, on_reload=lambda: country_cache.clear()))
+    if GEOIP_REMOTE_FALLBACK or not providers:
+        providers.append(RemoteGeoProvider())
+    return providers
+
+
+_providers: Optional[List[GeoProvider]] = None
+_providers_lock = threading.Lock()
+
+
+def get_providers() -> List[GeoProvider]:
+    global _providers
+    if _providers is None:
+        with _providers_lock:
+            if _providers is None:
+                _providers = build_default_providers()
+    return _providers
+
+
+def set_providers(providers: List[GeoProvider]):
+    """Replace the lookup chain, e.g. to plug in another geolocation engine"""
+    global _providers
+    _providers = list(providers)
+
+
+def parse_public_ip(ip: str) -> Optional[ipaddress._BaseAddress]:
+    try:
+        address = ipaddress.ip_address(ip.strip())
+    except (ValueError, AttributeError):
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    if not address.is_global:
+        return None
+    return address
+
+
+country_cache = TTLCache(
+    maxsize=GEOIP_CACHE_SIZE,
+    ttl=GEOIP_CACHE_TTL,
+    negative_ttl=GEOIP_NEGATIVE_TTL,
+    policy=GEOIP_CACHE_POLICY
+)
+
+
+def _lookup_uncached(address: ipaddress._BaseAddress) -> Optional[str]:
+    for provider in get_providers():
+        country = provider(address)
+        if country:
+            return country
+    return None
+
+
+def lookup_country(ip: str) -> Optional[str]:
+    """Return the ISO country code for an IP, or None if no provider knows it"""
+    address = parse_public_ip(ip)
+    if address is None:
+        return None
+    return country_cache.get_or_load(str(address), lambda: _lookup_uncached(address))
+
+
+def resolve_country(ip: str) -> str:
+    return lookup_country(ip) or DEFAULT_COUNTRY
+
+
+_NOT_CACHED = object()
+_prefetch_executor: Optional[ThreadPoolExecutor] = None
+_prefetch_pending: Dict[str, Future] = {}
+_prefetch_lock = threading.Lock()
+
+
+def _get_prefetch_executor() -> ThreadPoolExecutor:
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        _prefetch_executor = ThreadPoolExecutor(
+            max_workers=GEOIP_PREFETCH_WORKERS,
+            thread_name_prefix='geoip-prefetch'
+        )
+    return _prefetch_executor
+
+
+def prefetch_country(ip: str):
+    """Start resolving an IP in the background so a later lookup is a cache hit"""
+    address = parse_public_ip(ip)
+    if address is None:
+        return
+    key = str(address)
+    if country_cache.get(key, _NOT_CACHED) is not _NOT_CACHED:
+        return
+    with _prefetch_lock:
+        # When the pool is saturated the final step simply resolves inline
+        if key in _prefetch_pending or len(_prefetch_pending) >= GEOIP_PREFETCH_MAX_PENDING:
+            return
+        future = _get_prefetch_executor().submit(lookup_country, key)
+        _prefetch_pending[key] = future
+    future.add_done_callback(lambda _: _prefetch_pending.pop(key, None))
+
+
+def peek_country(ip: str) -> Optional[str]:
+    """Non-blocking lookup: the country if already resolved, otherwise None.
+
+    Only a positive answer is returned. A cached failure may be a
+    transient remote error, so it reads as None and a later lookup
+    retries once the negative entry expires.
+    """
+    address = parse_public_ip(ip)
+    if address is None:
+        return None
+    key = str(address)
+    future = _prefetch_pending.get(key)
+    if future is not None and not future.done():
+        return None
+    country = country_cache.get(key, _NOT_CACHED)
+    if country is _NOT_CACHED:
+        return None
+    return country or None
+
+
+def get_cache_stats() -> Dict:
+    stats = country_cache.stats()
+    stats['prefetch_pending'] = len(_prefetch_pending)
+    return stats
@@ -0,0 +1,49 @@
+"""Gunicorn settings for the web tier.
+
+    gunicorn -c gunicorn.conf.py web:app
+
+or ``python main.py web``. Workers are pre-forked from a master process
+that imports the app once (WEB_PRELOAD) so they share its memory; every
+worker then opens its own MongoDB connection.
+"""
+import os
+import multiprocessing
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv('WEB_THREADS', '4'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = os.getenv('WEB_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+timeout = int(os.getenv('WEB_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('WEB_KEEPALIVE', '5'))
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('WEB_MAX_REQUESTS_JITTER', '0'))
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+# Read by rate_limit.py when the app is imported to pick a shared backend
+os.environ['WEB_WORKERS'] = str(workers)
+
+
+def on_starting(server):
+    if preload_app:
+        # Build the GeoIP index before forking; its arrays are shared copy-on-write
+        import geoip
+        geoip.get_providers()
+
+
+def post_fork(server, worker):
+    # The client created while preloading must not be used across fork()
+    import database
+    database.connect()
+
+
+def worker_exit(server, worker):
+    # Write out views still queued in this worker
+    import view_pipeline
+    view_pipeline.pipeline.stop()
@@ -0,0 +1,178 @@
+"""MongoDB index management.
+
+Declares the indexes every query in database.py relies on and creates
+them idempotently. Run ``python indexes.py ensure`` to create them by
+hand or ``python indexes.py report`` to list missing and unused ones.
+Indexes in ``MANUAL_INDEXES`` are only reported; each is created by its
+own command once it is safe to.
+"""
+import sys
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from archiver import VIEW_RETENTION_DAYS
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    'users': [
+        # get_or_create_user, record_view_batch, get_user_balance, get_user_stats, ...
+        IndexModel([('user_id', ASCENDING)], name='user_id_unique', unique=True),
+        # get_referrals pages (keyset on created_at, _id)
+        IndexModel([('referrer_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+                   name='referrer_created_at_id'),
+        # get_admin_summary top earners (sort + limit)
+        IndexModel([('balance', DESCENDING)], name='balance_desc'),
+    ],
+    'files': [
+        # get_file_by_short_link_id, record_view_batch, delete_file_by_short_link
+        IndexModel([('short_link_id', ASCENDING)], name='short_link_id_unique', unique=True),
+        # get_user_files pages, get_file_count, get_user_stats (accounts without geo_ready)
+        IndexModel([('uploader_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+                   name='uploader_created_at_id'),
+    ],
+    'view_dedupe': [
+        # claim_view keys live for two dedupe windows
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'settings': [
+        # get_cpm_rates, get_ad_codes
+        IndexModel([('type', ASCENDING)], name='type_unique', unique=True),
+    ],
+    'counter_shards': [
+        # Readers summing the shards of a sharded file or user
+        IndexModel([('kind', ASCENDING), ('key', ASCENDING)], name='kind_key'),
+    ],
+    'rollups': [
+        # get_user_daily_stats and friends: one key's buckets over a time range
+        IndexModel([('dim', ASCENDING), ('key', ASCENDING), ('grain', ASCENDING), ('bucket', ASCENDING)],
+                   name='dim_key_grain_bucket'),
+        # Hourly buckets expire after ROLLUP_HOURLY_RETENTION_DAYS
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'rate_limits': [
+        # Window counters used by the mongo rate limiter backend
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'withdrawals': [
+        # get_pending_withdrawals, get_admin_summary pending totals
+        IndexModel([('status', ASCENDING), ('created_at', ASCENDING)], name='status_created_at'),
+        # get_user_withdrawals pages
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)],
+                   name='user_created_at_id'),
+    ],
+}
+
+# Not created by ensure_indexes (and so not at startup)
+MANUAL_INDEXES: Dict[str, List[IndexModel]] = {
+    'views': [
+        # Raw views expire after VIEW_RETENTION_DAYS; archiver.py ranges on timestamp.
+        # Created by ``python archiver.py expire``, which refuses while days past
+        # retention are not archived. Changing the retention needs collMod.
+        IndexModel([('timestamp', ASCENDING)], name='timestamp_ttl',
+                   expireAfterSeconds=VIEW_RETENTION_DAYS * 86400),
+    ],
+}
+
+
+def _declared() -> Dict[str, List[IndexModel]]:
+    declared = {name: list(models) for name, models in INDEXES.items()}
+    for name, models in MANUAL_INDEXES.items():
+        declared.setdefault(name, []).extend(models)
+    return declared
+
+
+def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Create every declared index; existing ones are left untouched"""
+    created = {}
+    if db is None:
+        return created
+
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        names = []
+        for model in models:
+            try:
+                names.extend(collection.create_indexes([model]))
+            except OperationFailure as e:
+                # Duplicate keys block unique indexes; a changed spec under
+                # an existing name needs a manual drop first
+                print(f"❌ Could not create index {collection_name}.{model.document['name']}: {e}")
+        created[collection_name] = names
+    return created
+
+
+def missing_indexes(db) -> Dict[str, List[str]]:
+    """Declared indexes that do not exist on the server"""
+    missing = {}
+    for collection_name, models in _declared().items():
+        existing = db[collection_name].index_information()
+        names = [m.document['name'] for m in models if m.document['name'] not in existing]
+        if names:
+            missing[collection_name] = names
+    return missing
+
+
+def index_usage(db) -> Dict[str, Dict[str, int]]:
+    """Access counts per index since the server last restarted"""
+    usage = {}
+    for collection_name in _declared():
+        stats = db[collection_name].aggregate([{'$indexStats': {}}])
+        usage[collection_name] = {s['name']: s['accesses']['ops'] for s in stats}
+    return usage
+
+
+def unused_indexes(db) -> Dict[str, List[str]]:
+    """Indexes (other than _id) that have not served a single query"""
+    unused = {}
+    for collection_name, counts in index_usage(db).items():
+        names = [name for name, ops in counts.items() if ops == 0 and name != '_id_']
+        if names:
+            unused[collection_name] = names
+    return unused
+
+
+def undeclared_indexes(db) -> Dict[str, List[str]]:
+    """Indexes on the server that are not declared here"""
+    extra = {}
+    for collection_name, models in _declared().items():
+        declared = {m.document['name'] for m in models} | {'_id_'}
+        names = [name for name in db[collection_name].index_information() if name not in declared]
+        if names:
+            extra[collection_name] = names
+    return extra
+
+
+def print_report(db):
+    manual = {(c, m.document['name']) for c, models in MANUAL_INDEXES.items() for m in models}
+    sections = [
+        ('Missing indexes', missing_indexes(db)),
+        ('Unused indexes (no ops since server start)', unused_indexes(db)),
+        ('Undeclared indexes', undeclared_indexes(db)),
+    ]
+    for title, result in sections:
+        print(f"{title}:")
+        if not result:
+            print("  none")
+        for collection_name, names in result.items():
+            for name in names:
+                note = " (created by hand, see MANUAL_INDEXES)" if (collection_name, name) in manual else ""
+                print(f"  {collection_name}.{name}{note}")
+
+
+if __name__ == '__main__':
+    import database
+
+    if database.db is None:
+        print("❌ MONGO_URI is not set")
+        sys.exit(1)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'report'
+    if command == 'ensure':
+        for collection_name, names in ensure_indexes(database.db).items():
+            print(f"✅ {collection_name}: {', '.join(names) or 'nothing to do'}")
+    elif command == 'report':
+        print_report(database.db)
+    else:
+        print("Usage: python indexes.py [ensure|report]")
+        sys.exit(1)
@@ -1,16 +1,33 @@
 import os
+import sys
 import threading
+import subprocess
 from dotenv import load_dotenv
 from pyngrok import ngrok
 
 # Load environment variables from a .env file if it exists
 load_dotenv()
 
+PORT = int(os.getenv('PORT', '5000'))
+# Same variable gunicorn.conf.py reads for graceful_timeout
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+
+# all   - development: Flask dev server in a thread next to the bot
+# web   - production web tier only (gunicorn, pre-fork workers)
+# bot   - Telegram bot only
+# split - gunicorn in a child process group plus the bot in this one
+RUN_MODES = ('all', 'web', 'bot', 'split')
+RUN_MODE = (sys.argv[1] if len(sys.argv) > 1 else os.getenv('RUN_MODE', 'all')).lower()
+
 def run_web():
     """Starts the Flask web server."""
     from web import app
-    # The web server will run on port 5000, which Ngrok will expose.
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+    # The web server will run on PORT (5000 by default), which Ngrok will expose.
+    app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
+
+def gunicorn_command():
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+    return [sys.executable, '-m', 'gunicorn', '-c', config, 'web:app']
 
 def run_bot():
     """Starts the Telegram bot."""
@@ -18,8 +35,12 @@ def run_bot():
     run_bot()
 
 if __name__ == '__main__':
+    if RUN_MODE not in RUN_MODES:
+        print(f"Usage: python main.py [{'|'.join(RUN_MODES)}]")
+        sys.exit(1)
+
     print("=" * 50)
-    print("🚀 Starting File Monetization System")
+    print(f"🚀 Starting File Monetization System ({RUN_MODE})")
     print("=" * 50)
 
     # --- Ngrok Integration Start ---
@@ -27,13 +48,17 @@ if __name__ == '__main__':
     # Get the Ngrok authtoken from environment variables
     ngrok_authtoken = os.getenv("NGROK_AUTHTOKEN")
 
-    if ngrok_authtoken:
+    # In bot mode the web tier runs elsewhere and BASE_URL must point at it
+    if RUN_MODE == 'bot':
+        print("✅ Bot-only mode. Skipping Ngrok setup.")
+
+    elif ngrok_authtoken:
         print("✅ Ngrok authtoken found. Initializing Ngrok tunnel...")
         ngrok.set_auth_token(ngrok_authtoken)
         
         try:
-            # Open an HTTP tunnel to the local Flask app on port 5000
-            public_url = ngrok.connect(5000).public_url
+            # Open an HTTP tunnel to the local Flask app
+            public_url = ngrok.connect(PORT).public_url
             
             # Dynamically update the BASE_URL environment variable for this session
             # This ensures both the bot and web server use the public Ngrok URL
@@ -54,11 +79,33 @@ if __name__ == '__main__':
 
     # --- Ngrok Integration End ---
 
-    # Start the Flask web server in a separate thread
-    web_thread = threading.Thread(target=run_web, daemon=True)
-    web_thread.start()
-    print("✅ Flask Web Server started on port 5000.")
+    if RUN_MODE == 'web':
+        # Replace this process with the gunicorn master
+        command = gunicorn_command()
+        os.execv(command[0], command)
+
+    web_process = None
+    if RUN_MODE == 'split':
+        # Own process group: the bot no longer competes with page serving for the GIL
+        web_process = subprocess.Popen(gunicorn_command(), env=os.environ.copy())
+        print(f"✅ Gunicorn web tier started on port {PORT} (pid {web_process.pid}).")
+    elif RUN_MODE == 'all':
+        # Start the Flask web server in a separate thread
+        web_thread = threading.Thread(target=run_web, daemon=True)
+        web_thread.start()
+        print(f"✅ Flask Web Server started on port {PORT}.")
     
     # Start the Telegram bot in the main thread
     print("✅ Starting Telegram Bot...")
-    run_bot()
+    try:
+        run_bot()
+    finally:
+        if web_process is not None:
+            web_process.terminate()
+            try:
+                # Give gunicorn its graceful_timeout plus a margin to exit
+                web_process.wait(timeout=WEB_GRACEFUL_TIMEOUT + 5)
+            except subprocess.TimeoutExpired:
+                print("⚠️  Gunicorn did not stop in time, killing it")
+                web_process.kill()
+                web_process.wait()
@@ -0,0 +1,205 @@
+"""Per-route rate limiting with pluggable storage.
+
+Every backend implements a sliding-window counter: one counter for the
+current fixed window plus the previous window's total, weighted by how
+much of it still overlaps the sliding window. That is two integers per
+key instead of a list of timestamps.
+
+Backends:
+    memory  in-process dict, idle keys swept periodically (single worker)
+    mongo   ``rate_limits`` collection with a TTL index (shared by workers,
+            the default when WEB_WORKERS > 1)
+    redis   any Redis-protocol server or stand-in exposing pipeline(),
+            incr(), expire() and get(); configured with REDIS_URL and
+            needs ``pip install redis`` (optional, not in requirements.txt)
+
+Every attempt counts towards the limit, including refused ones, and
+backend errors fail open.
+"""
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from pymongo import ReturnDocument
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Several web workers need a shared store, otherwise each enforces its own limit
+RATE_LIMIT_BACKEND = (
+    os.getenv('RATE_LIMIT_BACKEND')
+    or ('mongo' if int(os.getenv('WEB_WORKERS', '1')) > 1 else 'memory')
+).lower()
+RATE_LIMIT_SWEEP_INTERVAL = float(os.getenv('RATE_LIMIT_SWEEP_INTERVAL', '60'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# route -> (max requests, window seconds); override with
+# RATE_LIMITS="download=10/300,page=120/300"
+DEFAULT_LIMITS: Dict[str, Tuple[int, int]] = {
+    'download': (10, 300),
+    'page': (120, 300),
+}
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            route, value = item.split('=', 1)
+            max_requests, window = value.split('/', 1)
+            limits[route.strip()] = (int(max_requests), int(window))
+        except ValueError:
+            print(f"Ignoring malformed rate limit '{item}'")
+    return limits
+
+
+def sliding_count(previous: int, current: int, now: float, window: int) -> float:
+    elapsed = (now % window) / window
+    return previous * (1 - elapsed) + current
+
+
+class MemoryBackend:
+    def __init__(self, sweep_interval: float = RATE_LIMIT_SWEEP_INTERVAL):
+        # key -> (window index, previous count, current count, expires at)
+        self.entries: Dict[str, Tuple[int, int, int, float]] = {}
+        self.lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self.swept_at = time.monotonic()
+        self.swept = 0
+
+    def hit(self, key: str, window: int) -> float:
+        now = time.time()
+        index = int(now // window)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < index - 1:
+                previous, current = 0, 0
+            elif entry[0] == index - 1:
+                previous, current = entry[2], 0
+            else:
+                previous, current = entry[1], entry[2]
+            current += 1
+            self.entries[key] = (index, previous, current, (index + 2) * window)
+        self._maybe_sweep(now)
+        return sliding_count(previous, current, now, window)
+
+    def _maybe_sweep(self, now: float):
+        if time.monotonic() - self.swept_at < self.sweep_interval:
+            return
+        with self.lock:
+            self.swept_at = time.monotonic()
+            expired = [key for key, entry in self.entries.items() if entry[3] <= now]
+            for key in expired:
+                del self.entries[key]
+            self.swept += len(expired)
+
+    def stats(self) -> Dict:
+        return {'keys': len(self.entries), 'swept': self.swept}
+
+
+class MongoBackend:
+    def __init__(self, get_collection: Callable):
+        # Resolved per call: the collection is replaced when a worker reconnects after fork
+        self.get_collection = get_collection
+
+    def hit(self, key: str, window: int) -> float:
+        now = time.time()
+        index = int(now // window)
+        current_id, previous_id = f"{key}:{index}", f"{key}:{index - 1}"
+        collection = self.get_collection()
+        doc = collection.find_one_and_update(
+            {'_id': current_id},
+            {
+                '$inc': {'count': 1},
+                '$setOnInsert': {'expires_at': datetime.utcnow() + timedelta(seconds=window * 2)}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        previous = collection.find_one({'_id': previous_id}, {'count': 1})
+        return sliding_count(previous['count'] if previous else 0, doc['count'], now, window)
+
+    def stats(self) -> Dict:
+        return {}
+
+
+class RedisBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def hit(self, key: str, window: int) -> float:
+        now = time.time()
+        index = int(now // window)
+        current_key, previous_key = f"rl:{key}:{index}", f"rl:{key}:{index - 1}"
+        pipe = self.client.pipeline()
+        pipe.incr(current_key)
+        pipe.expire(current_key, window * 2)
+        pipe.get(previous_key)
+        current, _, previous = pipe.execute()
+        return sliding_count(int(previous or 0), int(current), now, window)
+
+    def stats(self) -> Dict:
+        return {}
+
+
+class RateLimiter:
+    def __init__(self, backend, limits: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.backend = backend
+        self.limits = dict(limits if limits is not None else DEFAULT_LIMITS)
+        self.allowed: Dict[str, int] = {}
+        self.throttled: Dict[str, int] = {}
+        self.errors = 0
+
+    def allow(self, route: str, ident: str) -> bool:
+        limit = self.limits.get(route)
+        if limit is None:
+            return True
+        max_requests, window = limit
+        try:
+            count = self.backend.hit(f"{route}:{ident}", window)
+        except Exception as e:
+            self.errors += 1
+            print(f"Rate limiter backend error: {e}")
+            return True
+        if count > max_requests:
+            self.throttled[route] = self.throttled.get(route, 0) + 1
+            return False
+        self.allowed[route] = self.allowed.get(route, 0) + 1
+        return True
+
+    def stats(self) -> Dict:
+        stats = {
+            'backend': type(self.backend).__name__,
+            'limits': {route: f"{n}/{w}s" for route, (n, w) in self.limits.items()},
+            'allowed': dict(self.allowed),
+            'throttled': dict(self.throttled),
+            'errors': self.errors
+        }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def build_backend(name: str = RATE_LIMIT_BACKEND):
+    if name == 'mongo':
+        import database
+        if database.rate_limits_collection is not None:
+            return MongoBackend(lambda: database.rate_limits_collection)
+        print("⚠️  RATE_LIMIT_BACKEND=mongo but MONGO_URI is not set, using memory")
+    elif name == 'redis':
+        try:
+            import redis
+        except ImportError as e:
+            # Falling back to memory would silently stop sharing limits between workers
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package: pip install redis") from e
+        return RedisBackend(redis.Redis.from_url(REDIS_URL))
+    elif name != 'memory':
+        print(f"⚠️  Unknown RATE_LIMIT_BACKEND '{name}', using memory")
+    return MemoryBackend()
+
+
+def build_rate_limiter() -> RateLimiter:
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(parse_limits(os.getenv('RATE_LIMITS', '')))
+    return RateLimiter(build_backend(), limits)
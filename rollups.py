@@ -0,0 +1,106 @@
+"""Hourly and daily rollups of credited views.
+
+Every batch written by ``database.record_view_batch`` also increments
+time buckets in the ``rollups`` collection: one document per grain
+(hour or day), dimension (file, uploader or country), key and bucket
+start, holding the view count, the uploader earnings and the views per
+country. "Views per day for the last month" is then at most 30 small
+documents instead of a scan over raw views. Hourly buckets expire after
+``ROLLUP_HOURLY_RETENTION_DAYS``; daily buckets are kept.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv('ROLLUP_HOURLY_RETENTION_DAYS', '14'))
+
+HOUR = 'hour'
+DAY = 'day'
+
+# dimension -> field of a view event that keys it
+DIMENSIONS = {'file': 'short_link_id', 'user': 'uploader_id', 'country': 'country'}
+
+
+def bucket_start(ts: datetime, grain: str) -> datetime:
+    if grain == HOUR:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_id(grain: str, dim: str, key: Hashable, start: datetime) -> str:
+    return f"{grain}:{dim}:{key}:{start:%Y%m%d%H}"
+
+
+def rollup_ops(views: List[Dict], now: Optional[datetime] = None) -> List[UpdateOne]:
+    """Upserting $inc ops adding a batch of view events to their buckets.
+
+    Events are summed per bucket first, so a batch costs one op per
+    touched bucket rather than per view.
+    """
+    now = now or datetime.utcnow()
+    buckets: Dict[Tuple[str, str, Hashable, datetime], Dict] = {}
+    for v in views:
+        ts = v.get('timestamp', now)
+        for grain in (HOUR, DAY):
+            start = bucket_start(ts, grain)
+            for dim, field in DIMENSIONS.items():
+                key = v.get(field)
+                if key is None:
+                    continue
+                inc = buckets.setdefault((grain, dim, key, start), {'views': 0, 'earnings': 0.0})
+                inc['views'] += 1
+                inc['earnings'] += v.get('earnings', 0.0)
+                if dim != 'country':
+                    geo_key = f"countries.{v['country']}"
+                    inc[geo_key] = inc.get(geo_key, 0) + 1
+
+    ops = []
+    for (grain, dim, key, start), inc in buckets.items():
+        on_insert = {'grain': grain, 'dim': dim, 'key': key, 'bucket': start}
+        if grain == HOUR:
+            on_insert['expires_at'] = start + timedelta(days=ROLLUP_HOURLY_RETENTION_DAYS)
+        ops.append(UpdateOne(
+            {'_id': bucket_id(grain, dim, key, start)},
+            {'$inc': inc, '$setOnInsert': on_insert},
+            upsert=True
+        ))
+    return ops
+
+
+def series(collection, dim: str, key: Hashable, grain: str = DAY, periods: int = 7,
+           now: Optional[datetime] = None) -> Dict:
+    """The last ``periods`` buckets for one key, oldest first, missing ones as zero.
+
+    Returns {'buckets': [{'start', 'views', 'earnings'}], 'views',
+    'earnings', 'countries'} with the totals over the whole range.
+    """
+    step = timedelta(hours=1) if grain == HOUR else timedelta(days=1)
+    last = bucket_start(now or datetime.utcnow(), grain)
+    first = last - step * (periods - 1)
+    result = {'buckets': [], 'views': 0, 'earnings': 0.0, 'countries': {}}
+    if collection is None:
+        return result
+
+    docs = {
+        doc['bucket']: doc
+        for doc in collection.find(
+            {'grain': grain, 'dim': dim, 'key': key, 'bucket': {'$gte': first, '$lte': last}},
+            {'_id': 0, 'bucket': 1, 'views': 1, 'earnings': 1, 'countries': 1}
+        )
+    }
+    for i in range(periods):
+        start = first + step * i
+        doc = docs.get(start, {})
+        views = doc.get('views', 0)
+        earnings = doc.get('earnings', 0.0)
+        result['buckets'].append({'start': start, 'views': views, 'earnings': earnings})
+        result['views'] += views
+        result['earnings'] += earnings
+        for country, count in doc.get('countries', {}).items():
+            result['countries'][country] = result['countries'].get(country, 0) + count
+    return result
@@ -0,0 +1,227 @@
+"""Outbound message scheduler for the bot.
+
+Every message the bot sends goes through ``outbox``. Sends are queued by
+priority (file deliveries, then replies, then menu edits) and released
+through a global token bucket (``SEND_GLOBAL_RATE`` per second) and one
+bucket per chat (``SEND_CHAT_RATE``), which keeps the bot under
+Telegram's limits instead of running into them. A chat that is out of
+tokens is parked without holding up other chats.
+
+When Telegram still answers with FloodWait, that chat is paused for the
+requested time plus jitter and the send is retried, up to
+``SEND_MAX_RETRIES`` times, as long as the wait is under
+``SEND_MAX_FLOOD_WAIT`` seconds. The caller awaits the final result or
+error.
+"""
+import os
+import time
+import random
+import asyncio
+import itertools
+import functools
+from typing import Callable, Dict, Optional
+
+from pyrogram.errors import FloodWait
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '25'))
+SEND_GLOBAL_BURST = float(os.getenv('SEND_GLOBAL_BURST', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '16'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+SEND_MAX_FLOOD_WAIT = float(os.getenv('SEND_MAX_FLOOD_WAIT', '60'))
+SEND_FLOOD_JITTER = float(os.getenv('SEND_FLOOD_JITTER', '2'))
+
+# Lower is sent first
+DELIVERY = 0
+REPLY = 1
+EDIT = 2
+PRIORITY_NAMES = {DELIVERY: 'delivery', REPLY: 'reply', EDIT: 'edit'}
+
+MAX_TRACKED_CHATS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendJob:
+    __slots__ = ('chat_id', 'call', 'priority', 'future', 'attempts')
+
+    def __init__(self, chat_id: int, call: Callable, priority: int, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+
+class SendScheduler:
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, global_burst: float = SEND_GLOBAL_BURST,
+                 chat_rate: float = SEND_CHAT_RATE, chat_burst: float = SEND_CHAT_BURST,
+                 concurrency: int = SEND_CONCURRENCY, max_retries: int = SEND_MAX_RETRIES,
+                 max_flood_wait: float = SEND_MAX_FLOOD_WAIT, flood_jitter: float = SEND_FLOOD_JITTER):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_flood_wait = max_flood_wait
+        self.flood_jitter = flood_jitter
+        self.chats: Dict[int, TokenBucket] = {}
+        self.paused_until: Dict[int, float] = {}
+        self.sequence = itertools.count()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.task: Optional[asyncio.Task] = None
+        self.parked = 0
+        self.sent: Dict[str, int] = {}
+        self.flood_waits = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.task is not None and self.loop is loop and not self.task.done():
+            return
+        self.loop = loop
+        self.queue = asyncio.PriorityQueue()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.parked = 0
+        self.task = loop.create_task(self._run())
+
+    async def send(self, chat_id: int, call: Callable, *args, priority: int = REPLY, **kwargs):
+        """Queue ``call(*args, **kwargs)`` for chat_id and return its result once sent"""
+        self._ensure_started()
+        job = SendJob(chat_id, functools.partial(call, *args, **kwargs), priority, self.loop.create_future())
+        self._enqueue(job)
+        return await job.future
+
+    async def deliver(self, message, method: str, **kwargs):
+        """Send a file back to the chat of ``message`` ahead of everything else"""
+        return await self.send(message.chat.id, getattr(message, method), priority=DELIVERY, **kwargs)
+
+    async def reply(self, message, *args, **kwargs):
+        return await self.send(message.chat.id, message.reply_text, *args, priority=REPLY, **kwargs)
+
+    async def edit(self, message, *args, **kwargs):
+        return await self.send(message.chat.id, message.edit_text, *args, priority=EDIT, **kwargs)
+
+    def _enqueue(self, job: SendJob):
+        self.queue.put_nowait((job.priority, next(self.sequence), job))
+
+    def _park(self, job: SendJob, delay: float):
+        """Requeue a job later without blocking the queue for other chats"""
+        self.parked += 1
+
+        def release():
+            self.parked -= 1
+            self._enqueue(job)
+
+        self.loop.call_later(delay, release)
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= MAX_TRACKED_CHATS:
+                # A full bucket carries no state worth keeping
+                for idle_id in [cid for cid, b in self.chats.items() if b.idle(now)]:
+                    del self.chats[idle_id]
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            job = item[2]
+            if job.future.done():
+                # The caller gave up (cancelled)
+                continue
+
+            now = time.monotonic()
+            bucket = self._chat_bucket(job.chat_id, now)
+            wait = max(bucket.delay(now), self.paused_until.get(job.chat_id, 0) - now)
+            if wait > 0:
+                self._park(job, wait)
+                continue
+
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                # Put it back so anything more urgent that arrives meanwhile goes first
+                self.queue.put_nowait(item)
+                await asyncio.sleep(wait)
+                continue
+
+            await self.slots.acquire()
+            now = time.monotonic()
+            bucket.take(now)
+            self.global_bucket.take(now)
+            self.paused_until.pop(job.chat_id, None)
+            self.loop.create_task(self._send(job))
+
+    async def _send(self, job: SendJob):
+        try:
+            result = await job.call()
+        except FloodWait as e:
+            self.flood_waits += 1
+            wait = float(e.value) + random.uniform(0, self.flood_jitter)
+            self.paused_until[job.chat_id] = time.monotonic() + wait
+            job.attempts += 1
+            if job.attempts > self.max_retries or e.value > self.max_flood_wait:
+                self._fail(job, e)
+            else:
+                self.retried += 1
+                self._park(job, wait)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            name = PRIORITY_NAMES.get(job.priority, str(job.priority))
+            self.sent[name] = self.sent.get(name, 0) + 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.slots.release()
+
+    def _fail(self, job: SendJob, error: Exception):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'parked': self.parked,
+            'sent': dict(self.sent),
+            'flood_waits': self.flood_waits,
+            'retried': self.retried,
+            'failed': self.failed,
+            'chats_tracked': len(self.chats)
+        }
+
+
+outbox = SendScheduler()
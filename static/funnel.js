@@ -0,0 +1,89 @@
+// Countdown and navigation shared by the funnel pages; served fingerprinted from /assets
+
+function openSmartlink(url) {
+    // Open smartlink in new window/tab if URL is provided
+    if (url && url !== '') {
+        window.open(url, '_blank');
+    }
+}
+
+function countdown(seconds, onDone) {
+    const timerEl = document.getElementById('timer');
+    let timeLeft = seconds;
+    timerEl.textContent = timeLeft;
+
+    const timer = setInterval(() => {
+        timeLeft--;
+        timerEl.textContent = timeLeft;
+
+        if (timeLeft <= 0) {
+            clearInterval(timer);
+            onDone();
+        }
+    }, 1000);
+}
+
+// One step per page: enable the button after the timer, then go to options.next
+function funnelStep(options) {
+    const btn = document.getElementById(options.button || 'continueBtn');
+
+    countdown(options.seconds, () => {
+        btn.disabled = false;
+        btn.onclick = () => {
+            if (options.smartlink === undefined) {
+                window.location.href = options.next;
+                return;
+            }
+            openSmartlink(options.smartlink);
+            // Redirect after short delay
+            setTimeout(() => {
+                window.location.href = options.next;
+            }, 100);
+        };
+    });
+}
+
+// All steps on one page; a step with complete: true posts the signed token
+function singlePageFunnel(options) {
+    const steps = options.steps;
+    const btn = document.getElementById('continueBtn');
+
+    function sendCompletion() {
+        const body = new URLSearchParams({ token: options.token });
+        // keepalive lets the beacon finish even if the visitor leaves the page
+        fetch(options.completeUrl, { method: 'POST', body: body, keepalive: true }).catch(() => {});
+    }
+
+    function showStep(index) {
+        const step = steps[index];
+        const last = index === steps.length - 1;
+        document.body.classList.toggle('ready', last);
+        document.getElementById('step').textContent = 'Step ' + (index + 1) + ' of ' + steps.length;
+        document.getElementById('title').textContent = step.title;
+        document.getElementById('text').textContent = step.text;
+        btn.textContent = step.button;
+        btn.disabled = true;
+        btn.onclick = null;
+
+        countdown(step.seconds, () => {
+            btn.disabled = false;
+            btn.onclick = () => {
+                if (step.smartlink) {
+                    openSmartlink(options.smartlink);
+                }
+                if (step.complete) {
+                    sendCompletion();
+                }
+                if (last) {
+                    setTimeout(() => {
+                        window.location.href = options.next;
+                    }, 100);
+                } else {
+                    showStep(index + 1);
+                }
+            };
+        });
+    }
+
+    showStep(0);
+}
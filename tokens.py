@@ -0,0 +1,134 @@
+"""Signed, stateless funnel tokens.
+
+A token is ``<step>.<issued at, base 36>.<country>.<signature>``. The
+signature is an HMAC-SHA256 over those fields plus the short link and the
+visitor's IP prefix, so checking one is a constant-time comparison with
+no storage lookup. A token is rejected when it is for another step, is
+older than ``FUNNEL_TOKEN_TTL``, was issued less than the step's minimum
+dwell time ago, or is presented from a different network. The final
+token is single-use: the web app claims its ``token_id`` before crediting.
+"""
+import os
+import hmac
+import time
+import base64
+import hashlib
+import ipaddress
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FUNNEL_TOKEN_TTL = int(os.getenv('FUNNEL_TOKEN_TTL', '1800'))
+# Seconds a token must age before it is accepted, per step (1-based). The
+# pages count down 15 seconds each before linking to steps 2, 3 and 4; the
+# single-page funnel's completion beacon (COMPLETE_STEP) follows all three.
+FUNNEL_MIN_DWELL = os.getenv('FUNNEL_MIN_DWELL', '0,12,12,12,40')
+FUNNEL_IPV4_PREFIX = int(os.getenv('FUNNEL_IPV4_PREFIX', '24'))
+FUNNEL_IPV6_PREFIX = int(os.getenv('FUNNEL_IPV6_PREFIX', '48'))
+# Tolerated clock difference between web workers on different hosts
+CLOCK_SKEW = 5
+
+SIGNATURE_BYTES = 12
+COMPLETE_STEP = 5
+
+
+def parse_dwell(spec: str) -> List[int]:
+    try:
+        return [int(part) for part in spec.split(',')]
+    except ValueError:
+        print(f"Ignoring malformed FUNNEL_MIN_DWELL '{spec}'")
+        return [0, 12, 12, 12, 40]
+
+
+def ip_prefix(ip: str) -> str:
+    """Network the visitor is on; a phone hopping between addresses keeps its prefix"""
+    try:
+        address = ipaddress.ip_address(ip.strip())
+    except (ValueError, AttributeError):
+        return str(ip)
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    prefix = FUNNEL_IPV4_PREFIX if address.version == 4 else FUNNEL_IPV6_PREFIX
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+def _b36(value: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        value, rem = divmod(value, 36)
+        out = digits[rem] + out
+        if not value:
+            return out
+
+
+def token_id(token: str) -> str:
+    """Identifies one issued token; its signature covers every other field"""
+    return token.rsplit('.', 1)[-1]
+
+
+class FunnelTokens:
+    def __init__(self, secret: str, ttl: int = FUNNEL_TOKEN_TTL,
+                 min_dwell: Optional[List[int]] = None):
+        # Separate key so funnel tokens cannot be confused with other uses of the secret
+        self.key = hmac.new(secret.encode(), b'funnel-token', hashlib.sha256).digest()
+        self.ttl = ttl
+        self.min_dwell = min_dwell if min_dwell is not None else parse_dwell(FUNNEL_MIN_DWELL)
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.accepted = 0
+        self.rejected: Dict[str, int] = {}
+
+    def _sign(self, short_link_id: str, step: int, issued: str, country: str, prefix: str) -> str:
+        message = f"{short_link_id}|{step}|{issued}|{country}|{prefix}".encode()
+        digest = hmac.new(self.key, message, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def issue(self, short_link_id: str, step: int, ip: str, country: Optional[str] = None) -> str:
+        issued = _b36(int(time.time()))
+        country = country or ''
+        with self.lock:
+            self.issued += 1
+        return f"{step}.{issued}.{country}.{self._sign(short_link_id, step, issued, country, ip_prefix(ip))}"
+
+    def _reject(self, reason: str) -> Tuple[bool, str, Optional[str]]:
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return False, reason, None
+
+    def verify(self, short_link_id: str, step: int, ip: str,
+               token: Optional[str]) -> Tuple[bool, str, Optional[str]]:
+        """Return (valid, reason, country carried by the token)"""
+        try:
+            token_step, issued, country, signature = (token or '').split('.')
+            issued_at = int(issued, 36)
+        except ValueError:
+            return self._reject('malformed')
+
+        expected = self._sign(short_link_id, int(step), issued, country, ip_prefix(ip))
+        if not hmac.compare_digest(signature.encode(), expected.encode()) or token_step != str(step):
+            return self._reject('bad_signature')
+
+        age = time.time() - issued_at
+        if age > self.ttl or age < -CLOCK_SKEW:
+            return self._reject('expired')
+        min_dwell = self.min_dwell[step - 1] if step - 1 < len(self.min_dwell) else 0
+        if age < min_dwell:
+            return self._reject('too_early')
+
+        with self.lock:
+            self.accepted += 1
+        return True, 'ok', country or None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'issued': self.issued,
+                'accepted': self.accepted,
+                'rejected': dict(self.rejected),
+                'ttl': self.ttl,
+                'min_dwell': list(self.min_dwell)
+            }
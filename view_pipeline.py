@@ -0,0 +1,288 @@
+"""Write-behind ingestion of completed views.
+
+page4 hands each credited view to ``record_view``. Events are queued in
+process and a background thread writes them in batches through
+``database.record_view_batch``, flushing when ``VIEW_FLUSH_SIZE`` events
+are waiting or ``VIEW_FLUSH_INTERVAL`` seconds have passed. Failed
+batches are retried with backoff and the queue is drained on shutdown.
+
+A batch that still fails after ``VIEW_FLUSH_RETRIES`` retries is appended,
+with the stages it already completed and its hot-document routing, to
+``VIEW_DEAD_LETTER_FILE``;
+``python view_pipeline.py replay`` writes those batches once MongoDB is
+healthy again.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from bson import json_util
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+
+import database
+
+load_dotenv()
+
+VIEW_WRITE_BEHIND = os.getenv('VIEW_WRITE_BEHIND', 'true').lower() in ('1', 'true', 'yes')
+VIEW_FLUSH_SIZE = int(os.getenv('VIEW_FLUSH_SIZE', '500'))
+VIEW_FLUSH_INTERVAL = float(os.getenv('VIEW_FLUSH_INTERVAL', '2'))
+VIEW_QUEUE_MAX = int(os.getenv('VIEW_QUEUE_MAX', '100000'))
+VIEW_FLUSH_RETRIES = int(os.getenv('VIEW_FLUSH_RETRIES', '5'))
+VIEW_DEAD_LETTER_FILE = os.getenv('VIEW_DEAD_LETTER_FILE', 'dead_letter/views.jsonl')
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_event(event: Dict) -> Dict:
+    return dict(event, _id=str(event['_id']), timestamp=event['timestamp'].isoformat())
+
+
+def _decode_event(event: Dict) -> Dict:
+    return dict(event, _id=ObjectId(event['_id']), timestamp=datetime.fromisoformat(event['timestamp']))
+
+
+class ViewPipeline:
+    def __init__(self, flush_size: int = VIEW_FLUSH_SIZE, flush_interval: float = VIEW_FLUSH_INTERVAL,
+                 max_queue: int = VIEW_QUEUE_MAX, retries: int = VIEW_FLUSH_RETRIES,
+                 dead_letter_file: str = VIEW_DEAD_LETTER_FILE):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.dead_letter_file = dead_letter_file
+        self.queue: 'queue.Queue[Dict]' = queue.Queue(maxsize=max_queue)
+        self.thread: Optional[threading.Thread] = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.dead_letter_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.retried = 0
+        self.failed = 0
+        self.inline_writes = 0
+        self.dead_lettered = 0
+
+    def _ensure_started(self):
+        # Threads do not survive fork(), so pre-fork servers start one per worker
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name='view-pipeline', daemon=True)
+            self.thread.start()
+
+    def submit(self, event: Dict):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(event)
+            self.enqueued += 1
+        except queue.Full:
+            # Never drop a paid view: write it on the request thread, but
+            # only try once so a struggling database cannot hold the request
+            self.inline_writes += 1
+            self.write_batch([event], retries=0)
+
+    def _drain(self) -> List[Dict]:
+        batch = []
+        while len(batch) < self.flush_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # Flush once the batch is full or the oldest event has waited flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_size and not self.stopping.is_set():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+
+    def write_batch(self, batch: List[Dict], state: Optional[Dict] = None, retries: Optional[int] = None):
+        """Write a batch, retrying with backoff; returns False if it was dead-lettered"""
+        state = {} if state is None else state
+        retries = self.retries if retries is None else retries
+        delay = 0.5
+        for attempt in range(retries + 1):
+            try:
+                # Held per attempt only, never across the backoff sleep
+                with self.write_lock:
+                    database.record_view_batch(batch, state)
+                self.written += len(batch)
+                self.batches += 1
+                return True
+            except Exception as e:
+                if attempt == retries:
+                    self.failed += len(batch)
+                    self._dead_letter(batch, state, e)
+                    return False
+                self.retried += 1
+                logger.warning("View batch write failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _dead_letter(self, batch: List[Dict], state: Dict, error: Exception):
+        """Keep a batch that could not be written so ``replay`` can write it later"""
+        record = {
+            'failed_at': datetime.utcnow().isoformat(),
+            'error': str(error),
+            'completed': sorted(state.get('completed', ())),
+            # Stage writes that partly succeeded; only the failed ones are replayed
+            'remaining': json.loads(json_util.dumps(state.get('remaining', {}))),
+            'live_links': sorted(state['live_links']) if 'live_links' in state else None,
+            # Hot-document routing, so a replay sends each increment where the first attempt did
+            'hot': [[kind, key, hot] for (kind, key), hot in state.get('hot', {}).items()],
+            'events': [_encode_event(event) for event in batch]
+        }
+        try:
+            with self.dead_letter_lock:
+                directory = os.path.dirname(self.dead_letter_file)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.dead_letter_file, 'a') as f:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.dead_lettered += len(batch)
+            logger.error("Dead-lettered %d views to %s: %s", len(batch), self.dead_letter_file, error)
+        except OSError as e:
+            logger.critical("Lost %d views (%s); dead letter file unwritable: %s | %s",
+                            len(batch), error, e, json.dumps(record['events']))
+
+    def flush(self):
+        """Write everything queued so far on the calling thread"""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self.write_batch(batch)
+
+    def stop(self, timeout: float = 10):
+        self.stopping.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(timeout)
+        self.flush()
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queue.qsize(),
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'batches': self.batches,
+            'retried_batches': self.retried,
+            'failed': self.failed,
+            'dead_lettered': self.dead_lettered,
+            'inline_writes': self.inline_writes
+        }
+
+
+pipeline = ViewPipeline()
+atexit.register(pipeline.stop)
+
+
+def record_view(short_link_id: str, ip: str, country: str, user_agent: str, uploader_id: int,
+                earnings: float, referrer_id: Optional[int] = None):
+    """Credit a completed view: queued when write-behind is on, written immediately otherwise"""
+    event = {
+        '_id': ObjectId(),
+        'short_link_id': short_link_id,
+        'ip': ip,
+        'country': country,
+        'user_agent': user_agent,
+        'timestamp': datetime.utcnow(),
+        'uploader_id': uploader_id,
+        'earnings': earnings,
+        'referrer_id': referrer_id
+    }
+    if VIEW_WRITE_BEHIND:
+        pipeline.submit(event)
+    else:
+        pipeline.write_batch([event])
+
+
+def get_stats() -> Dict:
+    return pipeline.stats()
+
+
+def replay_dead_letters(path: str = VIEW_DEAD_LETTER_FILE) -> Dict[str, int]:
+    """Write every dead-lettered batch, skipping the stages it had already completed.
+
+    The file is moved aside first and progress is recorded per batch, so
+    an interrupted replay resumes where it stopped instead of applying
+    counters twice. Batches that fail again are dead-lettered anew.
+    """
+    counts = {'batches': 0, 'views': 0, 'failed': 0}
+    replaying = f"{path}.replaying"
+    progress = f"{replaying}.done"
+    if not os.path.exists(replaying):
+        if not os.path.exists(path):
+            return counts
+        os.replace(path, replaying)
+    done = 0
+    if os.path.exists(progress):
+        with open(progress) as f:
+            done = int(f.read().strip() or 0)
+    
+    with open(replaying) as f:
+        for index, line in enumerate(f):
+            if index < done or not line.strip():
+                continue
+            record = json.loads(line)
+            batch = [_decode_event(event) for event in record['events']]
+            state = {
+                'completed': set(record['completed']),
+                'remaining': json_util.loads(json.dumps(record.get('remaining', {})))
+            }
+            if record.get('live_links') is not None:
+                state['live_links'] = set(record['live_links'])
+            state['hot'] = {(kind, key): hot for kind, key, hot in record.get('hot', [])}
+            if pipeline.write_batch(batch, state):
+                counts['batches'] += 1
+                counts['views'] += len(batch)
+            else:
+                counts['failed'] += len(batch)
+            with open(progress, 'w') as p:
+                p.write(str(index + 1))
+    os.remove(replaying)
+    if os.path.exists(progress):
+        os.remove(progress)
+    return counts
+
+
+if __name__ == '__main__':
+    if database.db is None:
+        print("❌ MONGO_URI is not set")
+        sys.exit(1)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'replay':
+        counts = replay_dead_letters()
+        print(f"✅ Replayed {counts['views']} views in {counts['batches']} batches "
+              f"({counts['failed']} failed again)")
+    else:
+        print("Usage: python view_pipeline.py replay")
+        sys.exit(1)
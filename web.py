@@ -1,25 +1,94 @@
 import os
+import time
 import hashlib
 import secrets
-from flask import Flask, render_template_string, request, redirect, session, jsonify
-from datetime import datetime, timedelta
-import requests
+from flask import Flask, request, redirect, jsonify
+from datetime import datetime
 from database import (
-    get_file_by_short_link_id, create_view_record, increment_file_views,
-    check_recent_view, calculate_earnings, update_user_balance, get_ad_codes
+    get_file_by_short_link_id, check_recent_view, calculate_earnings, get_ad_codes,
+    get_settings_version, get_file_referrer_id, claim_view, claim_token, get_file_cache_stats
 )
+from geoip import resolve_country, prefetch_country, peek_country, get_cache_stats as get_geoip_cache_stats
+from rate_limit import build_rate_limiter
+from assets import (
+    asset_url, find_asset, compress, supported_encodings,
+    COMPRESS_RESPONSES, COMPRESS_MIN_SIZE, COMPRESSIBLE_TYPES, ASSET_MAX_AGE
+)
+from tokens import FunnelTokens, COMPLETE_STEP, CLOCK_SKEW, token_id
+from view_pipeline import record_view, get_stats as get_view_pipeline_stats
 from dotenv import load_dotenv
 
 load_dotenv()
 
+SECRET_KEY_FILE = os.getenv('SECRET_KEY_FILE', '.secret_key')
+
+
+def load_secret_key():
+    """Secret shared by every web worker.
+
+    A key generated per process would make funnel tokens issued by one
+    worker invalid on the next, so without SECRET_KEY the
+    first worker to start writes a random key to SECRET_KEY_FILE and the
+    others read it back.
+    """
+    key = os.getenv('SECRET_KEY')
+    if key:
+        return key
+    try:
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another worker may still be writing it
+        for _ in range(50):
+            with open(SECRET_KEY_FILE) as fh:
+                key = fh.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{SECRET_KEY_FILE} is empty; delete it or set SECRET_KEY")
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(key)
+    return key
+
+
 app = Flask(__name__)
-app.secret_key = os.getenv('SECRET_KEY', secrets.token_hex(32))
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
+app.secret_key = load_secret_key()
 
 @app.after_request
 def add_ngrok_skip_header(response):
     response.headers["ngrok-skip-browser-warning"] = "true"
     return response
+
+
+@app.after_request
+def compress_response(response):
+    """ETag/304 handling for HTML, then gzip or brotli when the client accepts it"""
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    
+    body = response.get_data()
+    encoding = None
+    if COMPRESS_RESPONSES:
+        response.vary.add('Accept-Encoding')
+        if len(body) >= COMPRESS_MIN_SIZE:
+            encoding = request.accept_encodings.best_match(supported_encodings())
+    
+    if response.mimetype == 'text/html':
+        # Each encoding of the same page is a different representation
+        digest = hashlib.sha1(body).hexdigest()
+        response.set_etag(f"{digest}-{encoding}" if encoding else digest)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    
+    if encoding:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
 def get_base_url():
     replit_domains = os.getenv('REPLIT_DOMAINS')
     if replit_domains:
@@ -29,8 +98,12 @@ def get_base_url():
 
 BASE_URL = get_base_url()
 BOT_USERNAME = os.getenv('BOT_USERNAME', 'YourBot').lstrip('@')
+# pages: /download redirects through /page1-/page4
+# single: /download serves one page and the browser posts to /complete at the end
+FUNNEL_MODE = os.getenv('FUNNEL_MODE', 'pages').lower()
 
-rate_limit_store = {}
+rate_limiter = build_rate_limiter()
+funnel_tokens = FunnelTokens(app.secret_key)
 
 
 def get_client_ip():
@@ -40,46 +113,52 @@ def get_client_ip():
 
 
 def get_country_from_ip(ip):
-    if ip in ['127.0.0.1', '0.0.0.0', 'localhost']:
-        return 'OTHER'
-    
-    try:
-        response = requests.get(f'https://ipapi.co/{ip}/json/', timeout=3)
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('country_code', 'OTHER')
-    except:
-        pass
-    
-    return 'OTHER'
+    return resolve_country(ip)
 
 
-def check_rate_limit(ip, max_requests=10, window_minutes=5):
-    now = datetime.utcnow()
-    
-    if ip not in rate_limit_store:
-        rate_limit_store[ip] = []
-    
-    rate_limit_store[ip] = [
-        timestamp for timestamp in rate_limit_store[ip]
-        if now - timestamp < timedelta(minutes=window_minutes)
-    ]
-    
-    if len(rate_limit_store[ip]) >= max_requests:
-        return False
-    
-    rate_limit_store[ip].append(now)
-    return True
+def check_rate_limit(ip, route='download'):
+    return rate_limiter.allow(route, ip)
 
 
-def generate_token(file_id, page_num):
-    data = f"{file_id}-{page_num}-{app.secret_key}"
-    return hashlib.sha256(data.encode()).hexdigest()[:16]
+def generate_token(file_id, page_num, ip, country=None):
+    return funnel_tokens.issue(file_id, page_num, ip, country)
 
 
-def verify_token(file_id, page_num, token):
-    expected = generate_token(file_id, page_num)
-    return token == expected
+def verify_token(file_id, page_num, ip, token=None):
+    """Check the token for a funnel step (taken from the query string by default).
+
+    Returns (error response or None, country known so far). The country
+    travels in the token once a background lookup has finished; until
+    then every page starts one, since the pages of a funnel are usually
+    served by different workers.
+    """
+    if token is None:
+        token = request.args.get('token')
+    valid, reason, country = funnel_tokens.verify(file_id, page_num, ip, token)
+    if not valid:
+        if reason == 'too_early':
+            return ('Please wait for the timer to finish.', 403), None
+        return ('Invalid access token', 403), None
+    if country:
+        return None, country
+    prefetch_country(ip)
+    return None, peek_country(ip)
+
+
+def credit_view(short_link_id, ip, country, token):
+    """Credit the uploader for a completed funnel, once per token and dedupe window"""
+    # Only looked up here if the background lookup never finished
+    country = country or get_country_from_ip(ip)
+    user_agent = request.headers.get('User-Agent', '')
+    
+    file_record = get_file_by_short_link_id(short_link_id)
+    if (file_record and claim_token(token_id(token), funnel_tokens.ttl + CLOCK_SKEW)
+            and claim_view(short_link_id, ip)):
+        earnings = calculate_earnings(country)
+        record_view(
+            short_link_id, ip, country, user_agent,
+            file_record['uploader_id'], earnings, get_file_referrer_id(file_record)
+        )
 
 
 PAGE_1_TEMPLATE = '''
@@ -89,80 +168,7 @@ PAGE_1_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>File Access - Step 1</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
-        }
-        .banner-ad {
-            max-width: 728px;
-            width: 100%;
-            margin: 20px auto;
-            min-height: 90px;
-            background: rgba(255,255,255,0.1);
-            border-radius: 8px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        .native-ad {
-            max-width: 500px;
-            width: 100%;
-            margin: 20px auto;
-            min-height: 120px;
-            background: rgba(255,255,255,0.1);
-            border-radius: 8px;
-        }
-        .container {
-            background: white;
-            padding: 40px;
-            border-radius: 15px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            max-width: 500px;
-            width: 100%;
-            text-align: center;
-            position: relative;
-            z-index: 10;
-        }
-        h1 { color: #333; margin-bottom: 20px; font-size: 28px; }
-        p { color: #666; margin-bottom: 30px; line-height: 1.6; }
-        .timer {
-            font-size: 48px;
-            font-weight: bold;
-            color: #667eea;
-            margin: 30px 0;
-        }
-        .btn {
-            background: #667eea;
-            color: white;
-            border: none;
-            padding: 15px 40px;
-            font-size: 18px;
-            border-radius: 8px;
-            cursor: pointer;
-            transition: all 0.3s;
-            text-decoration: none;
-            display: inline-block;
-        }
-        .btn:hover { background: #5568d3; transform: translateY(-2px); }
-        .btn:disabled {
-            background: #ccc;
-            cursor: not-allowed;
-            transform: none;
-        }
-        .step-indicator {
-            color: #999;
-            font-size: 14px;
-            margin-bottom: 20px;
-        }
-    </style>
+    <link rel="stylesheet" href="''' + asset_url('funnel.css') + '''">
     
     <!-- Adsterra Popunder Ad -->
     <script type="text/javascript">
@@ -204,23 +210,9 @@ PAGE_1_TEMPLATE = '''
         <!-- Replace this comment with your 728x90 Banner ad code -->
     </div>
     
+    <script src="''' + asset_url('funnel.js') + '''"></script>
     <script>
-        let timeLeft = 15;
-        const timerEl = document.getElementById('timer');
-        const btn = document.getElementById('continueBtn');
-        
-        const countdown = setInterval(() => {
-            timeLeft--;
-            timerEl.textContent = timeLeft;
-            
-            if (timeLeft <= 0) {
-                clearInterval(countdown);
-                btn.disabled = false;
-                btn.onclick = () => {
-                    window.location.href = '{{ next_url }}';
-                };
-            }
-        }, 1000);
+        funnelStep({ seconds: 15, next: '{{ next_url }}' });
     </script>
     
     <!-- Adsterra Social Bar -->
@@ -249,80 +241,7 @@ PAGE_3_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>File Access - Step 3</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
-        }
-        .banner-ad {
-            max-width: 728px;
-            width: 100%;
-            margin: 20px auto;
-            min-height: 90px;
-            background: rgba(255,255,255,0.1);
-            border-radius: 8px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        .native-ad {
-            max-width: 500px;
-            width: 100%;
-            margin: 20px auto;
-            min-height: 120px;
-            background: rgba(255,255,255,0.1);
-            border-radius: 8px;
-        }
-        .container {
-            background: white;
-            padding: 40px;
-            border-radius: 15px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            max-width: 500px;
-            width: 100%;
-            text-align: center;
-            position: relative;
-            z-index: 10;
-        }
-        h1 { color: #333; margin-bottom: 20px; font-size: 28px; }
-        p { color: #666; margin-bottom: 30px; line-height: 1.6; }
-        .timer {
-            font-size: 48px;
-            font-weight: bold;
-            color: #667eea;
-            margin: 30px 0;
-        }
-        .btn {
-            background: #667eea;
-            color: white;
-            border: none;
-            padding: 15px 40px;
-            font-size: 18px;
-            border-radius: 8px;
-            cursor: pointer;
-            transition: all 0.3s;
-            text-decoration: none;
-            display: inline-block;
-        }
-        .btn:hover { background: #5568d3; transform: translateY(-2px); }
-        .btn:disabled {
-            background: #ccc;
-            cursor: not-allowed;
-            transform: none;
-        }
-        .step-indicator {
-            color: #999;
-            font-size: 14px;
-            margin-bottom: 20px;
-        }
-    </style>
+    <link rel="stylesheet" href="''' + asset_url('funnel.css') + '''">
     
     <!-- Adsterra Popunder -->
     <script type="text/javascript">
@@ -356,31 +275,9 @@ PAGE_3_TEMPLATE = '''
         <!-- Replace this comment with your 728x90 Banner ad code -->
     </div>
     
+    <script src="''' + asset_url('funnel.js') + '''"></script>
     <script>
-        let timeLeft = 15;
-        const timerEl = document.getElementById('timer');
-        const btn = document.getElementById('continueBtn');
-        const smartlinkUrl = '{{ smartlink_url }}';
-        
-        const countdown = setInterval(() => {
-            timeLeft--;
-            timerEl.textContent = timeLeft;
-            
-            if (timeLeft <= 0) {
-                clearInterval(countdown);
-                btn.disabled = false;
-                btn.onclick = () => {
-                    // Open smartlink in new window/tab if URL is provided
-                    if (smartlinkUrl && smartlinkUrl !== '') {
-                        window.open(smartlinkUrl, '_blank');
-                    }
-                    // Redirect to next page after short delay
-                    setTimeout(() => {
-                        window.location.href = '{{ next_url }}';
-                    }, 100);
-                };
-            }
-        }, 1000);
+        funnelStep({ seconds: 15, next: '{{ next_url }}', smartlink: '{{ smartlink_url }}' });
     </script>
     
     <!-- Adsterra Social Bar -->
@@ -398,80 +295,7 @@ PAGE_4_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>File Ready!</title>
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            background: linear-gradient(135deg, #11998e 0%, #38ef7d 100%);
-            min-height: 100vh;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            justify-content: center;
-            padding: 20px;
-        }
-        .banner-ad {
-            max-width: 728px;
-            width: 100%;
-            margin: 20px auto;
-            min-height: 90px;
-            background: rgba(255,255,255,0.1);
-            border-radius: 8px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        .native-ad {
-            max-width: 500px;
-            width: 100%;
-            margin: 20px auto;
-            min-height: 120px;
-            background: rgba(255,255,255,0.1);
-            border-radius: 8px;
-        }
-        .container {
-            background: white;
-            padding: 40px;
-            border-radius: 15px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            max-width: 500px;
-            width: 100%;
-            text-align: center;
-            position: relative;
-            z-index: 10;
-        }
-        h1 { color: #333; margin-bottom: 20px; font-size: 28px; }
-        p { color: #666; margin-bottom: 30px; line-height: 1.6; }
-        .timer {
-            font-size: 48px;
-            font-weight: bold;
-            color: #11998e;
-            margin: 30px 0;
-        }
-        .btn {
-            background: #11998e;
-            color: white;
-            border: none;
-            padding: 15px 40px;
-            font-size: 18px;
-            border-radius: 8px;
-            cursor: pointer;
-            transition: all 0.3s;
-            text-decoration: none;
-            display: inline-block;
-        }
-        .btn:hover { background: #0e7d73; transform: translateY(-2px); }
-        .btn:disabled {
-            background: #ccc;
-            cursor: not-allowed;
-            transform: none;
-        }
-        .step-indicator {
-            color: #999;
-            font-size: 14px;
-            margin-bottom: 20px;
-        }
-    </style>
+    <link rel="stylesheet" href="''' + asset_url('funnel.css') + '''">
     
     <!-- Adsterra Smartlink -->
     <script type="text/javascript">
@@ -486,7 +310,7 @@ PAGE_4_TEMPLATE = '''
     </script>
     <!-- <script type="text/javascript" src="//www.highperformanceformat.com/YOUR_KEY/invoke.js"></script> -->
 </head>
-<body>
+<body class="ready">
     <!-- Banner Ad - Top -->
     <div class="banner-ad">
         <!-- Add your Adsterra Banner code here -->
@@ -513,31 +337,9 @@ PAGE_4_TEMPLATE = '''
         <!-- Replace this comment with your 728x90 Banner ad code -->
     </div>
     
+    <script src="''' + asset_url('funnel.js') + '''"></script>
     <script>
-        let timeLeft = 5;
-        const timerEl = document.getElementById('timer');
-        const btn = document.getElementById('getBtn');
-        const smartlinkUrl = '{{ smartlink_url }}';
-        
-        const countdown = setInterval(() => {
-            timeLeft--;
-            timerEl.textContent = timeLeft;
-            
-            if (timeLeft <= 0) {
-                clearInterval(countdown);
-                btn.disabled = false;
-                btn.onclick = () => {
-                    // Open smartlink in new window/tab if URL is provided
-                    if (smartlinkUrl && smartlinkUrl !== '') {
-                        window.open(smartlinkUrl, '_blank');
-                    }
-                    // Redirect to bot after short delay
-                    setTimeout(() => {
-                        window.location.href = '{{ bot_url }}';
-                    }, 100);
-                };
-            }
-        }, 1000);
+        funnelStep({ seconds: 5, next: '{{ bot_url }}', smartlink: '{{ smartlink_url }}', button: 'getBtn' });
     </script>
     
     <!-- Adsterra Social Bar -->
@@ -556,6 +358,122 @@ PAGE_4_TEMPLATE = '''
 </html>
 '''
 
+# Single-page funnel: the four steps run in the browser and one signed
+# beacon to /complete credits the view
+SINGLE_PAGE_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>File Access</title>
+    <link rel="stylesheet" href="''' + asset_url('funnel.css') + '''">
+    
+    <!-- Adsterra Popunder -->
+    <script type="text/javascript">
+        <!-- Add your Adsterra Popunder code here -->
+    </script>
+    
+    <!-- Adsterra Smartlink -->
+    <script type="text/javascript">
+        <!-- Add your Adsterra Smartlink code here -->
+    </script>
+</head>
+<body>
+    <!-- Banner Ad - Top -->
+    <div class="banner-ad">
+        <!-- Add your Adsterra Banner code here -->
+    </div>
+    
+    <!-- Native Banner Ad -->
+    <div class="native-ad">
+        <!-- Add your Adsterra Native Banner code here -->
+    </div>
+    
+    <div class="container">
+        <div class="step-indicator" id="step">Step 1 of 4</div>
+        <h1 id="title">🔐 Accessing Your File</h1>
+        <p id="text">Please wait while we prepare your download link...</p>
+        <div class="timer" id="timer">15</div>
+        <button class="btn" id="continueBtn" disabled>Continue</button>
+    </div>
+    
+    <!-- Banner Ad - Bottom -->
+    <div class="banner-ad">
+        <!-- Add your Adsterra Banner code here -->
+    </div>
+    
+    <script src="''' + asset_url('funnel.js') + '''"></script>
+    <script>
+        singlePageFunnel({
+            steps: [
+                { title: '🔐 Accessing Your File', text: 'Please wait while we prepare your download link...', seconds: 15, button: 'Continue' },
+                { title: '⏳ Preparing Your File', text: 'Please wait while we prepare your download link...', seconds: 15, button: 'Continue' },
+                { title: '📦 Loading Your File', text: 'Please wait while we prepare your download link...', seconds: 15, button: 'Continue', smartlink: true, complete: true },
+                { title: '✅ File Ready!', text: 'Your file is ready to download. Click the button below to get your file.', seconds: 5, button: 'Get Link', smartlink: true }
+            ],
+            token: '{{ token }}',
+            completeUrl: '{{ complete_url }}',
+            next: '{{ bot_url }}',
+            smartlink: '{{ smartlink_url }}'
+        });
+    </script>
+    
+    <!-- Adsterra Social Bar -->
+    <script type="text/javascript">
+        <!-- Add your Adsterra Social Bar code here -->
+    </script>
+</body>
+</html>
+'''
+
+# Ad slot placeholder in the template source -> ad code setting that fills it
+AD_PLACEHOLDERS = {
+    '<!-- Add your Adsterra Popunder code here -->': 'popunder',
+    '<!-- Add your Adsterra Smartlink code here -->': 'smartlink',
+    '<!-- Add your Adsterra Banner code here -->': 'banner',
+    '<!-- Add your Adsterra Native Banner code here -->': 'native',
+    '<!-- Add your Adsterra Social Bar code here -->': 'social_bar',
+}
+
+PAGE_TEMPLATES = {
+    1: (PAGE_1_TEMPLATE, ('popunder', 'banner', 'native', 'social_bar')),
+    2: (PAGE_2_TEMPLATE, ('popunder', 'banner', 'native', 'social_bar')),
+    3: (PAGE_3_TEMPLATE, ('popunder', 'banner', 'native', 'social_bar')),
+    4: (PAGE_4_TEMPLATE, ('smartlink', 'banner', 'native', 'social_bar')),
+    'single': (SINGLE_PAGE_TEMPLATE, ('popunder', 'smartlink', 'banner', 'native', 'social_bar')),
+}
+
+# page number (or 'single') -> (settings version, compiled template)
+compiled_pages = {}
+
+
+def compile_page(page_num, ad_codes):
+    source, slots = PAGE_TEMPLATES[page_num]
+    for placeholder, ad_type in AD_PLACEHOLDERS.items():
+        if ad_type in slots:
+            source = source.replace(placeholder, ad_codes.get(ad_type, ''))
+    return app.jinja_env.from_string(
+        source,
+        globals={'smartlink_url': ad_codes.get('smartlink', '')}
+    )
+
+
+def get_page_template(page_num):
+    """Compiled page with the ad codes baked in, rebuilt when the settings version changes"""
+    version = get_settings_version()
+    cached = compiled_pages.get(page_num)
+    if cached and cached[0] == version:
+        return cached[1]
+    
+    template = compile_page(page_num, get_ad_codes())
+    compiled_pages[page_num] = (version, template)
+    return template
+
+
+def render_page(page_num, **context):
+    return get_page_template(page_num).render(**context)
+
 
 @app.route('/')
 def index():
@@ -618,9 +536,19 @@ def download_page(short_link_id):
     if check_recent_view(short_link_id, ip):
         return 'You recently viewed this file. Please wait before trying again.', 429
     
-    token = generate_token(short_link_id, 1)
-    session['short_link_id'] = short_link_id
-    session['started_at'] = datetime.utcnow().isoformat()
+    # Resolve the country while the visitor sits through pages 1-3
+    prefetch_country(ip)
+    
+    if FUNNEL_MODE == 'single':
+        token = generate_token(short_link_id, COMPLETE_STEP, ip, peek_country(ip))
+        return render_page(
+            'single',
+            token=token,
+            complete_url=f'/complete/{short_link_id}',
+            bot_url=f'https://t.me/{BOT_USERNAME}?start={short_link_id}'
+        )
+    
+    token = generate_token(short_link_id, 1, ip, peek_country(ip))
     
     next_url = f'/page1/{short_link_id}?token={token}'
     return redirect(next_url)
@@ -628,93 +556,103 @@ def download_page(short_link_id):
 
 @app.route('/page1/<short_link_id>')
 def page1(short_link_id):
-    token = request.args.get('token')
-    if not verify_token(short_link_id, 1, token):
-        return 'Invalid access token', 403
+    ip = get_client_ip()
+    if not check_rate_limit(ip, 'page'):
+        return 'Rate limit exceeded. Please try again later.', 429
     
-    next_token = generate_token(short_link_id, 2)
-    next_url = f'/page2/{short_link_id}?token={next_token}'
+    error, country = verify_token(short_link_id, 1, ip)
+    if error:
+        return error
     
-    ad_codes = get_ad_codes()
-    template = PAGE_1_TEMPLATE
-    template = template.replace('<!-- Add your Adsterra Popunder code here -->', ad_codes.get('popunder', ''))
-    template = template.replace('<!-- Add your Adsterra Banner code here -->', ad_codes.get('banner', ''))
-    template = template.replace('<!-- Add your Adsterra Native Banner code here -->', ad_codes.get('native', ''))
-    template = template.replace('<!-- Add your Adsterra Social Bar code here -->', ad_codes.get('social_bar', ''))
+    next_token = generate_token(short_link_id, 2, ip, country)
+    next_url = f'/page2/{short_link_id}?token={next_token}'
     
-    return render_template_string(template, next_url=next_url)
+    return render_page(1, next_url=next_url)
 
 
 @app.route('/page2/<short_link_id>')
 def page2(short_link_id):
-    token = request.args.get('token')
-    if not verify_token(short_link_id, 2, token):
-        return 'Invalid access token', 403
+    ip = get_client_ip()
+    if not check_rate_limit(ip, 'page'):
+        return 'Rate limit exceeded. Please try again later.', 429
     
-    next_token = generate_token(short_link_id, 3)
-    next_url = f'/page3/{short_link_id}?token={next_token}'
+    error, country = verify_token(short_link_id, 2, ip)
+    if error:
+        return error
     
-    ad_codes = get_ad_codes()
-    template = PAGE_2_TEMPLATE
-    template = template.replace('<!-- Add your Adsterra Popunder code here -->', ad_codes.get('popunder', ''))
-    template = template.replace('<!-- Add your Adsterra Banner code here -->', ad_codes.get('banner', ''))
-    template = template.replace('<!-- Add your Adsterra Native Banner code here -->', ad_codes.get('native', ''))
-    template = template.replace('<!-- Add your Adsterra Social Bar code here -->', ad_codes.get('social_bar', ''))
+    next_token = generate_token(short_link_id, 3, ip, country)
+    next_url = f'/page3/{short_link_id}?token={next_token}'
     
-    return render_template_string(template, next_url=next_url)
+    return render_page(2, next_url=next_url)
 
 
 @app.route('/page3/<short_link_id>')
 def page3(short_link_id):
-    token = request.args.get('token')
-    if not verify_token(short_link_id, 3, token):
-        return 'Invalid access token', 403
-    
-    next_token = generate_token(short_link_id, 4)
-    next_url = f'/page4/{short_link_id}?token={next_token}'
+    ip = get_client_ip()
+    if not check_rate_limit(ip, 'page'):
+        return 'Rate limit exceeded. Please try again later.', 429
     
-    ad_codes = get_ad_codes()
-    smartlink_url = ad_codes.get('smartlink', '')
+    error, country = verify_token(short_link_id, 3, ip)
+    if error:
+        return error
     
-    template = PAGE_3_TEMPLATE
-    template = template.replace('<!-- Add your Adsterra Popunder code here -->', ad_codes.get('popunder', ''))
-    template = template.replace('<!-- Add your Adsterra Banner code here -->', ad_codes.get('banner', ''))
-    template = template.replace('<!-- Add your Adsterra Native Banner code here -->', ad_codes.get('native', ''))
-    template = template.replace('<!-- Add your Adsterra Social Bar code here -->', ad_codes.get('social_bar', ''))
+    next_token = generate_token(short_link_id, 4, ip, country)
+    next_url = f'/page4/{short_link_id}?token={next_token}'
     
-    return render_template_string(template, next_url=next_url, smartlink_url=smartlink_url)
+    return render_page(3, next_url=next_url)
 
 
 @app.route('/page4/<short_link_id>')
 def page4(short_link_id):
-    token = request.args.get('token')
-    if not verify_token(short_link_id, 4, token):
-        return 'Invalid access token', 403
-    
     ip = get_client_ip()
-    country = get_country_from_ip(ip)
-    user_agent = request.headers.get('User-Agent', '')
+    if not check_rate_limit(ip, 'page'):
+        return 'Rate limit exceeded. Please try again later.', 429
     
-    file_record = get_file_by_short_link_id(short_link_id)
-    if file_record:
-        create_view_record(short_link_id, ip, country, user_agent)
-        increment_file_views(short_link_id, country)
-        
-        earnings = calculate_earnings(country)
-        update_user_balance(file_record['uploader_id'], earnings)
+    token = request.args.get('token')
+    error, country = verify_token(short_link_id, 4, ip, token)
+    if error:
+        return error
+    
+    credit_view(short_link_id, ip, country, token)
     
     bot_url = f'https://t.me/{BOT_USERNAME}?start={short_link_id}'
     
-    ad_codes = get_ad_codes()
-    smartlink_url = ad_codes.get('smartlink', '')
+    return render_page(4, bot_url=bot_url)
+
+
+@app.route('/complete/<short_link_id>', methods=['POST'])
+def complete(short_link_id):
+    """Completion beacon posted by the single-page funnel"""
+    ip = get_client_ip()
+    if not check_rate_limit(ip, 'page'):
+        return 'Rate limit exceeded. Please try again later.', 429
     
-    template = PAGE_4_TEMPLATE
-    template = template.replace('<!-- Add your Adsterra Smartlink code here -->', ad_codes.get('smartlink', ''))
-    template = template.replace('<!-- Add your Adsterra Banner code here -->', ad_codes.get('banner', ''))
-    template = template.replace('<!-- Add your Adsterra Native Banner code here -->', ad_codes.get('native', ''))
-    template = template.replace('<!-- Add your Adsterra Social Bar code here -->', ad_codes.get('social_bar', ''))
+    token = request.form.get('token', '')
+    error, country = verify_token(short_link_id, COMPLETE_STEP, ip, token)
+    if error:
+        return error
     
-    return render_template_string(template, bot_url=bot_url, smartlink_url=smartlink_url)
+    credit_view(short_link_id, ip, country, token)
+    return '', 204
+
+
+@app.route('/assets/<filename>')
+def static_asset(filename):
+    """Fingerprinted CSS/JS; the URL changes with the content, so it can be cached forever"""
+    asset = find_asset(filename)
+    if asset is None:
+        return 'Not found', 404
+    
+    encoding = None
+    if COMPRESS_RESPONSES:
+        encoding = request.accept_encodings.best_match(list(asset.encoded))
+    response = app.response_class(asset.variant(encoding), mimetype=asset.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    response.set_etag(f"{asset.digest}-{encoding}" if encoding else asset.digest)
+    return response.make_conditional(request)
 
 
 @app.route('/health')
@@ -722,5 +660,16 @@ def health():
     return jsonify({'status': 'ok', 'timestamp': datetime.utcnow().isoformat()})
 
 
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        'geoip_cache': get_geoip_cache_stats(),
+        'file_cache': get_file_cache_stats(),
+        'view_pipeline': get_view_pipeline_stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'funnel_tokens': funnel_tokens.stats()
+    })
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)